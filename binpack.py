@@ -0,0 +1,685 @@
+from collections import namedtuple
+import os
+import struct
+import sys
+
+import numpy as np
+
+from bitboards import (
+    WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, NO_PIECE, PIECE_SYMBOLS,
+    KING_ATTACKS, PAWN_ATTACKS,
+    bishop_attacks, rook_attacks, piece_attacks, iter_squares, nth_set_square, squares_before,
+    parse_square, square_name, square_rank, lsb,
+)
+
+''' Decode Stockfish .binpack files natively in Python
+
+A binpack is a sequence of chunks, each starting with b'BINP' and a little-endian uint32 size.
+A chunk holds "stems": a 32-byte packed position entry, a big-endian uint16 number of plies,
+then a bitstream of (move, score delta) pairs continuing the game from the stem position.
+Moves in the bitstream are indexes into the pseudo-legal moves of the position, so decoding
+needs to replay every move of the chain.
+
+Format reference:
+https://github.com/official-stockfish/Stockfish/blob/tools/src/extra/nnue_data_binpack_format.h
+'''
+
+# castling rights bits
+WHITE_OO = 1
+WHITE_OOO = 2
+BLACK_OO = 4
+BLACK_OOO = 8
+CASTLING_RIGHTS_OF = [WHITE_OO | WHITE_OOO, BLACK_OO | BLACK_OOO]
+
+# castling rights to keep when a piece moves from or to a square
+_CASTLING_RIGHTS_KEPT = [0xf] * 64
+_CASTLING_RIGHTS_KEPT[parse_square('a1')] = 0xf & ~WHITE_OOO
+_CASTLING_RIGHTS_KEPT[parse_square('h1')] = 0xf & ~WHITE_OO
+_CASTLING_RIGHTS_KEPT[parse_square('e1')] = 0xf & ~(WHITE_OO | WHITE_OOO)
+_CASTLING_RIGHTS_KEPT[parse_square('a8')] = 0xf & ~BLACK_OOO
+_CASTLING_RIGHTS_KEPT[parse_square('h8')] = 0xf & ~BLACK_OO
+_CASTLING_RIGHTS_KEPT[parse_square('e8')] = 0xf & ~(BLACK_OO | BLACK_OOO)
+
+# move types
+NORMAL = 0
+PROMOTION = 1
+CASTLE = 2
+EN_PASSANT = 3
+
+# special nibbles of a compressed position
+_NIBBLE_EP_PAWN = 12
+_NIBBLE_WHITE_CASTLING_ROOK = 13
+_NIBBLE_BLACK_CASTLING_ROOK = 14
+_NIBBLE_BLACK_KING_TO_MOVE = 15
+
+PACKED_ENTRY_SIZE = 32
+COMPRESSED_POSITION_SIZE = 24
+SCORE_VLE_BLOCK_SIZE = 4
+# a new chunk is started once the current one grows past this size
+SUGGESTED_CHUNK_SIZE = 1024 * 1024
+
+# a move is a (move_type, from_square, to_square, promotion_piece_type) tuple
+# castling moves go from the king square to the rook square, like in Stockfish's binpack library
+Move = namedtuple('Move', ['type', 'from_sq', 'to_sq', 'promotion'])
+
+
+def _to_int16(value):
+    return ((value + 0x8000) & 0xffff) - 0x8000
+
+def signed_to_unsigned(value):
+    ''' Map an int16 to a uint16 so that small magnitudes become small numbers '''
+    r = value & 0xffff
+    if r & 0x8000:
+        r ^= 0x7fff
+    return ((r << 1) | (r >> 15)) & 0xffff
+
+def unsigned_to_signed(value):
+    r = ((value << 15) | (value >> 1)) & 0xffff
+    if r & 0x8000:
+        r ^= 0x7fff
+    return r - 0x10000 if r & 0x8000 else r
+
+def used_bits_safe(n):
+    ''' Number of bits needed to encode an index into n choices '''
+    return (n - 1).bit_length() if n > 0 else 0
+
+
+class Position:
+    ''' Board state needed to decode and encode binpack entries '''
+    __slots__ = ('board', 'pieces', 'colors', 'side_to_move', 'castling_rights', 'ep_square', 'rule50', 'ply')
+
+    def __init__(self):
+        self.board = [NO_PIECE] * 64
+        self.pieces = [0] * 12
+        self.colors = [0, 0]
+        self.side_to_move = WHITE
+        self.castling_rights = 0
+        self.ep_square = -1
+        self.rule50 = 0
+        self.ply = 0
+
+    def copy(self):
+        pos = Position.__new__(Position)
+        pos.board = self.board[:]
+        pos.pieces = self.pieces[:]
+        pos.colors = self.colors[:]
+        pos.side_to_move = self.side_to_move
+        pos.castling_rights = self.castling_rights
+        pos.ep_square = self.ep_square
+        pos.rule50 = self.rule50
+        pos.ply = self.ply
+        return pos
+
+    def __eq__(self, other):
+        return self.pieces == other.pieces and \
+               self.side_to_move == other.side_to_move and \
+               self.castling_rights == other.castling_rights and \
+               self.ep_square == other.ep_square
+
+    def put(self, piece, sq):
+        self.board[sq] = piece
+        self.pieces[piece] |= 1 << sq
+        self.colors[piece & 1] |= 1 << sq
+
+    def remove(self, sq):
+        piece = self.board[sq]
+        self.board[sq] = NO_PIECE
+        self.pieces[piece] &= ~(1 << sq)
+        self.colors[piece & 1] &= ~(1 << sq)
+        return piece
+
+    def occupied(self):
+        return self.colors[WHITE] | self.colors[BLACK]
+
+    def king_square(self, color):
+        return lsb(self.pieces[KING * 2 + color])
+
+    def is_attacked(self, sq, by_color, occupied=None):
+        if occupied is None:
+            occupied = self.occupied()
+        p = self.pieces
+        if PAWN_ATTACKS[by_color ^ 1][sq] & p[PAWN * 2 + by_color]:
+            return True
+        if piece_attacks(KNIGHT, sq, occupied) & p[KNIGHT * 2 + by_color]:
+            return True
+        if KING_ATTACKS[sq] & p[KING * 2 + by_color]:
+            return True
+        queens = p[QUEEN * 2 + by_color]
+        if bishop_attacks(sq, occupied) & (p[BISHOP * 2 + by_color] | queens):
+            return True
+        if rook_attacks(sq, occupied) & (p[ROOK * 2 + by_color] | queens):
+            return True
+        return False
+
+    def is_check(self):
+        return self.is_attacked(self.king_square(self.side_to_move), self.side_to_move ^ 1)
+
+    def is_ep_possible(self, ep_square):
+        ''' True if the side to move has a legal en passant capture onto ep_square '''
+        us = self.side_to_move
+        them = us ^ 1
+        capturers = PAWN_ATTACKS[them][ep_square] & self.pieces[PAWN * 2 + us]
+        if not capturers:
+            return False
+        captured_sq = ep_square - 8 if us == WHITE else ep_square + 8
+        king_sq = self.king_square(us)
+        for from_sq in iter_squares(capturers):
+            pos = self.copy()
+            pos.remove(captured_sq)
+            pos.put(pos.remove(from_sq), ep_square)
+            if not pos.is_attacked(king_sq, them):
+                return True
+        return False
+
+    def do_move(self, move):
+        ''' Return the position after the move is made '''
+        move_type, from_sq, to_sq, promotion = move
+        pos = self.copy()
+        us = self.side_to_move
+        pos.ep_square = -1
+        if move_type == CASTLE:
+            rank_offset = from_sq & 56
+            if to_sq > from_sq:
+                king_to, rook_to = rank_offset + 6, rank_offset + 5
+            else:
+                king_to, rook_to = rank_offset + 2, rank_offset + 3
+            king = pos.remove(from_sq)
+            rook = pos.remove(to_sq)
+            pos.put(king, king_to)
+            pos.put(rook, rook_to)
+            pos.castling_rights &= ~CASTLING_RIGHTS_OF[us]
+            pos.rule50 += 1
+        else:
+            is_capture = pos.board[to_sq] != NO_PIECE
+            if move_type == EN_PASSANT:
+                pos.remove(to_sq - 8 if us == WHITE else to_sq + 8)
+                is_capture = True
+            elif is_capture:
+                pos.remove(to_sq)
+            piece = pos.remove(from_sq)
+            if move_type == PROMOTION:
+                pos.put(promotion * 2 + us, to_sq)
+            else:
+                pos.put(piece, to_sq)
+            pos.castling_rights &= _CASTLING_RIGHTS_KEPT[from_sq] & _CASTLING_RIGHTS_KEPT[to_sq]
+            is_pawn_move = piece >> 1 == PAWN
+            pos.rule50 = 0 if is_pawn_move or is_capture else pos.rule50 + 1
+        pos.side_to_move = us ^ 1
+        pos.ply += 1
+        if move_type == NORMAL and pos.board[to_sq] >> 1 == PAWN and abs(to_sq - from_sq) == 16:
+            # only keep the en passant square when it can be captured, like Stockfish
+            ep_square = (from_sq + to_sq) // 2
+            if pos.is_ep_possible(ep_square):
+                pos.ep_square = ep_square
+        return pos
+
+    @classmethod
+    def from_fen(cls, fen):
+        fields = fen.split()
+        pos = cls()
+        sq = 56
+        for c in fields[0]:
+            if c == '/':
+                sq -= 16
+            elif c.isdigit():
+                sq += int(c)
+            else:
+                pos.put(PIECE_SYMBOLS.index(c), sq)
+                sq += 1
+        pos.side_to_move = BLACK if len(fields) > 1 and fields[1] == 'b' else WHITE
+        if len(fields) > 2:
+            for c in fields[2]:
+                pos.castling_rights |= {'K': WHITE_OO, 'Q': WHITE_OOO, 'k': BLACK_OO, 'q': BLACK_OOO}.get(c, 0)
+        if len(fields) > 3 and fields[3] != '-':
+            ep_square = parse_square(fields[3])
+            if pos.is_ep_possible(ep_square):
+                pos.ep_square = ep_square
+        if len(fields) > 4:
+            pos.rule50 = int(fields[4])
+        if len(fields) > 5:
+            pos.ply = (int(fields[5]) - 1) * 2 + pos.side_to_move
+        return pos
+
+    def fen(self):
+        rows = []
+        for rank in range(7, -1, -1):
+            row = ''
+            empty = 0
+            for sq in range(rank * 8, rank * 8 + 8):
+                piece = self.board[sq]
+                if piece == NO_PIECE:
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                row += PIECE_SYMBOLS[piece]
+            if empty:
+                row += str(empty)
+            rows.append(row)
+        castling = ''.join(c for c, right in zip('KQkq', (WHITE_OO, WHITE_OOO, BLACK_OO, BLACK_OOO))
+                           if self.castling_rights & right) or '-'
+        ep = square_name(self.ep_square) if self.ep_square >= 0 else '-'
+        stm = 'w' if self.side_to_move == WHITE else 'b'
+        return f'{"/".join(rows)} {stm} {castling} {ep} {self.rule50} {self.ply // 2 + 1}'
+
+    @classmethod
+    def from_compressed(cls, data):
+        ''' Decode the 24-byte compressed position of a packed entry '''
+        pos = cls()
+        occupied = int.from_bytes(data[:8], 'big')
+        for i, sq in enumerate(iter_squares(occupied)):
+            nibble = (data[8 + (i >> 1)] >> ((i & 1) * 4)) & 0xf
+            if nibble == _NIBBLE_EP_PAWN:
+                if square_rank(sq) == 3:
+                    pos.put(PAWN * 2 + WHITE, sq)
+                    pos.ep_square = sq - 8
+                else:
+                    pos.put(PAWN * 2 + BLACK, sq)
+                    pos.ep_square = sq + 8
+            elif nibble == _NIBBLE_WHITE_CASTLING_ROOK:
+                pos.put(ROOK * 2 + WHITE, sq)
+                pos.castling_rights |= WHITE_OOO if sq == parse_square('a1') else WHITE_OO
+            elif nibble == _NIBBLE_BLACK_CASTLING_ROOK:
+                pos.put(ROOK * 2 + BLACK, sq)
+                pos.castling_rights |= BLACK_OOO if sq == parse_square('a8') else BLACK_OO
+            elif nibble == _NIBBLE_BLACK_KING_TO_MOVE:
+                pos.put(KING * 2 + BLACK, sq)
+                pos.side_to_move = BLACK
+            else:
+                pos.put(nibble, sq)
+        return pos
+
+    def compress(self):
+        ''' Encode into the 24-byte compressed position of a packed entry '''
+        occupied = self.occupied()
+        data = bytearray(COMPRESSED_POSITION_SIZE)
+        data[:8] = occupied.to_bytes(8, 'big')
+        rights = self.castling_rights
+        for i, sq in enumerate(iter_squares(occupied)):
+            nibble = self.board[sq]
+            if nibble == PAWN * 2 + WHITE and self.ep_square == sq - 8 or \
+               nibble == PAWN * 2 + BLACK and self.ep_square == sq + 8:
+                nibble = _NIBBLE_EP_PAWN
+            elif nibble == ROOK * 2 + WHITE and (sq == 0 and rights & WHITE_OOO or sq == 7 and rights & WHITE_OO):
+                nibble = _NIBBLE_WHITE_CASTLING_ROOK
+            elif nibble == ROOK * 2 + BLACK and (sq == 56 and rights & BLACK_OOO or sq == 63 and rights & BLACK_OO):
+                nibble = _NIBBLE_BLACK_CASTLING_ROOK
+            elif nibble == KING * 2 + BLACK and self.side_to_move == BLACK:
+                nibble = _NIBBLE_BLACK_KING_TO_MOVE
+            data[8 + (i >> 1)] |= nibble << ((i & 1) * 4)
+        return bytes(data)
+
+    def pawn_destinations(self, from_sq):
+        us = self.side_to_move
+        occupied = self.occupied()
+        targets = self.colors[us ^ 1]
+        if self.ep_square >= 0:
+            targets |= 1 << self.ep_square
+        destinations = PAWN_ATTACKS[us][from_sq] & targets
+        forward = from_sq + 8 if us == WHITE else from_sq - 8
+        if not occupied >> forward & 1:
+            destinations |= 1 << forward
+            start_rank = 1 if us == WHITE else 6
+            forward2 = forward + 8 if us == WHITE else forward - 8
+            if square_rank(from_sq) == start_rank and not occupied >> forward2 & 1:
+                destinations |= 1 << forward2
+        return destinations
+
+
+def compress_move(move):
+    packed = (move.type << 14) | (move.from_sq << 8) | (move.to_sq << 2)
+    if move.type == PROMOTION:
+        packed |= move.promotion - KNIGHT
+    return packed
+
+def decompress_move(packed):
+    move_type = packed >> 14
+    promotion = (packed & 3) + KNIGHT if move_type == PROMOTION else None
+    return Move(move_type, (packed >> 8) & 63, (packed >> 2) & 63, promotion)
+
+def move_to_uci(move):
+    from_sq, to_sq = move.from_sq, move.to_sq
+    if move.type == CASTLE:
+        # the king lands on the g or c file
+        to_sq = (from_sq & 56) + (6 if to_sq > from_sq else 2)
+    uci = square_name(from_sq) + square_name(to_sq)
+    if move.type == PROMOTION:
+        uci += 'pnbrqk'[move.promotion]
+    return uci
+
+
+TrainingEntry = namedtuple('TrainingEntry', ['pos', 'move', 'score', 'ply', 'result'])
+
+def unpack_entry(data):
+    ''' Decode a 32-byte packed training data entry '''
+    pos = Position.from_compressed(data[:COMPRESSED_POSITION_SIZE])
+    packed_move, packed_score, ply_result, rule50 = struct.unpack_from('>HHHH', data, COMPRESSED_POSITION_SIZE)
+    pos.ply = ply_result & 0x3fff
+    pos.rule50 = rule50
+    return TrainingEntry(pos, decompress_move(packed_move), unsigned_to_signed(packed_score),
+                         pos.ply, unsigned_to_signed(ply_result >> 14))
+
+
+class MovetextReader:
+    ''' Reads the (move, score) chain that follows a stem entry '''
+    def __init__(self, data, offset, entry, num_plies):
+        self.data = data
+        self.bit_offset = offset * 8
+        self.entry = entry
+        self.num_plies = num_plies
+        self.last_score = -entry.score
+
+    def read_bits(self, count):
+        if count == 0:
+            return 0
+        byte_offset = self.bit_offset >> 3
+        window = self.data[byte_offset] << 8
+        if byte_offset + 1 < len(self.data):
+            window |= self.data[byte_offset + 1]
+        value = (window >> (16 - (self.bit_offset & 7) - count)) & ((1 << count) - 1)
+        self.bit_offset += count
+        return value
+
+    def read_vle16(self, block_size):
+        mask = (1 << block_size) - 1
+        value = 0
+        shift = 0
+        while True:
+            block = self.read_bits(block_size + 1)
+            value |= (block & mask) << shift
+            if not block >> block_size:
+                return value
+            shift += block_size
+
+    def read_move(self, pos):
+        us = pos.side_to_move
+        ours = pos.colors[us]
+        from_sq = nth_set_square(ours, self.read_bits(used_bits_safe(ours.bit_count())))
+        piece_type = pos.board[from_sq] >> 1
+        if piece_type == PAWN:
+            destinations = pos.pawn_destinations(from_sq)
+            num_destinations = destinations.bit_count()
+            if square_rank(from_sq) == (6 if us == WHITE else 1):
+                move_id = self.read_bits(used_bits_safe(num_destinations * 4))
+                to_sq = nth_set_square(destinations, move_id // 4)
+                return Move(PROMOTION, from_sq, to_sq, KNIGHT + move_id % 4)
+            to_sq = nth_set_square(destinations, self.read_bits(used_bits_safe(num_destinations)))
+            if to_sq == pos.ep_square:
+                return Move(EN_PASSANT, from_sq, to_sq, None)
+            return Move(NORMAL, from_sq, to_sq, None)
+        elif piece_type == KING:
+            attacks = KING_ATTACKS[from_sq] & ~ours
+            num_attacks = attacks.bit_count()
+            our_rights = pos.castling_rights & CASTLING_RIGHTS_OF[us]
+            move_id = self.read_bits(used_bits_safe(num_attacks + our_rights.bit_count()))
+            if move_id < num_attacks:
+                return Move(NORMAL, from_sq, nth_set_square(attacks, move_id), None)
+            long_right = WHITE_OOO if us == WHITE else BLACK_OOO
+            rank_offset = 0 if us == WHITE else 56
+            if move_id == num_attacks and our_rights & long_right:
+                return Move(CASTLE, from_sq, rank_offset, None)
+            return Move(CASTLE, from_sq, rank_offset + 7, None)
+        attacks = piece_attacks(piece_type, from_sq, pos.occupied()) & ~ours
+        to_sq = nth_set_square(attacks, self.read_bits(used_bits_safe(attacks.bit_count())))
+        return Move(NORMAL, from_sq, to_sq, None)
+
+    def __iter__(self):
+        entry = self.entry
+        for _ in range(self.num_plies):
+            pos = entry.pos.do_move(entry.move)
+            move = self.read_move(pos)
+            score = _to_int16(self.last_score + unsigned_to_signed(self.read_vle16(SCORE_VLE_BLOCK_SIZE)))
+            self.last_score = -score
+            entry = TrainingEntry(pos, move, score, entry.ply + 1, -entry.result)
+            yield entry
+
+    def end_offset(self):
+        ''' Byte offset just past the movetext that has been read '''
+        return (self.bit_offset + 7) >> 3
+
+
+def iter_chunks(infile):
+    ''' Yield the payload of every BINP chunk in a binary file object '''
+    while True:
+        chunk_header = infile.read(8)
+        if not chunk_header:
+            return
+        assert chunk_header[0:4] == b'BINP'
+        size = struct.unpack('<I', chunk_header[4:])[0]
+        data = infile.read(size)
+        assert len(data) == size
+        yield data
+
+def iter_chunk_entries(chunk):
+    ''' Yield every training data entry of a chunk payload in file order '''
+    offset = 0
+    while offset + PACKED_ENTRY_SIZE + 2 <= len(chunk):
+        entry = unpack_entry(chunk[offset:offset + PACKED_ENTRY_SIZE])
+        offset += PACKED_ENTRY_SIZE
+        num_plies = (chunk[offset] << 8) | chunk[offset + 1]
+        offset += 2
+        yield entry
+        if num_plies > 0:
+            movetext = MovetextReader(chunk, offset, entry, num_plies)
+            yield from movetext
+            offset = movetext.end_offset()
+
+def iter_entries(input_filename):
+    ''' Stream every training data entry of a .binpack file '''
+    with open(input_filename, 'rb') as infile:
+        for chunk in iter_chunks(infile):
+            yield from iter_chunk_entries(chunk)
+
+
+# one row per position, laid out like the fields of a packed entry
+ENTRY_DTYPE = np.dtype([
+    ('pos', np.uint8, (COMPRESSED_POSITION_SIZE,)),
+    ('move', '<u2'),
+    ('score', '<i2'),
+    ('ply', '<u2'),
+    ('rule50', '<u2'),
+    ('result', 'i1'),
+])
+_ENTRY_STRUCT = struct.Struct('<24sHhHHb')
+
+def iter_entry_batches(input_filename, batch_size=1 << 16):
+    ''' Stream a .binpack file as NumPy arrays of ENTRY_DTYPE with up to batch_size rows '''
+    batch = bytearray()
+    num_rows = 0
+    for entry in iter_entries(input_filename):
+        pos = entry.pos
+        batch += _ENTRY_STRUCT.pack(pos.compress(), compress_move(entry.move), entry.score,
+                                    entry.ply, pos.rule50, entry.result)
+        num_rows += 1
+        if num_rows == batch_size:
+            yield np.frombuffer(batch, dtype=ENTRY_DTYPE)
+            batch = bytearray()
+            num_rows = 0
+    if num_rows:
+        yield np.frombuffer(batch, dtype=ENTRY_DTYPE)
+
+def pack_entry(entry):
+    ''' Encode a training data entry into 32 bytes '''
+    pos = entry.pos
+    ply_result = (entry.ply & 0x3fff) | (signed_to_unsigned(entry.result) << 14)
+    return pos.compress() + struct.pack('>HHHH', compress_move(entry.move), signed_to_unsigned(entry.score),
+                                        ply_result, pos.rule50)
+
+def move_from_uci(pos, uci):
+    from_sq, to_sq = parse_square(uci[0:2]), parse_square(uci[2:4])
+    piece_type = pos.board[from_sq] >> 1
+    if len(uci) == 5:
+        return Move(PROMOTION, from_sq, to_sq, 'pnbrqk'.index(uci[4]))
+    elif piece_type == KING and abs(to_sq - from_sq) == 2:
+        return Move(CASTLE, from_sq, (from_sq & 56) + (7 if to_sq > from_sq else 0), None)
+    elif piece_type == PAWN and (from_sq ^ to_sq) & 7 and pos.board[to_sq] == NO_PIECE:
+        return Move(EN_PASSANT, from_sq, to_sq, None)
+    return Move(NORMAL, from_sq, to_sq, None)
+
+def is_continuation(prev_entry, entry):
+    ''' True if entry is the position reached by playing the move of prev_entry '''
+    if prev_entry.result != -entry.result or prev_entry.ply + 1 != entry.ply:
+        return False
+    next_pos = prev_entry.pos.do_move(prev_entry.move)
+    return next_pos == entry.pos and next_pos.rule50 == entry.pos.rule50
+
+
+class MovetextWriter:
+    ''' Writes the (move, score) chain that follows a stem entry '''
+    def __init__(self, entry):
+        self.data = bytearray()
+        self.bits = 0
+        self.num_bits = 0
+        self.num_plies = 0
+        self.last_score = -entry.score
+
+    def write_bits(self, value, count):
+        self.bits = (self.bits << count) | value
+        self.num_bits += count
+        while self.num_bits >= 8:
+            self.num_bits -= 8
+            self.data.append((self.bits >> self.num_bits) & 0xff)
+        self.bits &= (1 << self.num_bits) - 1
+
+    def write_vle16(self, value, block_size):
+        mask = (1 << block_size) - 1
+        while True:
+            self.write_bits((value & mask) | ((value > mask) << block_size), block_size + 1)
+            value >>= block_size
+            if value == 0:
+                return
+
+    def write_move_score(self, pos, move, score):
+        ''' Append the move played in pos and the score of the position it leads to '''
+        us = pos.side_to_move
+        ours = pos.colors[us]
+        from_sq, to_sq = move.from_sq, move.to_sq
+        piece_type = pos.board[from_sq] >> 1
+        if piece_type == PAWN:
+            destinations = pos.pawn_destinations(from_sq)
+            move_id = (destinations & squares_before(to_sq)).bit_count()
+            num_moves = destinations.bit_count()
+            if square_rank(from_sq) == (6 if us == WHITE else 1):
+                move_id = move_id * 4 + move.promotion - KNIGHT
+                num_moves *= 4
+        elif piece_type == KING:
+            attacks = KING_ATTACKS[from_sq] & ~ours
+            num_attacks = attacks.bit_count()
+            our_rights = pos.castling_rights & CASTLING_RIGHTS_OF[us]
+            if move.type == CASTLE:
+                long_right = WHITE_OOO if us == WHITE else BLACK_OOO
+                move_id = num_attacks
+                if to_sq > from_sq and our_rights & long_right:
+                    move_id += 1
+            else:
+                move_id = (attacks & squares_before(to_sq)).bit_count()
+            num_moves = num_attacks + our_rights.bit_count()
+        else:
+            attacks = piece_attacks(piece_type, from_sq, pos.occupied()) & ~ours
+            move_id = (attacks & squares_before(to_sq)).bit_count()
+            num_moves = attacks.bit_count()
+        self.write_bits((ours & squares_before(from_sq)).bit_count(), used_bits_safe(ours.bit_count()))
+        self.write_bits(move_id, used_bits_safe(num_moves))
+        self.write_vle16(signed_to_unsigned(_to_int16(score - self.last_score)), SCORE_VLE_BLOCK_SIZE)
+        self.last_score = -score
+        self.num_plies += 1
+
+    def getvalue(self):
+        if self.num_bits:
+            return bytes(self.data) + bytes([(self.bits << (8 - self.num_bits)) & 0xff])
+        return bytes(self.data)
+
+
+class BinpackWriter:
+    ''' Encode training data entries into a .binpack file
+
+    With chain=True, an entry that continues the game of the previous entry is appended
+    to its movetext instead of starting a new 32-byte stem, like `stockfish convert` does.
+    '''
+    def __init__(self, output_filename, chain=True, chunk_size=SUGGESTED_CHUNK_SIZE, append=False):
+        self.outfile = open(output_filename, 'ab' if append else 'wb')
+        self.chain = chain
+        self.chunk_size = chunk_size
+        self.chunk = bytearray()
+        self.last_entry = None
+        self.movetext = None
+        self.num_entries = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_entry(self, entry):
+        if self.chain and self.last_entry is not None and self.movetext.num_plies < 0xffff and \
+           is_continuation(self.last_entry, entry):
+            self.movetext.write_move_score(self.last_entry.pos.do_move(self.last_entry.move), entry.move, entry.score)
+        else:
+            self.finish_stem()
+            if len(self.chunk) >= self.chunk_size:
+                self.write_chunk()
+            self.chunk += pack_entry(entry)
+            self.movetext = MovetextWriter(entry)
+        self.last_entry = entry
+        self.num_entries += 1
+
+    def add_position(self, fen, move, score, ply, result):
+        ''' Add a position from the fields of a .plain record '''
+        pos = Position.from_fen(fen)
+        pos.ply = int(ply)
+        self.add_entry(TrainingEntry(pos, move_from_uci(pos, move), _to_int16(int(score)), int(ply), int(result)))
+
+    def finish_stem(self):
+        if self.movetext is not None:
+            self.chunk += self.movetext.num_plies.to_bytes(2, 'big')
+            self.chunk += self.movetext.getvalue()
+            self.movetext = None
+
+    def write_chunk(self):
+        if self.chunk:
+            self.outfile.write(b'BINP' + struct.pack('<I', len(self.chunk)))
+            self.outfile.write(self.chunk)
+            self.chunk = bytearray()
+
+    def flush(self):
+        ''' Write out every entry added so far and sync the file, returning its length
+
+            The file is then a complete .binpack, and the next entry starts a new stem.
+        '''
+        self.finish_stem()
+        self.write_chunk()
+        self.last_entry = None
+        self.outfile.flush()
+        os.fsync(self.outfile.fileno())
+        return self.outfile.tell()
+
+    def close(self):
+        self.finish_stem()
+        self.write_chunk()
+        self.last_entry = None
+        self.outfile.close()
+
+
+def count_positions(input_filename):
+    return sum(1 for _ in iter_entries(input_filename))
+
+def format_plain_entry(entry):
+    return f'fen {entry.pos.fen()}\nmove {move_to_uci(entry.move)}\nscore {entry.score}\n' \
+           f'ply {entry.ply}\nresult {entry.result}\ne\n'
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('count', 'plain'):
+        print('Usage: ./binpack.py count <input_binpack> ...')
+        print('       ./binpack.py plain <input_binpack>')
+        sys.exit(0)
+
+    if sys.argv[1] == 'count':
+        for input_filename in sys.argv[2:]:
+            print(f'{input_filename}')
+            print(f'Number of positions: {count_positions(input_filename)}')
+    else:
+        for entry in iter_entries(sys.argv[2]):
+            sys.stdout.write(format_plain_entry(entry))
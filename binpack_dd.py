@@ -1,3 +1,4 @@
+import argparse
 from glob import glob
 import io
 import os
@@ -5,22 +6,39 @@ import os.path
 from pprint import pprint
 import re
 import sys
-import textwrap
 
 import chess
 import zstandard
 
+from dedup import BloomFilter, PositionHashSet
+from plain_writer import PlainWriter
+from stockfish_convert import StockfishConverter
+
 ''' Iterate over .binpack files and de-duplicate positions
 '''
-if len(sys.argv) < 2:
-    print('Usage: ./binpack_dd.py <binpack_file_glob>')
-    sys.exit(0)
-
-
-piece_orientations_seen = set()
-
-def filter_csv_to_plain(input_filename):
-    ''' Filter a .csv or .csv.zst file '''
+parser = argparse.ArgumentParser(description='De-duplicate positions across files, keeping the latest ones')
+parser.add_argument('binpack_file_glob')
+parser.add_argument('--bloom-capacity', type=int,
+                    help='de-duplicate with an approximate bloom filter sized for this many positions')
+parser.add_argument('--bloom-fpr', type=float, default=0.001,
+                    help='target false positive rate of the bloom filter')
+parser.add_argument('--bloom-file',
+                    help='keep the bloom filter bits in this file, to de-duplicate across runs')
+parser.add_argument('--stream', action='store_true',
+                    help='pipe the filtered positions straight into stockfish convert instead of a .plain file')
+parser.add_argument('--stockfish', default='stockfish',
+                    help='stockfish binary used to convert .plain positions into .binpack')
+args = parser.parse_args()
+
+if args.bloom_capacity:
+    piece_orientations_seen = BloomFilter(args.bloom_capacity, args.bloom_fpr, args.bloom_file)
+else:
+    piece_orientations_seen = PositionHashSet()
+
+def filter_csv_to_plain(input_filename, stream=False):
+    ''' Filter a .csv or .csv.zst file into a .plain file,
+        or with stream set into a .binpack converted from the positions as they're filtered
+    '''
     print(f'Processing {input_filename} ...')
     if input_filename.endswith(".csv.zst"):
         output_filename = input_filename.replace('.csv.zst', '.csv.zst.filter-v6-dd.plain')
@@ -35,22 +53,28 @@ def filter_csv_to_plain(input_filename):
         print(f'Found .csv.zst.filter-v6-dd.binpack file, doing nothing:')
         print(output_filename.replace('.csv.zst.filter-v6-dd.plain', '.csv.zst.filter-v6-dd.binpack'))
         return
+    if stream:
+        output_filename = output_filename.replace('-v6-dd.plain', '-v6-dd.binpack')
     # filter the file
     if input_filename.endswith(".csv.zst"):
         with open(input_filename, 'rb') as compressed_infile, \
-             open(output_filename, 'w+') as outfile:
+             open_output(output_filename, stream) as outfile:
             dctx = zstandard.ZstdDecompressor()
             stream_reader = dctx.stream_reader(compressed_infile)
             text_stream = io.TextIOWrapper(stream_reader, encoding='utf-8')
             PositionCsvIterator(text_stream, outfile).process_csv_rows()
     else:
-        output_filename = input_filename.replace('.csv', '.csv.filter-v6-dd.plain')
         with open(input_filename, 'r') as infile, \
-             open(output_filename, 'w+') as outfile:
+             open_output(output_filename, stream) as outfile:
             PositionCsvIterator(infile, outfile).process_csv_rows()
     print(f'Saved to {output_filename}')
     return output_filename
 
+def open_output(output_filename, stream):
+    if stream:
+        return StockfishConverter(output_filename, args.stockfish)
+    return PlainWriter(output_filename)
+
 
 class PositionCsvIterator:
     def __init__(self, infile, outfile):
@@ -62,6 +86,7 @@ class PositionCsvIterator:
         self.num_non_standard_games = 0
 
         self.num_positions = 0
+        self.num_only_one_move = 0
         self.num_start_positions = 0
         self.num_seen_before = 0
         self.num_positions_filtered_out = 0
@@ -111,13 +136,7 @@ class PositionCsvIterator:
             if should_filter_out:
                 self.num_positions_filtered_out += 1
             else:
-                positions.append({
-                    'fen': fen,
-                    'move': bestmove_uci,
-                    'score': bestmove_score,
-                    'ply': ply,
-                    'result': game_result,
-                })
+                positions.append((fen, bestmove_uci, bestmove_score, ply, game_result))
             prev_ply = ply
             if self.write_positions_and_print_stats(positions, self.num_positions % 100000 == 0):
                 positions = []
@@ -134,16 +153,7 @@ class PositionCsvIterator:
         return False
 
     def write_positions_to_file(self, positions):
-        game_plain = ''
-        for position in positions:
-            game_plain += textwrap.dedent(f'''
-                fen {position['fen']}
-                score {position['score']}
-                move {str(position['move'])}
-                ply {position['ply']}
-                result {position['result']}
-                e''')
-        self.outfile.write(game_plain.strip() + "\n")
+        self.outfile.write_positions(positions)
 
     def print_stats(self):
         num_positions_after_filter = self.num_positions - self.num_positions_filtered_out
@@ -154,15 +164,18 @@ class PositionCsvIterator:
         print(f'  # positions:                   {self.num_positions:8d}')
         print(f'    # startpos:                  {self.num_start_positions:8d}')
         print(f'    # seen before:               {self.num_seen_before:8d}')
+        print(f'    # seen set:                  {piece_orientations_seen.stats()}')
         print(f'  # positions after filtering:   {num_positions_after_filter:8d}')
         print(f'    % positions kept:            {num_positions_after_filter/self.num_positions*100:8.1f}')
 
 
 # prioritize position scores from later in time (ie. seen end of month vs. beginning of month)
-for file in sorted(glob(sys.argv[1]))[::-1]:
-    filtered_plain_filename = filter_csv_to_plain(file)
-    if filtered_plain_filename:
+for file in sorted(glob(args.binpack_file_glob))[::-1]:
+    filtered_plain_filename = filter_csv_to_plain(file, args.stream)
+    if filtered_plain_filename and not args.stream:
         # convert the filtered .plain file into a .binpack
         filtered_binpack_filename = filtered_plain_filename.replace('-v6-dd.plain', '-v6-dd.binpack')
-        print(os.system(f"stockfish convert {filtered_plain_filename} {filtered_binpack_filename}"))
+        print(os.system(f"{args.stockfish} convert {filtered_plain_filename} {filtered_binpack_filename}"))
         os.system(f"rm {filtered_plain_filename}")
+if args.bloom_capacity:
+    piece_orientations_seen.close()
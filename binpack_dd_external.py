@@ -0,0 +1,189 @@
+import argparse
+from glob import glob
+import multiprocessing
+import os
+import os.path
+import tempfile
+
+import numpy as np
+
+from binpack import BinpackWriter
+from csv_reader import iter_csv_rows
+from dedup import placement_hashes
+
+''' De-duplicate positions across many .csv files with bounded memory
+
+Same rule as binpack_dd.py: files later in sorted order win, then earlier rows within a file.
+Instead of keeping every seen position in memory, it runs in three passes:
+
+  1. each file's (key, file rank, row) records are hash-partitioned into on-disk buckets
+  2. each bucket is de-duplicated on its own, keeping the record with the lowest (rank, row)
+  3. the kept rows of each file are gathered into a keep-list bitmap that the writers stream against
+
+Memory is bounded by the size of one bucket rather than the whole dataset.
+'''
+
+RECORD_DTYPE = np.dtype([('key', '<u8'), ('rank', '<u4'), ('row', '<u8')])
+
+def output_filename_for(input_filename):
+    if input_filename.endswith(".csv.zst"):
+        return input_filename.replace('.csv.zst', '.csv.zst.filter-v6-dd.binpack')
+    return input_filename.replace('.csv', '.csv.filter-v6-dd.binpack')
+
+def bucket_filename(work_dir, bucket, rank):
+    return os.path.join(work_dir, f'bucket-{bucket:05d}-file-{rank:05d}.bin')
+
+def keep_rows_filename(work_dir, bucket, rank):
+    return os.path.join(work_dir, f'keep-{bucket:05d}-file-{rank:05d}.bin')
+
+def keep_list_filename(work_dir, rank):
+    return os.path.join(work_dir, f'keep-file-{rank:05d}.bits')
+
+
+def partition_file(input_filename, rank, work_dir, num_buckets, batch_size=1000000):
+    ''' Pass 1: append a record for every position of a file to the bucket of its key
+
+        Returns the number of rows in the file
+    '''
+    def flush(piece_orientations, rows):
+        if not rows:
+            return
+        records = np.empty(len(rows), dtype=RECORD_DTYPE)
+        records['key'] = placement_hashes(piece_orientations)
+        records['rank'] = rank
+        records['row'] = rows
+        # the high bits pick the bucket so the low bits stay spread out within one
+        buckets = (records['key'] >> np.uint64(40)) % np.uint64(num_buckets)
+        order = np.argsort(buckets, kind='stable')
+        records, buckets = records[order], buckets[order]
+        bounds = np.searchsorted(buckets, np.arange(num_buckets + 1, dtype=np.uint64))
+        for bucket in range(num_buckets):
+            if bounds[bucket] < bounds[bucket + 1]:
+                with open(bucket_filename(work_dir, bucket, rank), 'ab') as f:
+                    records[bounds[bucket]:bounds[bucket + 1]].tofile(f)
+
+    num_rows = 0
+    piece_orientations = []
+    rows = []
+    for row in iter_csv_rows(input_filename):
+        split_row = row.strip().split(",")
+        if len(split_row) == 10:
+            piece_orientations.append(split_row[1].split(' ')[0])
+            rows.append(num_rows)
+        num_rows += 1
+        if len(rows) == batch_size:
+            flush(piece_orientations, rows)
+            piece_orientations = []
+            rows = []
+    flush(piece_orientations, rows)
+    print(f'Partitioned {input_filename}: {num_rows} rows')
+    return num_rows
+
+def dedup_bucket(bucket, work_dir, num_files):
+    ''' Pass 2: keep the highest priority record of every key in a bucket '''
+    parts = [bucket_filename(work_dir, bucket, rank) for rank in range(num_files)]
+    parts = [part for part in parts if os.path.isfile(part)]
+    if not parts:
+        return 0, 0
+    records = np.concatenate([np.fromfile(part, dtype=RECORD_DTYPE) for part in parts])
+    for part in parts:
+        os.remove(part)
+    records = records[np.lexsort((records['row'], records['rank'], records['key']))]
+    is_first = np.ones(len(records), dtype=bool)
+    is_first[1:] = records['key'][1:] != records['key'][:-1]
+    kept = records[is_first]
+    for rank in np.unique(kept['rank']):
+        kept['row'][kept['rank'] == rank].tofile(keep_rows_filename(work_dir, bucket, int(rank)))
+    return len(records), len(kept)
+
+def build_keep_list(rank, num_rows, work_dir, num_buckets):
+    ''' Gather the kept rows of a file from every bucket into one bitmap '''
+    keep_list = np.zeros((num_rows + 7) // 8, dtype=np.uint8)
+    for bucket in range(num_buckets):
+        filename = keep_rows_filename(work_dir, bucket, rank)
+        if os.path.isfile(filename):
+            rows = np.fromfile(filename, dtype=np.uint64)
+            np.bitwise_or.at(keep_list, rows >> np.uint64(3),
+                             np.left_shift(1, (rows & np.uint64(7)).astype(np.uint8)).astype(np.uint8))
+            os.remove(filename)
+    keep_list.tofile(keep_list_filename(work_dir, rank))
+
+def write_file(input_filename, rank, work_dir):
+    ''' Pass 3: stream a file again, writing only the rows on its keep-list '''
+    keep_list = np.fromfile(keep_list_filename(work_dir, rank), dtype=np.uint8)
+    output_filename = output_filename_for(input_filename)
+    num_positions = 0
+    num_start_positions = 0
+    num_seen_before = 0
+    num_positions_filtered_out = 0
+    prev_ply = -1
+    # written to a temp file, so a run killed while writing leaves no partial output
+    tmp_filename = output_filename + '.tmp'
+    with BinpackWriter(tmp_filename) as outfile:
+        for row_index, row in enumerate(iter_csv_rows(input_filename)):
+            split_row = row.strip().split(",")
+            num_positions += 1
+            if len(split_row) != 10:
+                # only one possible move in the position
+                num_positions_filtered_out += 1
+                continue
+            ply, fen, bestmove_uci, bestmove_score, game_result = split_row[:5]
+            ply = int(ply)
+            if ply < prev_ply:
+                num_start_positions += 1
+                num_positions_filtered_out += 1
+            elif not keep_list[row_index >> 3] >> (row_index & 7) & 1:
+                num_seen_before += 1
+                num_positions_filtered_out += 1
+            else:
+                outfile.add_position(fen, bestmove_uci, bestmove_score, ply, game_result)
+            prev_ply = ply
+    os.replace(tmp_filename, output_filename)
+    os.remove(keep_list_filename(work_dir, rank))
+    print(f'Saved to {output_filename}: {num_positions} positions, {num_start_positions} startpos, '
+          f'{num_seen_before} seen before, {num_positions - num_positions_filtered_out} kept')
+    return output_filename
+
+
+def dedup_files(input_filenames, work_dir, num_buckets=256, workers=None):
+    # prioritize position scores from later in time (ie. seen end of month vs. beginning of month)
+    input_filenames = sorted(input_filenames)[::-1]
+    output_filenames = [output_filename_for(input_filename) for input_filename in input_filenames]
+    missing = [f for f in output_filenames if not os.path.isfile(f)]
+    if not missing:
+        print(f'Found all {len(output_filenames)} outputs, doing nothing')
+        return
+    if len(missing) < len(output_filenames):
+        # every output depends on every input, so they can only be made together
+        raise RuntimeError(f'Only some outputs exist, from an earlier run that didn\'t finish. '
+                           f'Remove the others to run again. Missing: {" ".join(missing)}')
+    with tempfile.TemporaryDirectory(dir=work_dir, prefix='binpack-dd-') as tmp_dir, \
+         multiprocessing.Pool(workers) as pool:
+        num_rows = pool.starmap(partition_file, [
+            (input_filename, rank, tmp_dir, num_buckets) for rank, input_filename in enumerate(input_filenames)
+        ])
+        bucket_counts = pool.starmap(dedup_bucket, [
+            (bucket, tmp_dir, len(input_filenames)) for bucket in range(num_buckets)
+        ])
+        num_records = sum(n for n, _ in bucket_counts)
+        num_kept = sum(n for _, n in bucket_counts)
+        print(f'De-duplicated {num_records} positions into {num_kept} unique positions')
+        pool.starmap(build_keep_list, [
+            (rank, num_rows[rank], tmp_dir, num_buckets) for rank in range(len(input_filenames))
+        ])
+        return pool.starmap(write_file, [
+            (input_filename, rank, tmp_dir) for rank, input_filename in enumerate(input_filenames)
+        ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='De-duplicate positions across .csv files larger than memory')
+    parser.add_argument('csv_file_glob')
+    parser.add_argument('--work-dir', default=None,
+                        help='directory for the temporary bucket files, needs ~20 bytes per position')
+    parser.add_argument('--buckets', type=int, default=256,
+                        help='number of on-disk buckets, more buckets use less memory each')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes, defaults to the number of cores')
+    args = parser.parse_args()
+    dedup_files(glob(args.csv_file_glob), args.work_dir, num_buckets=args.buckets, workers=args.workers)
@@ -0,0 +1,185 @@
+import argparse
+import os
+import os.path
+import subprocess
+import tempfile
+import textwrap
+import time
+
+from binpack import BinpackWriter, CASTLE, EN_PASSANT, NO_PIECE, iter_entries
+from dedup import PositionHashSet
+from manifest import Manifest
+
+''' Drop positions from a .binpack before rescoring it, with the csv_filter_v8.py rules that need no scores
+
+binpack_to_csv.sh searches every position at depth 6 with multipv 2, then csv_filter_v8.py
+throws most of them away. The rules that don't look at the search results are applied here,
+to the decoded .binpack entries, so those positions are never searched:
+
+  - early plies <= 36
+  - positions in check
+  - bestmove captures, including en passant
+  - duplicate piece placements, keeping the first one of the file like v8
+
+The first position of every game is kept, even though v8 drops it, since v8 finds the start
+of a game by the ply going down. That's one search per game. Bestmove promotions are left
+to v8, which keeps some of them when the two best moves favor different sides.
+
+v8 keeps the odd duplicate too, when the two best moves favor different sides, so with
+de-duplication the output loses a few positions v8 would keep, about 1 in 7000. Without it,
+duplicates of dropped positions aren't seen before any more and v8 keeps a few extra.
+
+Only v8's rules are applied, so the rescored .csv of a .prefilter.binpack suits
+csv_filter_v8.py and nothing else. Older filters skip fewer early plies and keep captures.
+It's opt-in: `orchestrate.py --prefilter` rescores it into X.binpack.prefilter.binpack.csv.zst,
+and X.binpack.csv.zst keeps every position.
+
+  ./binpack_prefilter.py X.binpack                      -> X.binpack.prefilter.binpack
+  ./binpack_prefilter.py X.binpack --calibrate 2000     times binpack_to_csv.sh on 2000 kept positions
+'''
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PREFILTER_SUFFIX = '.prefilter.binpack'
+PREFILTER_TOOLS = [os.path.join(SCRIPT_DIR, filename) for filename in [
+    'binpack_prefilter.py', 'binpack.py', 'dedup.py',
+]]
+EARLY_PLY_SKIP = 36
+# rough depth 6 multipv 2 search time of one position on one thread
+DEFAULT_MS_PER_POSITION = 3.0
+
+def prefiltered_filename(input_filename):
+    return input_filename + PREFILTER_SUFFIX
+
+def placement_key(pos):
+    ''' 64-bit key of a position's piece placement, never 0, for a PositionHashSet '''
+    return (hash(tuple(pos.pieces)) & 0xffffffffffffffff) or 1
+
+def board_failure(entry):
+    ''' Name of the counter of the first rule needing only the board that drops the entry, if any '''
+    pos, move = entry.pos, entry.move
+    if pos.is_check():
+        return 'num_in_check'
+    if move.type == EN_PASSANT or move.type != CASTLE and pos.board[move.to_sq] != NO_PIECE:
+        return 'num_bestmove_captures'
+
+
+class BinpackPrefilter:
+    def __init__(self, outfile, dedup=True):
+        self.outfile = outfile
+        self.dedup = dedup
+        self.prev_ply = -1
+        self.piece_orientations_seen = PositionHashSet()
+
+        self.num_positions = 0
+        self.num_games = 0
+        self.num_early_plies = 0
+        self.num_seen_before = 0
+        self.num_in_check = 0
+        self.num_bestmove_captures = 0
+        self.num_kept = 0
+
+    def process_entry(self, entry):
+        self.num_positions += 1
+        seen_position_before = self.piece_orientations_seen.test_and_add_hash(placement_key(entry.pos))
+        is_start_of_game = self.prev_ply == -1 or entry.ply < self.prev_ply
+        self.prev_ply = entry.ply
+        if is_start_of_game:
+            # kept so the filter after rescoring still sees where each game starts
+            self.num_games += 1
+        elif entry.ply <= EARLY_PLY_SKIP:
+            self.num_early_plies += 1
+            return
+        elif self.dedup and seen_position_before:
+            self.num_seen_before += 1
+            return
+        else:
+            failure = board_failure(entry)
+            if failure:
+                setattr(self, failure, getattr(self, failure) + 1)
+                return
+        self.outfile.add_entry(entry)
+        self.num_kept += 1
+
+    @property
+    def num_dropped(self):
+        return self.num_positions - self.num_kept
+
+    def print_stats(self, ms_per_position):
+        saved_hours = self.num_dropped * ms_per_position / 1000 / 3600
+        total_hours = self.num_positions * ms_per_position / 1000 / 3600
+        print(textwrap.dedent(f'''
+            Processed {self.num_positions} positions
+              # games (first position kept): {self.num_games:8d}
+              # early plies <= {EARLY_PLY_SKIP}:           {self.num_early_plies:8d}
+              # seen before:                 {self.num_seen_before:8d}
+              # in check:                    {self.num_in_check:8d}
+              # bestmove captures:           {self.num_bestmove_captures:8d}
+              # positions to rescore:        {self.num_kept:8d}
+                % positions dropped:         {self.num_dropped/max(self.num_positions, 1)*100:8.1f}
+            Rescore search time saved: {saved_hours:.2f} of {total_hours:.2f} CPU hours at {ms_per_position:.2f} ms per position
+        '''))
+
+
+def prefilter_binpack(input_filename, dedup=True):
+    ''' Write the positions of a .binpack that may pass csv_filter_v8.py to a .prefilter.binpack
+
+        Returns the BinpackPrefilter with the counts, or None if the manifest shows the output is up to date.
+    '''
+    output_filename = prefiltered_filename(input_filename)
+    params = {'early_ply_skip': EARLY_PLY_SKIP, 'dedup': dedup}
+    manifest = Manifest.for_file(output_filename)
+    if manifest.is_current(output_filename, [input_filename], PREFILTER_TOOLS, params):
+        print(f'Up to date, doing nothing:')
+        print(output_filename)
+        return
+    print(f'Prefiltering {input_filename} ...')
+    tmp_filename = output_filename + '.tmp'
+    with BinpackWriter(tmp_filename) as outfile:
+        prefilter = BinpackPrefilter(outfile, dedup)
+        for entry in iter_entries(input_filename):
+            prefilter.process_entry(entry)
+    os.replace(tmp_filename, output_filename)
+    manifest.record(output_filename, [input_filename], PREFILTER_TOOLS, params)
+    print(f'Saved to {output_filename}')
+    return prefilter
+
+def calibrate_ms_per_position(binpack_filename, num_positions):
+    ''' Milliseconds per position of binpack_to_csv.sh on the first num_positions of a .binpack,
+        including starting the engine
+    '''
+    with tempfile.TemporaryDirectory(prefix='prefilter-calibrate-') as tmp_dir:
+        sample_filename = os.path.join(tmp_dir, 'sample.binpack')
+        num_sampled = 0
+        with BinpackWriter(sample_filename) as outfile:
+            for entry in iter_entries(binpack_filename):
+                if num_sampled == num_positions:
+                    break
+                outfile.add_entry(entry)
+                num_sampled += 1
+        start_time = time.perf_counter()
+        subprocess.run([os.path.join(SCRIPT_DIR, 'binpack_to_csv.sh'), sample_filename],
+                       stdout=subprocess.DEVNULL, check=True)
+        seconds = time.perf_counter() - start_time
+    print(f'Rescored {num_sampled} positions in {seconds:.2f}s')
+    return seconds * 1000 / max(num_sampled, 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drop positions from .binpack files that csv_filter_v8.py '
+                                                 'would drop whatever their rescored scores')
+    parser.add_argument('input_binpacks', nargs='+')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help="keep duplicate piece placements for csv_filter_v8.py to decide on")
+    parser.add_argument('--ms-per-position', type=float, default=DEFAULT_MS_PER_POSITION,
+                        help='rescore search time of a position, to report the time saved')
+    parser.add_argument('--calibrate', type=int, default=0, metavar='N',
+                        help='measure the search time of a position by rescoring N kept positions')
+    args = parser.parse_args()
+    # calibrated on the first file
+    ms_per_position = None if args.calibrate > 0 else args.ms_per_position
+    for input_filename in args.input_binpacks:
+        prefilter = prefilter_binpack(input_filename, dedup=not args.no_dedup)
+        if ms_per_position is None:
+            ms_per_position = calibrate_ms_per_position(prefiltered_filename(input_filename), args.calibrate)
+        if prefilter:
+            prefilter.print_stats(ms_per_position)
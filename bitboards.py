@@ -0,0 +1,144 @@
+''' Minimal bitboard helpers shared by the binpack codec and the fast board checks
+
+Squares are numbered a1=0, b1=1, ... h8=63, the same as Stockfish and python-chess.
+'''
+
+WHITE = 0
+BLACK = 1
+
+# piece types, ordered like Stockfish's binpack library
+PAWN = 0
+KNIGHT = 1
+BISHOP = 2
+ROOK = 3
+QUEEN = 4
+KING = 5
+
+# pieces are encoded as piece_type * 2 + color, ie. 0 = white pawn, 11 = black king
+NO_PIECE = -1
+PIECE_SYMBOLS = 'PpNnBbRrQqKk'
+
+ALL_SQUARES = (1 << 64) - 1
+
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+RANK_1 = 0xff
+RANK_8 = RANK_1 << 56
+
+
+def square(file, rank):
+    return rank * 8 + file
+
+def square_file(sq):
+    return sq & 7
+
+def square_rank(sq):
+    return sq >> 3
+
+def square_name(sq):
+    return 'abcdefgh'[sq & 7] + str((sq >> 3) + 1)
+
+def parse_square(name):
+    return (ord(name[1]) - ord('1')) * 8 + (ord(name[0]) - ord('a'))
+
+def lsb(bb):
+    return (bb & -bb).bit_length() - 1
+
+def msb(bb):
+    return bb.bit_length() - 1
+
+def popcount(bb):
+    return bb.bit_count()
+
+def iter_squares(bb):
+    ''' Yield the set squares of a bitboard from a1 to h8 '''
+    while bb:
+        low_bit = bb & -bb
+        yield low_bit.bit_length() - 1
+        bb ^= low_bit
+
+def nth_set_square(bb, n):
+    ''' Square of the n-th (0-indexed) set bit, counting up from a1 '''
+    for _ in range(n):
+        bb &= bb - 1
+    return lsb(bb)
+
+def squares_before(sq):
+    ''' Bitboard of every square with a lower index than sq '''
+    return (1 << sq) - 1
+
+
+def _step_attacks(deltas):
+    attacks = []
+    for sq in range(64):
+        bb = 0
+        for df, dr in deltas:
+            f, r = square_file(sq) + df, square_rank(sq) + dr
+            if 0 <= f < 8 and 0 <= r < 8:
+                bb |= 1 << square(f, r)
+        attacks.append(bb)
+    return attacks
+
+def _rays(df, dr):
+    rays = []
+    for sq in range(64):
+        bb = 0
+        f, r = square_file(sq) + df, square_rank(sq) + dr
+        while 0 <= f < 8 and 0 <= r < 8:
+            bb |= 1 << square(f, r)
+            f, r = f + df, r + dr
+        rays.append(bb)
+    return rays
+
+
+KNIGHT_ATTACKS = _step_attacks([(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)])
+KING_ATTACKS = _step_attacks([(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)])
+PAWN_ATTACKS = [
+    _step_attacks([(-1, 1), (1, 1)]),    # squares attacked by a white pawn
+    _step_attacks([(-1, -1), (1, -1)]),  # squares attacked by a black pawn
+]
+
+# rays pointing towards higher square indexes stop at their lowest set blocker,
+# rays pointing towards lower square indexes stop at their highest set blocker
+_POSITIVE_ROOK_RAYS = [_rays(0, 1), _rays(1, 0)]
+_NEGATIVE_ROOK_RAYS = [_rays(0, -1), _rays(-1, 0)]
+_POSITIVE_BISHOP_RAYS = [_rays(1, 1), _rays(-1, 1)]
+_NEGATIVE_BISHOP_RAYS = [_rays(1, -1), _rays(-1, -1)]
+
+
+def _slider_attacks(sq, occupied, positive_rays, negative_rays):
+    attacks = 0
+    for rays in positive_rays:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[lsb(blockers)]
+        attacks |= ray
+    for rays in negative_rays:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[msb(blockers)]
+        attacks |= ray
+    return attacks
+
+def rook_attacks(sq, occupied):
+    return _slider_attacks(sq, occupied, _POSITIVE_ROOK_RAYS, _NEGATIVE_ROOK_RAYS)
+
+def bishop_attacks(sq, occupied):
+    return _slider_attacks(sq, occupied, _POSITIVE_BISHOP_RAYS, _NEGATIVE_BISHOP_RAYS)
+
+def queen_attacks(sq, occupied):
+    return rook_attacks(sq, occupied) | bishop_attacks(sq, occupied)
+
+def piece_attacks(piece_type, sq, occupied):
+    ''' Attacks of a non-pawn piece type '''
+    if piece_type == KNIGHT:
+        return KNIGHT_ATTACKS[sq]
+    elif piece_type == BISHOP:
+        return bishop_attacks(sq, occupied)
+    elif piece_type == ROOK:
+        return rook_attacks(sq, occupied)
+    elif piece_type == QUEEN:
+        return queen_attacks(sq, occupied)
+    return KING_ATTACKS[sq]
@@ -0,0 +1,132 @@
+import json
+import os
+import os.path
+
+import numpy as np
+
+''' Checkpoints of a long filter run, so a run that's killed resumes where it left off
+
+A run writes its output to <output>.tmp and renames it once it's finished, so an output file
+is never a partial one. Every checkpoint_rows input rows, the output is flushed to a clean
+boundary and synced, then <output>.checkpoint records the number of input rows done, the
+filter counters, the de-duplication state and the length of the output at that point.
+Checkpoints are written to a temp file and renamed over the previous one.
+
+Batches of rows are cut at checkpoint rows, so checkpoints are exactly checkpoint_rows
+apart, except with worker processes where a checkpoint waits for the end of its shard.
+The pipeline's filter stage runs ahead of its write stage, so it takes a copy of the state
+at a checkpoint row, and the write stage saves it once the output up to that row is written.
+
+A rerun with the same input and options truncates <output>.tmp to the checkpointed length,
+restores the state and continues from the next input row.
+'''
+
+CHECKPOINT_VERSION = 1
+
+class FilterCheckpoint:
+    def __init__(self, output_filename, input_filename, options, checkpoint_rows=5_000_000):
+        self.output_filename = output_filename
+        self.temp_filename = output_filename + '.tmp'
+        self.filename = output_filename + '.checkpoint'
+        self.input_filename = input_filename
+        self.options = options
+        self.checkpoint_rows = checkpoint_rows
+        self.next_checkpoint_row = checkpoint_rows
+        self.meta = None
+        self.seen_state = None
+
+    def input_identity(self):
+        stat = os.stat(self.input_filename)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def load(self):
+        ''' True if there's a checkpoint of this input and options to resume from '''
+        if not os.path.isfile(self.filename) or not os.path.isfile(self.temp_filename):
+            return False
+        with np.load(self.filename) as checkpoint:
+            state = {name: checkpoint[name] for name in checkpoint.files}
+        meta = json.loads(state.pop('meta').tobytes())
+        if meta['version'] != CHECKPOINT_VERSION or meta['input'] != self.input_identity() or \
+           meta['options'] != self.options:
+            print(f'Ignoring {self.filename} from a different input file or options')
+            return False
+        if os.path.getsize(self.temp_filename) < meta['output_length']:
+            print(f'Ignoring {self.filename}, {self.temp_filename} is shorter than when checkpointed')
+            return False
+        self.meta = meta
+        self.seen_state = state
+        self.next_checkpoint_row = meta['num_rows'] + self.checkpoint_rows
+        return True
+
+    @property
+    def start_row(self):
+        ''' The input row to continue from '''
+        return self.meta['num_rows'] if self.meta else 0
+
+    def truncate_output(self):
+        ''' Drop what was written to the temp output after the checkpoint '''
+        os.truncate(self.temp_filename, self.meta['output_length'])
+
+    def restore(self, position_csv_iterator):
+        for name, value in self.meta['counters'].items():
+            setattr(position_csv_iterator, name, value)
+        position_csv_iterator.piece_orientations_seen.restore_state(self.seen_state)
+        self.seen_state = None
+        print(f'Resuming {self.input_filename} from the checkpoint at row {self.start_row}')
+
+    def is_due(self, num_rows):
+        return num_rows >= self.next_checkpoint_row
+
+    def iter_batch_sizes(self, batch_size):
+        ''' Sizes of batches of rows from the start row on, up to batch_size and cut at every checkpoint row '''
+        num_rows, next_checkpoint_row = self.start_row, self.next_checkpoint_row
+        while True:
+            num_batch_rows = min(batch_size, next_checkpoint_row - num_rows)
+            yield num_batch_rows
+            num_rows += num_batch_rows
+            if num_rows == next_checkpoint_row:
+                next_checkpoint_row += self.checkpoint_rows
+
+    def maybe_save(self, position_csv_iterator):
+        if self.is_due(position_csv_iterator.num_positions):
+            self.save(position_csv_iterator)
+
+    def snapshot(self, position_csv_iterator, copy=False):
+        ''' The counters and de-duplication state to checkpoint, copied if filtering runs on
+            before the output up to this point is written
+        '''
+        counters = {name: int(value) for name, value in vars(position_csv_iterator).items()
+                    if name.startswith('num_') or name == 'prev_ply'}
+        seen_state = position_csv_iterator.piece_orientations_seen.checkpoint_state()
+        if copy:
+            seen_state = {name: np.array(value) for name, value in seen_state.items()}
+        self.next_checkpoint_row = counters['num_positions'] + self.checkpoint_rows
+        return counters, seen_state
+
+    def save(self, position_csv_iterator):
+        ''' Checkpoint after every input row so far has been filtered and its positions written '''
+        counters, seen_state = self.snapshot(position_csv_iterator)
+        self.write(counters, seen_state, position_csv_iterator.outfile.flush())
+
+    def write(self, counters, seen_state, output_length):
+        ''' Checkpoint a snapshot, once the output has been written and synced up to output_length '''
+        meta = {
+            'version': CHECKPOINT_VERSION,
+            'input': self.input_identity(),
+            'options': self.options,
+            'num_rows': counters['num_positions'],
+            'counters': counters,
+            'output_length': output_length,
+        }
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            np.savez(f, meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8), **seen_state)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, self.filename)
+
+    def finish(self):
+        ''' Rename the finished temp output to the output and drop the checkpoint '''
+        os.replace(self.temp_filename, self.output_filename)
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
@@ -0,0 +1,402 @@
+import json
+import multiprocessing
+import os
+import os.path
+import struct
+import sys
+
+import numpy as np
+
+from binpack import COMPRESSED_POSITION_SIZE, Position
+from bitboards import PIECE_SYMBOLS, parse_square, square_name
+from csv_reader import iter_csv_row_batches
+from dedup import placement_hashes
+
+''' Convert positions .csv files once into a columnar file that NumPy can memory-map
+
+Every .csv row becomes one row of fixed-width columns: ply, the 3 moves and their scores,
+game result, search method, and the board as the 24-byte compressed position of
+binpack entries with its en passant field, rule50 and move number kept on the side.
+Rows are grouped into blocks of a fixed number of rows, where each column of the block is
+contiguous, so a block is one slice of the file and its columns are zero-copy array views.
+
+File layout: a 4096 byte header (struct fields, then json metadata), then the blocks,
+the last one padded with zeros to a full block.
+The min and max of a few columns in each block are saved next to it in a .zones file,
+so queries can skip blocks without reading them.
+
+query.py runs queries on .cols files, and dupe_count_csv.py and stats_from_csv.py read a .cols
+file, or the one next to a .csv, instead of parsing every row. The csv_filter_v*.py scripts keep
+reading the .csv, which they write back out row by row, and take the boards they need to check
+from a .features sidecar (features.py) instead.
+'''
+
+COLUMNAR_FILE_MAGIC = b'NNUECOLS'
+COLUMNAR_FILE_VERSION = 1
+_COLUMNAR_FILE_HEADER = struct.Struct('<8sIIQQI')
+COLUMNAR_FILE_HEADER_SIZE = 4096
+DEFAULT_BLOCK_ROWS = 1 << 16
+
+# widest first, so every column of a block stays aligned for block_rows that are multiples of 8
+ROW_DTYPE = np.dtype([
+    ('placement_hash', '<u8'),
+    ('board', 'u1', (COMPRESSED_POSITION_SIZE,)),
+    ('ply', '<u2'),
+    ('rule50', '<u2'),
+    ('fullmove', '<u2'),
+    ('bestmove', '<u2'),
+    ('sf_bestmove1', '<u2'),
+    ('sf_bestmove2', '<u2'),
+    ('bestmove_score', '<i2'),
+    ('sf_bestmove1_score', '<i2'),
+    ('sf_bestmove2_score', '<i2'),
+    ('game_result', 'i1'),
+    ('search_method', 'u1'),
+    # 1 for rows with only one possible move, which have no sf_bestmove2
+    ('num_sf_moves', 'u1'),
+    ('ep_square', 'u1'),
+])
+
+NO_MOVE = 0
+NO_EP_SQUARE = 255
+_PROMOTION_PIECES = ' nbrq'
+
+# columns with a per-block min and max, num_pieces being derived from the board
+ZONE_COLUMNS = ['ply', 'bestmove_score', 'sf_bestmove1_score', 'sf_bestmove2_score', 'num_pieces']
+ZONE_MAP_DTYPE = np.dtype([(f'{name}_{bound}', '<i4') for name in ZONE_COLUMNS for bound in ('min', 'max')])
+# columns that only have a value in rows with num_sf_moves == 2, and are 0 in the others
+SECOND_MOVE_COLUMNS = ['sf_bestmove2', 'sf_bestmove2_score']
+
+def columnar_filename(input_filename):
+    return input_filename + '.cols'
+
+def zones_filename(filename):
+    return filename + '.zones'
+
+
+def pack_uci(uci_move):
+    ''' A uci move as a uint16: from square, to square << 6, promotion piece << 12 '''
+    packed = parse_square(uci_move[0:2]) | parse_square(uci_move[2:4]) << 6
+    if len(uci_move) == 5:
+        packed |= _PROMOTION_PIECES.index(uci_move[4]) << 12
+    return packed
+
+def unpack_uci(packed):
+    if packed == NO_MOVE:
+        return None
+    uci_move = square_name(packed & 63) + square_name(packed >> 6 & 63)
+    return uci_move + _PROMOTION_PIECES[packed >> 12].strip()
+
+# compressed position nibbles of pieces that carry extra state, see binpack.py
+_EP_PAWN_NIBBLE = 12
+_WHITE_CASTLING_ROOK_NIBBLE = 13
+_BLACK_CASTLING_ROOK_NIBBLE = 14
+_BLACK_KING_TO_MOVE_NIBBLE = 15
+_CASTLING_ROOK_NIBBLES = {'K': (7, 'R', _WHITE_CASTLING_ROOK_NIBBLE), 'Q': (0, 'R', _WHITE_CASTLING_ROOK_NIBBLE),
+                          'k': (63, 'r', _BLACK_CASTLING_ROOK_NIBBLE), 'q': (56, 'r', _BLACK_CASTLING_ROOK_NIBBLE)}
+_PAWN_NIBBLES = [PIECE_SYMBOLS.index('P'), PIECE_SYMBOLS.index('p'), _EP_PAWN_NIBBLE]
+EMPTY_NIBBLE = 255
+_NIBBLE_OF_SYMBOL = {c: PIECE_SYMBOLS.index(c) for c in PIECE_SYMBOLS}
+
+def compress_fen(fen):
+    ''' Same as Position.from_fen(fen).compress(), without building a Position '''
+    placement, side_to_move, castling, ep_square = fen.split(' ')[:4]
+    if ep_square != '-':
+        # whether the en passant pawn is marked depends on the capture being legal
+        return Position.from_fen(fen).compress()
+    # walk the squares from a1 up, the order of the compressed nibbles
+    squares = []
+    nibbles = []
+    for rank, row in enumerate(reversed(placement.split('/'))):
+        sq = rank * 8
+        for c in row:
+            if c in _NIBBLE_OF_SYMBOL:
+                squares.append(sq)
+                nibbles.append(_NIBBLE_OF_SYMBOL[c])
+                sq += 1
+            else:
+                sq += int(c)
+    if castling != '-':
+        for right in castling:
+            rook_sq, rook, nibble = _CASTLING_ROOK_NIBBLES[right]
+            if rook_sq in squares and nibbles[squares.index(rook_sq)] == _NIBBLE_OF_SYMBOL[rook]:
+                nibbles[squares.index(rook_sq)] = nibble
+    if side_to_move == 'b':
+        nibbles[nibbles.index(_NIBBLE_OF_SYMBOL['k'])] = _BLACK_KING_TO_MOVE_NIBBLE
+    occupied = 0
+    for sq in squares:
+        occupied |= 1 << sq
+    if len(nibbles) & 1:
+        nibbles.append(0)
+    packed = bytes(nibbles[i] | nibbles[i + 1] << 4 for i in range(0, len(nibbles), 2))
+    return occupied.to_bytes(8, 'big') + packed.ljust(COMPRESSED_POSITION_SIZE - 8, b'\0')
+
+def encode_rows(csv_rows):
+    ''' Columns of a list of csv rows as a ROW_DTYPE array, with the search methods
+        as indexes into the returned list of search methods
+    '''
+    split_rows = [csv_row.strip().split(",") for csv_row in csv_rows]
+    full_rows = [split_row if len(split_row) == 10 else split_row + ['', '0'] for split_row in split_rows]
+    ply, fen, bestmove, bestmove_score, game_result, search_method, \
+    sf_bestmove1, sf_bestmove1_score, sf_bestmove2, sf_bestmove2_score = \
+        zip(*full_rows) if full_rows else [()] * 10
+    fen_fields = [f.split(' ') for f in fen]
+    search_methods = {}
+    rows = np.zeros(len(csv_rows), dtype=ROW_DTYPE)
+    rows['placement_hash'] = placement_hashes([fields[0] for fields in fen_fields])
+    rows['board'] = np.frombuffer(b''.join(compress_fen(f) for f in fen),
+                                  dtype=np.uint8).reshape(-1, COMPRESSED_POSITION_SIZE)
+    rows['ply'] = ply
+    rows['rule50'] = [fields[4] for fields in fen_fields]
+    rows['fullmove'] = [fields[5] for fields in fen_fields]
+    rows['ep_square'] = [NO_EP_SQUARE if fields[3] == '-' else parse_square(fields[3]) for fields in fen_fields]
+    rows['bestmove'] = [pack_uci(m) for m in bestmove]
+    rows['sf_bestmove1'] = [pack_uci(m) for m in sf_bestmove1]
+    rows['sf_bestmove2'] = [pack_uci(m) if m else NO_MOVE for m in sf_bestmove2]
+    for name, scores in (('bestmove_score', bestmove_score), ('sf_bestmove1_score', sf_bestmove1_score),
+                         ('sf_bestmove2_score', sf_bestmove2_score)):
+        scores = np.array(scores).astype(np.int32)
+        if len(scores) and (scores.min() < -0x8000 or scores.max() >= 0x8000):
+            raise ValueError(f'{name} out of the int16 range')
+        rows[name] = scores
+    rows['game_result'] = game_result
+    rows['search_method'] = [search_methods.setdefault(m, len(search_methods)) for m in search_method]
+    rows['num_sf_moves'] = [2 if len(split_row) == 10 else 1 for split_row in split_rows]
+    return rows, list(search_methods)
+
+
+def convert_csv(input_filename, block_rows=DEFAULT_BLOCK_ROWS, workers=None):
+    ''' Convert a .csv or .csv.zst file into a columnar .cols file next to it '''
+    if block_rows % 8:
+        raise ValueError('block_rows must be a multiple of 8')
+    output_filename = columnar_filename(input_filename)
+    tmp_filename = output_filename + '.tmp'
+    search_methods = {}
+    num_rows = 0
+    pending = []
+    with multiprocessing.Pool(workers) as pool, open(tmp_filename, 'wb') as f:
+        f.seek(COLUMNAR_FILE_HEADER_SIZE)
+        for rows, batch_search_methods in pool.imap(encode_rows, iter_csv_row_batches(input_filename)):
+            # map the batch's search method indexes to the file's
+            codes = np.array([search_methods.setdefault(m, len(search_methods)) for m in batch_search_methods],
+                             dtype=np.uint8)
+            if len(codes):
+                rows['search_method'] = codes[rows['search_method']]
+            num_rows += len(rows)
+            pending.append(rows)
+            if sum(len(rows) for rows in pending) >= block_rows:
+                rows = np.concatenate(pending)
+                for start in range(0, len(rows) - block_rows + 1, block_rows):
+                    write_block(f, rows[start:start + block_rows])
+                pending = [rows[len(rows) // block_rows * block_rows:]]
+        rows = np.concatenate(pending) if pending else np.zeros(0, dtype=ROW_DTYPE)
+        if len(rows):
+            write_block(f, np.concatenate([rows, np.zeros(block_rows - len(rows), dtype=ROW_DTYPE)]))
+        if len(search_methods) > 256:
+            raise ValueError(f'too many search methods: {len(search_methods)}')
+        f.seek(0)
+        metadata = json.dumps({'search_methods': list(search_methods)}).encode()
+        header = _COLUMNAR_FILE_HEADER.pack(COLUMNAR_FILE_MAGIC, COLUMNAR_FILE_VERSION, block_rows,
+                                            num_rows, os.path.getsize(input_filename), len(metadata)) + metadata
+        if len(header) > COLUMNAR_FILE_HEADER_SIZE:
+            raise ValueError('header too large')
+        f.write(header.ljust(COLUMNAR_FILE_HEADER_SIZE, b'\0'))
+    os.replace(tmp_filename, output_filename)
+    save_zone_maps(output_filename, np.array([block_zone_map(block)
+                                              for block in ColumnarPositions(output_filename).iter_blocks()]))
+    print(f'Saved {num_rows} rows to {output_filename}')
+    return output_filename
+
+def write_block(f, rows):
+    for name in ROW_DTYPE.names:
+        f.write(np.ascontiguousarray(rows[name]).tobytes())
+
+
+def num_pieces(board):
+    ''' Number of pieces of each compressed position in a (rows, 24) board column '''
+    return np.unpackbits(board[:, :8], axis=1).sum(axis=1, dtype=np.int32)
+
+def black_to_move(board):
+    ''' 1 for each compressed position with black to move, else 0 '''
+    nibble_bytes = board[:, 8:]
+    black_king_to_move = ((nibble_bytes & 15) == _BLACK_KING_TO_MOVE_NIBBLE) | \
+                         ((nibble_bytes >> 4) == _BLACK_KING_TO_MOVE_NIBBLE)
+    return black_king_to_move.any(axis=1).astype(np.uint8)
+
+def pieces_on(board, squares):
+    ''' The compressed position nibble on squares[i] of each board i, or EMPTY_NIBBLE '''
+    rows = np.arange(len(board))
+    # the occupancy is big-endian, so reversed and unpacked little-endian it has a bit per square from a1 up
+    occupied = np.unpackbits(board[:, 7::-1], axis=1, bitorder='little')
+    is_occupied = occupied[rows, squares] == 1
+    # the nibbles go from a1 up too, so the piece on a square is the one after the pieces below it
+    index = np.cumsum(occupied, axis=1, dtype=np.int32)[rows, squares] - is_occupied
+    index = np.minimum(index, 2 * (COMPRESSED_POSITION_SIZE - 8) - 1)
+    nibbles = (board[rows, 8 + (index >> 1)] >> ((index & 1) * 4)) & 15
+    return np.where(is_occupied, nibbles, EMPTY_NIBBLE).astype(np.uint8)
+
+def nibble_colors(nibbles, black_to_move):
+    ''' 0 for white pieces, 1 for black ones, of the nibbles of boards with black_to_move '''
+    colors = nibbles & 1
+    colors = np.where(nibbles == _EP_PAWN_NIBBLE, 1 - black_to_move, colors)
+    colors = np.where(nibbles == _WHITE_CASTLING_ROOK_NIBBLE, 0, colors)
+    colors = np.where(nibbles == _BLACK_CASTLING_ROOK_NIBBLE, 1, colors)
+    return colors
+
+def move_is_capture(block, name):
+    ''' Whether the moves of a move column of a block are captures, en passant included, like chess.Board.is_capture '''
+    board, moves = block['board'], block[name].astype(np.int32)
+    from_squares, to_squares = moves & 63, moves >> 6 & 63
+    captured, mover = pieces_on(board, to_squares), pieces_on(board, from_squares)
+    is_piece_capture = (captured != EMPTY_NIBBLE) & (nibble_colors(captured, black_to_move(board)) != black_to_move(board))
+    is_en_passant = (to_squares == block['ep_square']) & np.isin(mover, _PAWN_NIBBLES) & \
+                    np.isin(np.abs(to_squares - from_squares), [7, 9]) & (captured == EMPTY_NIBBLE)
+    return is_piece_capture | is_en_passant
+
+def block_zone_map(block):
+    ''' The min and max of each zone map column in a block
+
+        A column with no values in the block, like sf_bestmove2_score in a block of rows
+        with only one possible move, has a min above its max.
+    '''
+    zone_map = np.zeros((), dtype=ZONE_MAP_DTYPE)
+    if not len(block['ply']):
+        return zone_map
+    for name in ZONE_COLUMNS:
+        values = num_pieces(block['board']) if name == 'num_pieces' else block[name]
+        if name in SECOND_MOVE_COLUMNS:
+            values = values[block['num_sf_moves'] == 2]
+            if not len(values):
+                zone_map[f'{name}_min'] = np.iinfo(np.int32).max
+                zone_map[f'{name}_max'] = np.iinfo(np.int32).min
+                continue
+        zone_map[f'{name}_min'] = values.min()
+        zone_map[f'{name}_max'] = values.max()
+    return zone_map
+
+def save_zone_maps(filename, zone_maps):
+    tmp_filename = zones_filename(filename) + '.tmp'
+    zone_maps.tofile(tmp_filename)
+    os.replace(tmp_filename, zones_filename(filename))
+
+
+def block_dtype(block_rows):
+    ''' One block of the file as a single struct of per-column arrays '''
+    return np.dtype([(name, ROW_DTYPE[name].base, (block_rows,) + ROW_DTYPE[name].shape)
+                     for name in ROW_DTYPE.names])
+
+
+class ColumnarPositions:
+    ''' A memory-mapped .cols file, read a block or a column at a time '''
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            header = f.read(COLUMNAR_FILE_HEADER_SIZE)
+        magic, version, self.block_rows, self.num_rows, self.input_size, metadata_size = \
+            _COLUMNAR_FILE_HEADER.unpack_from(header)
+        if magic != COLUMNAR_FILE_MAGIC or version != COLUMNAR_FILE_VERSION:
+            raise ValueError(f'{filename} is not a version {COLUMNAR_FILE_VERSION} columnar file')
+        metadata = json.loads(header[_COLUMNAR_FILE_HEADER.size:_COLUMNAR_FILE_HEADER.size + metadata_size])
+        self.filename = filename
+        self.search_methods = metadata['search_methods']
+        self._zone_maps = None
+        self.num_blocks = (self.num_rows + self.block_rows - 1) // self.block_rows
+        self.blocks = np.memmap(filename, dtype=block_dtype(self.block_rows), mode='r',
+                                offset=COLUMNAR_FILE_HEADER_SIZE, shape=(self.num_blocks,))
+
+    @classmethod
+    def for_input(cls, input_filename):
+        ''' The columnar file of an input file, or None if there is none for its current contents '''
+        filename = columnar_filename(input_filename)
+        if not os.path.isfile(filename):
+            return None
+        columns = cls(filename)
+        if columns.input_size != os.path.getsize(input_filename):
+            print(f'Ignoring {filename}, it was built from a different version of {input_filename}')
+            return None
+        return columns
+
+    @classmethod
+    def for_file(cls, filename):
+        ''' A .cols file, or the columnar file of an input file if it has a current one, else None '''
+        return cls(filename) if filename.endswith('.cols') else cls.for_input(filename)
+
+    def __len__(self):
+        return self.num_rows
+
+    def block_size(self, block_index):
+        return min(self.block_rows, self.num_rows - block_index * self.block_rows)
+
+    def block(self, block_index):
+        ''' The columns of a block as a dict of views into the file, without padding rows '''
+        block = self.blocks[block_index]
+        num_rows = self.block_size(block_index)
+        return {name: block[name][:num_rows] for name in ROW_DTYPE.names}
+
+    def iter_blocks(self):
+        for block_index in range(self.num_blocks):
+            yield self.block(block_index)
+
+    @property
+    def zone_maps(self):
+        ''' One ZONE_MAP_DTYPE record per block, from the .zones file or worked out and saved if missing '''
+        if self._zone_maps is None:
+            filename = zones_filename(self.filename)
+            if os.path.isfile(filename) and os.path.getsize(filename) == self.num_blocks * ZONE_MAP_DTYPE.itemsize:
+                self._zone_maps = np.fromfile(filename, dtype=ZONE_MAP_DTYPE)
+            else:
+                self._zone_maps = np.array([block_zone_map(block) for block in self.iter_blocks()],
+                                           dtype=ZONE_MAP_DTYPE)
+                save_zone_maps(self.filename, self._zone_maps)
+        return self._zone_maps
+
+    def column(self, name, start=0, stop=None):
+        ''' Rows start to stop of a column, copied out of the blocks they span '''
+        stop = self.num_rows if stop is None else min(stop, self.num_rows)
+        if start >= stop:
+            return np.zeros((0,) + ROW_DTYPE[name].shape, dtype=ROW_DTYPE[name].base)
+        first_block, last_block = start // self.block_rows, (stop - 1) // self.block_rows
+        values = self.blocks[name][first_block:last_block + 1].reshape((-1,) + ROW_DTYPE[name].shape)
+        offset = first_block * self.block_rows
+        return values[start - offset:stop - offset]
+
+    def fen(self, block, i):
+        ''' The fen of row i of a block '''
+        pos = Position.from_compressed(block['board'][i].tobytes())
+        fields = pos.fen().split(' ')
+        ep_square = block['ep_square'][i]
+        fields[3] = '-' if ep_square == NO_EP_SQUARE else square_name(int(ep_square))
+        fields[4] = str(block['rule50'][i])
+        fields[5] = str(block['fullmove'][i])
+        return ' '.join(fields)
+
+    def csv_row(self, block, i):
+        ''' Row i of a block in the original .csv format '''
+        fields = [
+            block['ply'][i], self.fen(block, i), unpack_uci(block['bestmove'][i]), block['bestmove_score'][i],
+            block['game_result'][i], self.search_methods[block['search_method'][i]],
+            unpack_uci(block['sf_bestmove1'][i]), block['sf_bestmove1_score'][i],
+        ]
+        if block['num_sf_moves'][i] == 2:
+            fields += [unpack_uci(block['sf_bestmove2'][i]), block['sf_bestmove2_score'][i]]
+        return ','.join(map(str, fields)) + '\n'
+
+    def iter_csv_rows(self):
+        for block in self.iter_blocks():
+            for i in range(len(block['ply'])):
+                yield self.csv_row(block, i)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: ./columnar.py <input.csv or input.csv.zst> ...')
+        print('       ./columnar.py csv <input.cols>')
+        sys.exit(0)
+    if sys.argv[1] == 'csv':
+        for csv_row in ColumnarPositions(sys.argv[2]).iter_csv_rows():
+            sys.stdout.write(csv_row)
+        sys.exit(0)
+    for input_filename in sys.argv[1:]:
+        if ColumnarPositions.for_input(input_filename):
+            print(f'Found {columnar_filename(input_filename)}, doing nothing')
+            continue
+        convert_csv(input_filename)
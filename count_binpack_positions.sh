@@ -1,5 +1,10 @@
 #!/bin/bash
 
-stockfish-output-positions-csv \
-  gather_statistics position_count \
-  input_file $1
+# the native counter is much faster, binpack.py decodes every move in Python
+if command -v stockfish-output-positions-csv > /dev/null; then
+  stockfish-output-positions-csv \
+    gather_statistics position_count \
+    input_file $1
+else
+  python3 $(dirname $0)/binpack.py count $1
+fi
@@ -0,0 +1,200 @@
+import argparse
+import os
+import os.path
+
+from binpack import BinpackWriter
+from csv_reader import iter_csv_rows
+from dedup import BloomFilter, PositionHashSet
+from features import PositionFeatures, features_filename
+from filter_configs import FILTER_VERSIONS, cross_file_dedup
+from filter_engine import CsvRow, FilterEngine
+from manifest import Manifest
+from plain_writer import PlainWriter
+
+''' Filter positions .csv files with any filter versions through the rule engine
+
+Several versions are filtered from one pass over the file: every row is decompressed,
+parsed and, if some rule needs it, classified on a board once, then handed to each
+version's engine. Each version keeps its own counters, dedup state and output file.
+
+Outputs are written to a temp file, renamed when done and recorded in the build manifest,
+which decides whether a version needs filtering again. A -dd version's output depends on
+every file filtered before it, so those are its inputs too, and when it's filtered again
+the rows of earlier files that were up to date are added to its seen set first.
+'''
+
+# the sources that decide what the output of a filter version is, recorded in the build manifest
+CSV_FILTER_TOOLS = [os.path.join(os.path.dirname(os.path.abspath(__file__)), filename) for filename in [
+    'csv_filter.py', 'filter_configs.py', 'filter_engine.py', 'binpack.py', 'bitboards.py', 'csv_reader.py',
+    'dedup.py', 'fast_board.py', 'features.py', 'plain_writer.py',
+]]
+
+def output_filenames(input_filename, version):
+    ''' The .plain, .binpack and .min.binpack files a filter version could have written '''
+    if input_filename.endswith(".csv.zst"):
+        plain_filename = input_filename.replace('.csv.zst', f'.csv.zst.filter-{version}.plain')
+    else:
+        plain_filename = input_filename.replace('.csv', f'.csv.filter-{version}.plain')
+    binpack_filename = plain_filename.replace('.plain', '.binpack')
+    return plain_filename, binpack_filename, binpack_filename + '.min.binpack'
+
+def is_filtered(input_filename, version, inputs, params):
+    ''' Whether the output of a filter version, or the .min.binpack minimized from it, is up to date '''
+    plain_filename, binpack_filename, min_binpack_filename = output_filenames(input_filename, version)
+    output_filename = plain_filename if params['write_plain'] else binpack_filename
+    manifest = Manifest.for_file(output_filename)
+    if manifest.is_current(output_filename, inputs, CSV_FILTER_TOOLS, params):
+        return True
+    return not params['write_plain'] and \
+           manifest.is_current(binpack_filename, inputs, CSV_FILTER_TOOLS, params, allow_missing=True) and \
+           manifest.is_current(min_binpack_filename)
+
+def add_placements(input_filename, version, seen):
+    ''' Add the piece placement of every row a filter engine would track to a version's seen set '''
+    print(f'Adding the positions of {input_filename} to the seen set of filter {version} ...')
+    for csv_row in iter_csv_rows(input_filename):
+        split_row = csv_row.strip().split(",")
+        # rows with only one possible move are never tracked
+        if len(split_row) == 10:
+            seen.add(split_row[1].split(' ')[0])
+
+
+class FilterOutput:
+    def __init__(self, engine, output_filename, write_plain, inputs, params):
+        self.engine = engine
+        self.output_filename = output_filename
+        self.temp_filename = output_filename + '.tmp'
+        self.inputs = inputs
+        self.params = params
+        self.outfile = PlainWriter(self.temp_filename) if write_plain else BinpackWriter(self.temp_filename)
+        self.positions = []
+
+    def write_positions_to_file(self):
+        if isinstance(self.outfile, BinpackWriter):
+            for position in self.positions:
+                self.outfile.add_position(*position)
+        else:
+            self.outfile.write_positions(self.positions)
+        self.positions = []
+
+    def finish(self):
+        ''' Rename the finished temp output to the output and record it in the manifest '''
+        self.outfile.close()
+        os.replace(self.temp_filename, self.output_filename)
+        Manifest.for_file(self.output_filename).record(self.output_filename, self.inputs, CSV_FILTER_TOOLS,
+                                                       self.params)
+
+
+def filter_csv(input_filename, versions, write_plain=False, adaptive=True, seen_sets=None, use_features=True,
+               features_chunk_size=100000, earlier_filenames=(), seen_filenames=None):
+    ''' Filter a .csv or .csv.zst file into a .filter-<version>.binpack for each version,
+        or .plain files if write_plain is set
+
+        seen_sets maps versions to the seen set they de-duplicate against,
+        by default a new one for this file.
+        earlier_filenames are the files filtered before this one into those seen sets, and
+        seen_filenames maps versions to the files whose rows are in their seen set so far.
+        Board rules read the file's features sidecar from features.py when there is one.
+        Versions whose output the build manifest shows is up to date are skipped.
+        Returns the output filenames written.
+    '''
+    seen_sets = seen_sets or {}
+    seen_filenames = {} if seen_filenames is None else seen_filenames
+    features = PositionFeatures.for_input(input_filename) if use_features else None
+    outputs = []
+    for version in versions:
+        seen = seen_sets.get(version)
+        # the features sidecar decides the board rules when it's used, so it's an input too
+        inputs = [input_filename, features_filename(input_filename)] if features else [input_filename]
+        if seen is not None:
+            inputs += earlier_filenames
+        params = {
+            'version': version,
+            'write_plain': write_plain,
+            'seen': type(seen).__name__ if seen is not None else 'PositionHashSet',
+        }
+        if is_filtered(input_filename, version, inputs, params):
+            print(f'Up to date, skipping filter {version} of {input_filename}')
+            continue
+        if seen is not None:
+            # the seen set has to hold every earlier file's rows, including those of files that were skipped
+            loaded_filenames = seen_filenames.setdefault(version, set())
+            for earlier_filename in earlier_filenames:
+                if earlier_filename not in loaded_filenames:
+                    add_placements(earlier_filename, version, seen)
+                    loaded_filenames.add(earlier_filename)
+        plain_filename, binpack_filename, _ = output_filenames(input_filename, version)
+        engine = FilterEngine(FILTER_VERSIONS[version](), seen=seen, adaptive=adaptive)
+        outputs.append(FilterOutput(engine, plain_filename if write_plain else binpack_filename, write_plain,
+                                    inputs, params))
+    if not outputs:
+        return []
+    print(f'Processing {input_filename} with filters {", ".join(o.engine.config.name for o in outputs)} ...')
+    if features:
+        print(f'Using the board features in {features_filename(input_filename)}')
+    num_positions = 0
+    for csv_row in iter_csv_rows(input_filename):
+        split_row = csv_row.strip().split(",")
+        row = CsvRow(split_row) if len(split_row) == 10 else None
+        if features:
+            if num_positions % features_chunk_size == 0:
+                feature_rows = features.rows(num_positions, num_positions + features_chunk_size).tolist()
+            if row is not None:
+                row.features = feature_rows[num_positions % features_chunk_size]
+        num_positions += 1
+        for output in outputs:
+            position = output.engine.process_row(row)
+            if position:
+                output.positions.append(position)
+            if num_positions % 100000 == 0:
+                output.engine.print_stats()
+                output.write_positions_to_file()
+    for output in outputs:
+        output.engine.print_stats()
+        output.write_positions_to_file()
+        output.finish()
+        if output.params['version'] in seen_sets:
+            seen_filenames.setdefault(output.params['version'], set()).add(input_filename)
+        print(f'Saved to {output.output_filename}')
+    return [output.output_filename for output in outputs]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Filter positions .csv or .csv.zst files into .binpack files')
+    parser.add_argument('versions', help=f'comma-separated filter versions: {", ".join(FILTER_VERSIONS)}')
+    parser.add_argument('input_csv_files', nargs='+')
+    parser.add_argument('--plain', action='store_true',
+                        help='write .plain files instead of .binpack files')
+    parser.add_argument('--no-adaptive', action='store_true',
+                        help='run the rules in their declared order instead of reordering them by cost')
+    parser.add_argument('--no-features', action='store_true',
+                        help="parse boards for the board rules even if there's a .features file from features.py")
+    parser.add_argument('--bloom-capacity', type=int,
+                        help='de-duplicate -dd versions with an approximate bloom filter sized for this many positions')
+    parser.add_argument('--bloom-fpr', type=float, default=0.001,
+                        help='target false positive rate of the bloom filter')
+    parser.add_argument('--bloom-file',
+                        help='keep the bloom filter bits in this file, to de-duplicate across runs')
+    args = parser.parse_args()
+    versions = args.versions.split(',')
+    for version in versions:
+        if version not in FILTER_VERSIONS:
+            parser.error(f'unknown filter version: {version}')
+    input_filenames = args.input_csv_files
+    seen_sets = {}
+    for version in filter(cross_file_dedup, versions):
+        if args.bloom_capacity:
+            seen_sets[version] = BloomFilter(args.bloom_capacity, args.bloom_fpr,
+                                             args.bloom_file and f'{args.bloom_file}.{version}')
+        else:
+            seen_sets[version] = PositionHashSet()
+    # prioritize position scores from later in time (ie. seen end of month vs. beginning of month)
+    input_filenames = sorted(input_filenames)[::-1]
+    seen_filenames = {}
+    for i, input_filename in enumerate(input_filenames):
+        filter_csv(input_filename, versions, write_plain=args.plain, adaptive=not args.no_adaptive, seen_sets=seen_sets,
+                   use_features=not args.no_features, earlier_filenames=input_filenames[:i],
+                   seen_filenames=seen_filenames)
+    for seen in seen_sets.values():
+        if isinstance(seen, BloomFilter):
+            seen.close()
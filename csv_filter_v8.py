@@ -1,5 +1,9 @@
+import argparse
+import collections
 from glob import glob
 import io
+import itertools
+import multiprocessing
 import os
 import os.path
 from pprint import pprint
@@ -7,63 +11,150 @@ import re
 import sys
 import textwrap
 
-import chess
-import zstandard
+import numpy as np
 
-''' Iterate over positions .csv files and output .plain files
+from binpack import BinpackWriter
+from checkpoint import FilterCheckpoint
+from csv_reader import iter_csv_rows
+from dedup import BloomFilter, PositionHashSet, placement_hashes
+from fast_board import FastBoard
+from features import BOARD_CHECK_FAILURES, PositionFeatures, features_filename
+from manifest import Manifest
+from pipeline import Stage, run_pipeline
+from plain_writer import PlainWriter, format_plain_records
+
+''' Iterate over positions .csv files and output .binpack or .plain files
 '''
-if len(sys.argv) != 2:
-    print('Usage: ./csv_filter_v8.py <input_csv_file>')
-    sys.exit(0)
 
+# the sources that decide what the output of a filter run is, recorded in the build manifest
+FILTER_TOOLS = [os.path.join(os.path.dirname(os.path.abspath(__file__)), filename) for filename in [
+    'csv_filter_v8.py', 'binpack.py', 'bitboards.py', 'csv_reader.py', 'dedup.py', 'fast_board.py',
+    'features.py', 'plain_writer.py',
+]]
 
 def move_is_promo(uci_move):
     return len(uci_move) == 5 and uci_move[-1] in ['n','b','r','q']
 
-def filter_csv_to_plain(input_filename):
-    ''' Filter a .csv or .csv.zst file '''
+def board_check_failure(fen, bestmove_uci, sf_bestmove1_uci, sf_bestmove2_uci):
+    ''' Name of the PositionCsvIterator counter for the first board check that fails, if any '''
+    # filtering is slower when needing to parse the board
+    b = FastBoard(fen)
+    if b.is_check():
+        # skip if in check since eval never gets called when in check
+        return 'num_in_check'
+    # filter out if provided move is a capture or promo
+    if b.is_capture(bestmove_uci):
+        return 'num_bestmove_captures'
+    # check if moves from SF search are captures or promos
+    if b.is_capture(sf_bestmove1_uci) or b.is_promotion(sf_bestmove1_uci):
+        # skip if SF search 1st best move is a capture or promo
+        return 'num_sf_bestmove1_capture_promos'
+    if b.is_capture(sf_bestmove2_uci) or b.is_promotion(sf_bestmove2_uci):
+        # skip if SF search 2nd best move is a capture or promo
+        return 'num_sf_bestmove2_capture_promos'
+
+def filter_csv_to_plain(input_filename, write_plain=False, chain=True, batch=False, workers=1, seen=None,
+                        use_features=True, pipeline=False, compression_level=None, checkpoint_rows=5_000_000):
+    ''' Filter a .csv or .csv.zst file into a .binpack, or a .plain file if write_plain is set,
+        compressed into a .plain.zst if compression_level is given
+
+        seen is the set of piece placements to de-duplicate against, an exact
+        PositionHashSet for this file alone by default.
+        The board checks read the file's features sidecar from features.py when there is one.
+        The output is written to a temp file and checkpointed every checkpoint_rows rows,
+        and a rerun resumes from the last checkpoint.
+        Filtering is skipped if the build manifest shows the output is up to date.
+    '''
     print(f'Processing {input_filename} ...')
     if input_filename.endswith(".csv.zst"):
-        output_filename = input_filename.replace('.csv.zst', '.csv.zst.filter-v8.plain')
+        plain_filename = input_filename.replace('.csv.zst', '.csv.zst.filter-v8.plain')
     else:
-        output_filename = input_filename.replace('.csv', '.csv.filter-v8.plain')
-    # skip filtering if the .plain file already exists
-    if os.path.isfile(output_filename):
-        print(f'Found .csv.zst.filter-v8.plain file, doing nothing:')
+        plain_filename = input_filename.replace('.csv', '.csv.filter-v8.plain')
+    binpack_filename = plain_filename.replace('.filter-v8.plain', '.filter-v8.binpack')
+    min_binpack_filename = binpack_filename.replace('.filter-v8.binpack', '.filter-v8.binpack.min.binpack')
+    output_filename = binpack_filename
+    if write_plain:
+        output_filename = plain_filename if compression_level is None else plain_filename + '.zst'
+    params = {
+        'write_plain': write_plain,
+        'chain': chain,
+        'compression_level': compression_level,
+        'seen': type(seen).__name__ if seen is not None else 'PositionHashSet',
+    }
+    features = None
+    if use_features and workers == 1:
+        features = PositionFeatures.for_input(input_filename)
+    # the features sidecar decides the board checks when it's used, so it's an input too
+    inputs = [input_filename, features_filename(input_filename)] if features else [input_filename]
+    # skip filtering if the output, or the .min.binpack minimized from it, is up to date
+    manifest = Manifest.for_file(output_filename)
+    if manifest.is_current(output_filename, inputs, FILTER_TOOLS, params):
+        print(f'Up to date, doing nothing:')
         print(output_filename)
         return
-    # skip filtering if the .binpack file already exists
-    binpack_filename = output_filename.replace('.csv.zst.filter-v8.plain', '.csv.zst.filter-v8.binpack')
-    if os.path.isfile(binpack_filename):
-        print(f'Found .csv.zst.filter-v8.binpack file, doing nothing:')
-        print(binpack_filename)
-        return
-    # skip filtering if the minimized .min.binpack file already exists
-    min_binpack_filename = binpack_filename.replace('.filter-v8.binpack', '.filter-v8.binpack.min.binpack')
-    if os.path.isfile(min_binpack_filename):
-        print(f'Found .csv.zst.filter-v8.binpack.min.binpack file, doing nothing:')
+    if not write_plain and \
+       manifest.is_current(binpack_filename, inputs, FILTER_TOOLS, params, allow_missing=True) and \
+       manifest.is_current(min_binpack_filename):
+        print(f'Minimized .binpack is up to date, doing nothing:')
         print(min_binpack_filename)
         return
-    # filter the file
-    if input_filename.endswith(".csv.zst"):
-        with open(input_filename, 'rb') as compressed_infile, \
-             open(output_filename, 'w+') as outfile:
-            dctx = zstandard.ZstdDecompressor()
-            stream_reader = dctx.stream_reader(compressed_infile)
-            text_stream = io.TextIOWrapper(stream_reader, encoding='utf-8')
-            PositionCsvIterator(text_stream, outfile).process_csv_rows()
+    mode = 'shards' if workers > 1 else 'pipeline' if pipeline else 'batch' if batch else 'rows'
+    checkpoint = FilterCheckpoint(output_filename, input_filename, dict(params, mode=mode), checkpoint_rows)
+    resume = checkpoint_rows > 0 and checkpoint.load()
+    if resume:
+        checkpoint.truncate_output()
+    # filter the file, encoding binpack chunks directly unless a .plain file is wanted
+    if write_plain:
+        outfile = PlainWriter(checkpoint.temp_filename, compression_level, append=resume)
     else:
-        with open(input_filename, 'r') as infile, \
-             open(output_filename, 'w+') as outfile:
-            PositionCsvIterator(infile, outfile).process_csv_rows()
+        outfile = BinpackWriter(checkpoint.temp_filename, chain=chain, append=resume)
+    if features:
+        print(f'Using the board features in {features_filename(input_filename)}')
+    with outfile:
+        position_csv_iterator = PositionCsvIterator(iter_csv_rows(input_filename, start_row=checkpoint.start_row),
+                                                    outfile, seen, features)
+        if resume:
+            checkpoint.restore(position_csv_iterator)
+        if checkpoint_rows > 0:
+            position_csv_iterator.checkpoint = checkpoint
+        filter_rows(position_csv_iterator, batch, workers, pipeline)
+    checkpoint.finish()
+    manifest.record(output_filename, inputs, FILTER_TOOLS, params)
     print(f'Saved to {output_filename}')
     return output_filename
 
 
+def filter_csv_shard(shard):
+    ''' Runs in a worker process: filter a shard of rows, leaving dedup to the parent '''
+    shard_iterator = PositionCsvIterator(None, None)
+    candidates, piece_orientation_hashes = shard_iterator.filter_csv_batch(shard.splitlines())
+    checked_candidates = [
+        (dedup_key, seen_in_shard,
+         board_check_failure(position[0], position[1], sf_bestmove1_uci, sf_bestmove2_uci), position)
+        for row_index, dedup_key, seen_in_shard, sf_bestmove1_uci, sf_bestmove2_uci, position in candidates
+    ]
+    counters = {name: value for name, value in vars(shard_iterator).items() if name.startswith('num_')}
+    return counters, checked_candidates, piece_orientation_hashes
+
+def filter_rows(position_csv_iterator, batch, workers=1, pipeline=False):
+    if workers > 1:
+        position_csv_iterator.process_csv_shards(workers)
+    elif pipeline:
+        position_csv_iterator.process_csv_pipeline()
+    elif batch:
+        position_csv_iterator.process_csv_batches()
+    else:
+        position_csv_iterator.process_csv_rows()
+
+
 class PositionCsvIterator:
-    def __init__(self, infile, outfile):
+    def __init__(self, infile, outfile, seen=None, features=None):
         self.infile = infile
         self.outfile = outfile
+        # precomputed board checks of every row, instead of parsing boards
+        self.features = features
+        # a FilterCheckpoint to save after writing positions
+        self.checkpoint = None
 
         self.EARLY_PLY_SKIP = 36
 
@@ -90,7 +181,7 @@ class PositionCsvIterator:
 
         # reducing duplicate positions
         self.num_seen_before = 0
-        self.piece_orientations_seen = set()
+        self.piece_orientations_seen = seen if seen is not None else PositionHashSet()
 
         self.num_positions_filtered_out = 0
 
@@ -111,8 +202,7 @@ class PositionCsvIterator:
         sf_bestmove2_score = int(sf_bestmove2_score)
 
         piece_orientation = fen.split(' ')[0]
-        seen_position_before = piece_orientation in self.piece_orientations_seen
-        self.piece_orientations_seen.add(piece_orientation)
+        seen_position_before = self.piece_orientations_seen.test_and_add(piece_orientation)
 
         # assume the dataset is a sequence of training games
         # and that we're at the beginning of a training game when this is true
@@ -167,75 +257,318 @@ class PositionCsvIterator:
             self.num_bestmove_promos += 1
             return
         elif seen_position_before:
-            # faster to remove duplicate positions before filtering with chess.Board
+            # faster to remove duplicate positions before the board checks
             self.num_seen_before += 1
             return
 
-        # filtering is slower when needing to initialize a board
-        b = chess.Board(fen)
-        if b.is_check():
-            # skip if in check since eval never gets called when in check
-            self.num_in_check += 1
-            return
-        # filter out if provided move is a capture or promo
-        bestmove = chess.Move.from_uci(bestmove_uci)
-        if b.is_capture(bestmove):
-            self.num_bestmove_captures += 1
-            return
-        # check if moves from SF search are captures or promos
-        sf_bestmove1 = chess.Move.from_uci(sf_bestmove1_uci)
-        if b.is_capture(sf_bestmove1) or move_is_promo(sf_bestmove1_uci):
-            # skip if SF search 1st best move is a capture or promo
-            self.num_sf_bestmove1_capture_promos += 1
-            return
-        sf_bestmove2 = chess.Move.from_uci(sf_bestmove2_uci)
-        if b.is_capture(sf_bestmove2) or move_is_promo(sf_bestmove2_uci):
-            # skip if SF search 2nd best move is a capture or promo
-            self.num_sf_bestmove2_capture_promos += 1
+        if not self.passes_board_checks(fen, bestmove_uci, sf_bestmove1_uci, sf_bestmove2_uci, self.num_positions):
             return
         return (fen, bestmove_uci, bestmove_score, ply, game_result)
 
+    def passes_board_checks(self, fen, bestmove_uci, sf_bestmove1_uci, sf_bestmove2_uci, row_index) -> bool:
+        if self.features:
+            failed_check = self.features.board_check_failure(row_index)
+        else:
+            failed_check = board_check_failure(fen, bestmove_uci, sf_bestmove1_uci, sf_bestmove2_uci)
+        if failed_check:
+            setattr(self, failed_check, getattr(self, failed_check) + 1)
+            return False
+        return True
+
+    def process_csv_batch(self, csv_rows):
+        ''' Filter a block of csv rows, same as process_csv_row on each row
+
+            The score-only rules are evaluated as masks over NumPy columns of the block,
+            so only the rows that pass them are looked at one by one.
+        '''
+        batch_start = self.num_positions
+        candidates, piece_orientation_hashes = self.filter_csv_batch(csv_rows)
+        board_check = None
+        if self.features:
+            board_check = self.features.board_check_failures(batch_start, self.num_positions)
+        positions = []
+        for row_index, dedup_key, seen_in_batch, sf_bestmove1_uci, sf_bestmove2_uci, position in candidates:
+            if dedup_key is not None and (seen_in_batch or self.piece_orientations_seen.contains_hash(dedup_key)):
+                # faster to remove duplicate positions before the board checks
+                self.num_seen_before += 1
+            elif board_check is not None:
+                if board_check[row_index - batch_start]:
+                    failed_check = BOARD_CHECK_FAILURES[board_check[row_index - batch_start] - 1]
+                    setattr(self, failed_check, getattr(self, failed_check) + 1)
+                else:
+                    positions.append(position)
+            elif self.passes_board_checks(position[0], position[1], sf_bestmove1_uci, sf_bestmove2_uci, row_index):
+                positions.append(position)
+        self.piece_orientations_seen.test_and_add_hashes(piece_orientation_hashes)
+        self.num_positions_filtered_out += len(csv_rows) - len(positions)
+        return positions
+
+    def filter_csv_batch(self, csv_rows):
+        ''' Apply the score-only rules to a block of csv rows
+
+            Returns the rows left for the dedup and board checks, as
+            (row_index, dedup_key, seen_in_batch, sf_bestmove1_uci, sf_bestmove2_uci, position) tuples,
+            and the piece orientation hash of every row to add to the seen set afterwards.
+            dedup_key is None for rows that skip the dedup rule.
+        '''
+        split_rows = [csv_row.strip().split(",") for csv_row in csv_rows]
+        full_row_indexes = [self.num_positions + i for i, split_row in enumerate(split_rows) if len(split_row) == 10]
+        full_rows = [split_row for split_row in split_rows if len(split_row) == 10]
+        self.num_positions += len(split_rows)
+        # only one possible move in the position
+        self.num_only_one_move += len(split_rows) - len(full_rows)
+        if not full_rows:
+            return [], []
+        ply_col, fen_col, bestmove_uci_col, bestmove_score_col, game_result_col, \
+        sf_search_method_col, sf_bestmove1_uci_col, sf_bestmove1_score_col, \
+        sf_bestmove2_uci_col, sf_bestmove2_score_col = \
+            zip(*full_rows)
+        ply = np.array(ply_col).astype(np.int32)
+        sf_bestmove1_score = np.array(sf_bestmove1_score_col).astype(np.int32)
+        sf_bestmove2_score = np.array(sf_bestmove2_score_col).astype(np.int32)
+        abs_score1 = np.abs(sf_bestmove1_score)
+        abs_score2 = np.abs(sf_bestmove2_score)
+        abs_score_diff = np.abs(sf_bestmove1_score - sf_bestmove2_score)
+
+        # rows with only one possible move don't update prev_ply
+        prev_ply = np.empty_like(ply)
+        prev_ply[0] = self.prev_ply
+        prev_ply[1:] = ply[:-1]
+        self.prev_ply = int(ply[-1])
+        is_start_of_game = (prev_ply == -1) | (ply < prev_ply)
+        for i in np.flatnonzero(is_start_of_game):
+            if 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq' in fen_col[i]:
+                self.num_standard_games += 1
+            else:
+                self.num_non_standard_games += 1
+        num_start_positions = int(is_start_of_game.sum())
+        self.num_games += num_start_positions
+        self.num_start_positions += num_start_positions
+
+        # each mask only holds rows that no earlier rule removed, like the elif chain of process_csv_row
+        remaining = ~is_start_of_game
+        is_early_ply = remaining & (ply <= self.EARLY_PLY_SKIP)
+        remaining &= ~is_early_ply
+        is_one_good_move = remaining & (
+            (abs_score1 < 100) & (abs_score2 > 150) |
+            (abs_score1 > 150) & (abs_score2 < 100))
+        remaining &= ~is_one_good_move
+        # rows where the 2 best move scores favor different sides skip the promo and dedup rules
+        favor_different_sides = remaining & ((sf_bestmove1_score > 0) != (sf_bestmove2_score > 0))
+        is_one_good_move_v6 = favor_different_sides & (
+            (abs_score1 > 150) & (abs_score2 > 150) | (abs_score_diff > 200))
+        is_one_good_move_v8 = favor_different_sides & ~is_one_good_move_v6 & (
+            (abs_score1 > 100) & (abs_score2 > 100) | (abs_score_diff > 150))
+        remaining &= ~(is_one_good_move_v6 | is_one_good_move_v8)
+        same_side = remaining & ~favor_different_sides
+        is_bestmove_promo = same_side & (np.char.str_len(np.array(bestmove_uci_col)) == 5)
+        for i in np.flatnonzero(is_bestmove_promo):
+            is_bestmove_promo[i] = move_is_promo(bestmove_uci_col[i])
+        remaining &= ~is_bestmove_promo
+        self.num_early_plies += int(is_early_ply.sum())
+        self.num_one_good_move += int(is_one_good_move.sum() + is_one_good_move_v6.sum())
+        self.num_one_good_move_v8 += int(is_one_good_move_v8.sum())
+        self.num_bestmove_promos += int(is_bestmove_promo.sum())
+
+        # every row is added to the seen set, even when filtered out earlier
+        piece_orientation_hashes = placement_hashes([fen.split(' ')[0] for fen in fen_col])
+        dedup_keys = piece_orientation_hashes.tolist()
+        first_row_with = dict(zip(reversed(dedup_keys), range(len(dedup_keys) - 1, -1, -1)))
+        candidates = []
+        for i in np.flatnonzero(remaining):
+            dedup_key = None
+            seen_in_batch = False
+            if same_side[i]:
+                dedup_key = dedup_keys[i]
+                seen_in_batch = first_row_with[dedup_key] < i
+            position = (fen_col[i], bestmove_uci_col[i], int(bestmove_score_col[i]), int(ply[i]), game_result_col[i])
+            candidates.append((full_row_indexes[i], dedup_key, seen_in_batch,
+                               sf_bestmove1_uci_col[i], sf_bestmove2_uci_col[i], position))
+        return candidates, piece_orientation_hashes
+
     def process_csv_rows(self):
         positions = []
+        next_checkpoint_row = self.checkpoint.next_checkpoint_row if self.checkpoint else -1
         for row in self.infile:
             position = self.process_csv_row(row)
             self.num_positions += 1
             if position:
-                (fen, bestmove_uci, bestmove_score, ply, game_result) = position
-                positions.append({
-                    'fen': fen,
-                    'move': bestmove_uci,
-                    'score': bestmove_score,
-                    'ply': ply,
-                    'result': game_result,
-                })
+                positions.append(position)
             else:
                 self.num_positions_filtered_out += 1
+            if self.num_positions == next_checkpoint_row:
+                self.write_positions_to_file(positions)
+                positions = []
+                self.checkpoint.save(self)
+                next_checkpoint_row = self.checkpoint.next_checkpoint_row
             if self.write_positions_and_print_stats(positions, self.num_positions % 100000 == 0):
                 positions = []
         if self.write_positions_and_print_stats(positions, True):
             positions = []
 
+    def iter_csv_batches(self, batch_size):
+        ''' Lists of up to batch_size input rows, cut at every checkpoint row '''
+        batch_sizes = self.checkpoint.iter_batch_sizes(batch_size) if self.checkpoint else itertools.repeat(batch_size)
+        for num_rows in batch_sizes:
+            csv_rows = list(itertools.islice(self.infile, num_rows))
+            if not csv_rows:
+                return
+            yield csv_rows
+
+    def process_csv_batches(self, batch_size=100000):
+        for csv_rows in self.iter_csv_batches(batch_size):
+            self.write_positions_and_print_stats(self.process_csv_batch(csv_rows), True)
+
+    def process_csv_pipeline(self, batch_size=25000, queue_size=2):
+        ''' Filter batches like process_csv_batches, with reading and decompressing, filtering,
+            encoding the output, and writing it to the file each running in its own thread
+
+            A checkpoint is saved by the write stage, from a copy of the state the filter stage
+            took after the batch ending at the checkpoint row.
+        '''
+        binpack_writer = self.outfile if isinstance(self.outfile, BinpackWriter) else None
+        output_file = binpack_writer.outfile if binpack_writer else self.outfile
+        if binpack_writer:
+            # the writer encodes chunks into memory, for the write stage to copy to the file
+            binpack_writer.outfile = io.BytesIO()
+
+        def filter_batch(csv_rows):
+            num_positions = self.num_positions
+            positions = self.process_csv_batch(csv_rows)
+            if num_positions // 100000 != self.num_positions // 100000:
+                self.print_stats()
+            snapshot = None
+            if self.checkpoint is not None and self.checkpoint.is_due(self.num_positions):
+                snapshot = self.checkpoint.snapshot(self, copy=True)
+            return positions, snapshot
+
+        def encode_positions(batch):
+            positions, snapshot = batch
+            data = None
+            if not binpack_writer:
+                data = format_plain_records(positions) if positions else None
+            else:
+                for position in positions:
+                    binpack_writer.add_position(*position)
+                if snapshot is not None:
+                    # so the output up to the checkpoint is a complete .binpack
+                    binpack_writer.finish_stem()
+                    binpack_writer.write_chunk()
+                    binpack_writer.last_entry = None
+                data = binpack_writer.outfile.getvalue() or None
+                binpack_writer.outfile.seek(0)
+                binpack_writer.outfile.truncate()
+            if data or snapshot is not None:
+                return data, snapshot
+
+        def write_output(batch):
+            data, snapshot = batch
+            if data:
+                output_file.write(data)
+            if snapshot is None:
+                return
+            if binpack_writer:
+                output_file.flush()
+                os.fsync(output_file.fileno())
+                output_length = output_file.tell()
+            else:
+                output_length = output_file.flush()
+            self.checkpoint.write(*snapshot, output_length)
+
+        try:
+            run_pipeline('read', self.iter_csv_batches(batch_size), [
+                Stage('filter', filter_batch),
+                Stage('encode', encode_positions),
+                Stage('write', write_output),
+            ], queue_size)
+        finally:
+            if binpack_writer:
+                binpack_writer.finish_stem()
+                binpack_writer.write_chunk()
+                output_file.write(binpack_writer.outfile.getvalue())
+                binpack_writer.outfile = output_file
+        self.print_stats()
+
+    def process_csv_shards(self, num_workers, shard_size=100000):
+        ''' Filter with worker processes, each taking a shard of whole games
+
+            Workers apply the score-only rules and board checks. Shards are merged in input order,
+            where the dedup rule is applied against every piece orientation seen so far.
+            Checkpoints are saved after merging a shard, so shards are at most checkpoint_rows
+            rows plus the rest of the game they end in.
+        '''
+        if self.checkpoint is not None:
+            shard_size = min(shard_size, self.checkpoint.checkpoint_rows)
+        with multiprocessing.Pool(num_workers) as pool:
+            pending_shards = collections.deque()
+            for shard in self.iter_csv_shards(shard_size):
+                pending_shards.append(pool.apply_async(filter_csv_shard, (''.join(shard),)))
+                if len(pending_shards) >= 2 * num_workers:
+                    self.merge_csv_shard(*pending_shards.popleft().get())
+            while pending_shards:
+                self.merge_csv_shard(*pending_shards.popleft().get())
+
+    def iter_csv_shards(self, shard_size):
+        ''' Split the input rows into lists of about shard_size rows
+
+            Every shard after the first starts at a row where ply resets,
+            so a worker starting with prev_ply = -1 sees the same game starts.
+        '''
+        next_shard = []
+        while True:
+            shard = next_shard + list(itertools.islice(self.infile, shard_size))
+            next_shard = []
+            if not shard:
+                return
+            last_ply = -1
+            for csv_row in reversed(shard):
+                if csv_row.count(',') == 9:
+                    last_ply = int(csv_row[:csv_row.index(',')])
+                    break
+            for csv_row in self.infile:
+                if csv_row.count(',') == 9:
+                    ply = int(csv_row[:csv_row.index(',')])
+                    if ply < last_ply:
+                        next_shard = [csv_row]
+                        break
+                    last_ply = ply
+                shard.append(csv_row)
+            yield shard
+
+    def merge_csv_shard(self, counters, checked_candidates, piece_orientation_hashes):
+        for name, value in counters.items():
+            setattr(self, name, getattr(self, name) + value)
+        positions = []
+        for dedup_key, seen_in_shard, failed_check, position in checked_candidates:
+            if dedup_key is not None and (seen_in_shard or self.piece_orientations_seen.contains_hash(dedup_key)):
+                self.num_seen_before += 1
+            elif failed_check:
+                setattr(self, failed_check, getattr(self, failed_check) + 1)
+            else:
+                positions.append(position)
+        self.piece_orientations_seen.test_and_add_hashes(piece_orientation_hashes)
+        self.num_positions_filtered_out += counters['num_positions'] - len(positions)
+        self.write_positions_and_print_stats(positions, True)
+
     def write_positions_and_print_stats(self, positions, should_write) -> bool:
         if not should_write:
             return False
         self.print_stats()
+        wrote_positions = False
         if len(positions):
             self.write_positions_to_file(positions)
-            return True
-        return False
+            wrote_positions = True
+        if self.checkpoint is not None:
+            self.checkpoint.maybe_save(self)
+        return wrote_positions
 
     def write_positions_to_file(self, positions):
-        game_plain = ''
-        for position in positions:
-            game_plain += textwrap.dedent(f'''
-                fen {position['fen']}
-                score {position['score']}
-                move {str(position['move'])}
-                ply {position['ply']}
-                result {position['result']}
-                e''')
-        self.outfile.write(game_plain.strip() + "\n")
+        ''' Write (fen, move, score, ply, result) tuples to the output file '''
+        if isinstance(self.outfile, BinpackWriter):
+            for position in positions:
+                self.outfile.add_position(*position)
+            return
+        self.outfile.write_positions(positions)
 
     def print_stats(self):
         num_positions_after_filter = self.num_positions - self.num_positions_filtered_out
@@ -258,8 +591,207 @@ class PositionCsvIterator:
                 # sf bestmove2 cap/promos:   {self.num_sf_bestmove2_capture_promos:8d}
               # positions after filtering:   {num_positions_after_filter:8d}
                 % positions kept:            {num_positions_after_filter/self.num_positions*100:8.1f}
+              # seen set: {self.piece_orientations_seen.stats()}
         '''))
 
 
-input_filename = sys.argv[1]
-filter_csv_to_plain(input_filename)
+# rule thresholds a sweep can vary, with their v8 values
+SWEEP_PARAMETERS = {
+    'early_ply_skip': 36,
+    'one_good_move_equal': 100,
+    'one_good_move_losing': 150,
+    'different_sides_v6_score': 150,
+    'different_sides_v6_diff': 200,
+    'different_sides_v8_score': 100,
+    'different_sides_v8_diff': 150,
+}
+SWEEP_COUNTERS = [
+    'num_start_positions',
+    'num_early_plies',
+    'num_one_good_move',
+    'num_one_good_move_v8',
+    'num_bestmove_promos',
+    'num_seen_before',
+] + BOARD_CHECK_FAILURES
+
+def sweep_csv(input_filename, grid, output_filename=None, batch_size=100000, use_features=True):
+    ''' Count the positions v8 keeps for every combination of thresholds in grid, in one pass '''
+    print(f'Sweeping {input_filename} ...')
+    sweep = ParameterSweep(grid, PositionFeatures.for_input(input_filename) if use_features else None)
+    infile = iter_csv_rows(input_filename)
+    while True:
+        csv_rows = list(itertools.islice(infile, batch_size))
+        if not csv_rows:
+            break
+        sweep.process_csv_batch(csv_rows)
+        print(f'Processed {sweep.num_positions} positions')
+    if output_filename:
+        with open(output_filename, 'w') as outfile:
+            sweep.write_results(outfile)
+        print(f'Saved to {output_filename}')
+    else:
+        sweep.write_results(sys.stdout)
+
+
+class ParameterSweep:
+    ''' The v8 rules evaluated for a grid of thresholds at once
+
+        Every score rule is a (combinations x rows) mask, attributed in the same order as
+        process_csv_row. The dedup, promo and board checks don't depend on the thresholds,
+        so they're done once per row, and the board checks only for rows that some
+        combination keeps after the score rules, or read from features if given.
+    '''
+    def __init__(self, grid, features=None):
+        for name in grid:
+            if name not in SWEEP_PARAMETERS:
+                raise ValueError(f'unknown sweep parameter: {name}')
+        self.names = list(SWEEP_PARAMETERS)
+        self.combinations = list(itertools.product(*(grid.get(name, [SWEEP_PARAMETERS[name]]) for name in self.names)))
+        columns = np.array(self.combinations, dtype=np.int32)
+        # (combinations, 1) columns, to broadcast against rows
+        self.params = {name: columns[:, i:i + 1] for i, name in enumerate(self.names)}
+        self.counters = {name: np.zeros(len(self.combinations), dtype=np.int64) for name in SWEEP_COUNTERS}
+        self.num_kept = np.zeros(len(self.combinations), dtype=np.int64)
+        self.num_positions = 0
+        self.num_only_one_move = 0
+        self.prev_ply = -1
+        self.piece_orientations_seen = PositionHashSet()
+        self.features = features
+
+    def process_csv_batch(self, csv_rows):
+        split_rows = [csv_row.strip().split(",") for csv_row in csv_rows]
+        is_full_row = np.array([len(split_row) == 10 for split_row in split_rows])
+        full_rows = [split_row for split_row in split_rows if len(split_row) == 10]
+        batch_start = self.num_positions
+        self.num_positions += len(split_rows)
+        # only one possible move in the position
+        self.num_only_one_move += len(split_rows) - len(full_rows)
+        if not full_rows:
+            return
+        ply_col, fen_col, bestmove_uci_col, bestmove_score_col, game_result_col, \
+        sf_search_method_col, sf_bestmove1_uci_col, sf_bestmove1_score_col, \
+        sf_bestmove2_uci_col, sf_bestmove2_score_col = \
+            zip(*full_rows)
+        ply = np.array(ply_col).astype(np.int32)
+        sf_bestmove1_score = np.array(sf_bestmove1_score_col).astype(np.int32)
+        sf_bestmove2_score = np.array(sf_bestmove2_score_col).astype(np.int32)
+        abs_score1 = np.abs(sf_bestmove1_score)
+        abs_score2 = np.abs(sf_bestmove2_score)
+        abs_score_diff = np.abs(sf_bestmove1_score - sf_bestmove2_score)
+        favor_different_sides = (sf_bestmove1_score > 0) != (sf_bestmove2_score > 0)
+
+        # the threshold-independent parts of each row
+        prev_ply = np.empty_like(ply)
+        prev_ply[0] = self.prev_ply
+        prev_ply[1:] = ply[:-1]
+        self.prev_ply = int(ply[-1])
+        is_start_of_game = (prev_ply == -1) | (ply < prev_ply)
+        # every row is added to the seen set, even when filtered out earlier
+        seen_before = self.piece_orientations_seen.test_and_add_hashes(
+            placement_hashes([fen.split(' ')[0] for fen in fen_col]))
+        is_promo = np.char.str_len(np.array(bestmove_uci_col)) == 5
+        for i in np.flatnonzero(is_promo):
+            is_promo[i] = move_is_promo(bestmove_uci_col[i])
+
+        # each mask only holds rows that no earlier rule removed, like the elif chain of process_csv_row
+        p = self.params
+        remaining = np.broadcast_to(~is_start_of_game, (len(self.combinations), len(ply)))
+        is_early_ply = remaining & (ply <= p['early_ply_skip'])
+        remaining = remaining & ~is_early_ply
+        is_one_good_move = remaining & (
+            (abs_score1 < p['one_good_move_equal']) & (abs_score2 > p['one_good_move_losing']) |
+            (abs_score1 > p['one_good_move_losing']) & (abs_score2 < p['one_good_move_equal']))
+        remaining &= ~is_one_good_move
+        is_one_good_move_v6 = remaining & favor_different_sides & (
+            (abs_score1 > p['different_sides_v6_score']) & (abs_score2 > p['different_sides_v6_score']) |
+            (abs_score_diff > p['different_sides_v6_diff']))
+        remaining &= ~is_one_good_move_v6
+        is_one_good_move_v8 = remaining & favor_different_sides & (
+            (abs_score1 > p['different_sides_v8_score']) & (abs_score2 > p['different_sides_v8_score']) |
+            (abs_score_diff > p['different_sides_v8_diff']))
+        remaining &= ~is_one_good_move_v8
+        # rows where the 2 best move scores favor different sides skip the promo and dedup rules
+        is_bestmove_promo = remaining & ~favor_different_sides & is_promo
+        remaining &= ~is_bestmove_promo
+        is_seen_before = remaining & ~favor_different_sides & seen_before
+        remaining &= ~is_seen_before
+
+        # 0 if the row passes the board checks, else 1 + the index of the first failing check
+        if self.features:
+            board_check = self.features.board_check_failures(batch_start, self.num_positions)[is_full_row]
+        else:
+            board_check = np.zeros(len(ply), dtype=np.int8)
+            for i in np.flatnonzero(remaining.any(axis=0)):
+                failed_check = board_check_failure(fen_col[i], bestmove_uci_col[i],
+                                                   sf_bestmove1_uci_col[i], sf_bestmove2_uci_col[i])
+                if failed_check:
+                    board_check[i] = 1 + BOARD_CHECK_FAILURES.index(failed_check)
+
+        self.counters['num_start_positions'] += int(is_start_of_game.sum())
+        self.counters['num_early_plies'] += is_early_ply.sum(axis=1)
+        self.counters['num_one_good_move'] += is_one_good_move.sum(axis=1) + is_one_good_move_v6.sum(axis=1)
+        self.counters['num_one_good_move_v8'] += is_one_good_move_v8.sum(axis=1)
+        self.counters['num_bestmove_promos'] += is_bestmove_promo.sum(axis=1)
+        self.counters['num_seen_before'] += is_seen_before.sum(axis=1)
+        for i, counter in enumerate(BOARD_CHECK_FAILURES):
+            self.counters[counter] += (remaining & (board_check == 1 + i)).sum(axis=1)
+        self.num_kept += (remaining & (board_check == 0)).sum(axis=1)
+
+    def write_results(self, outfile):
+        ''' One csv line per combination of thresholds, with the positions each rule removes and the rest kept '''
+        outfile.write(','.join(self.names + ['num_positions', 'num_only_one_move'] + SWEEP_COUNTERS +
+                               ['num_positions_kept', 'percent_kept']) + '\n')
+        for i, combination in enumerate(self.combinations):
+            counts = [self.counters[name][i] for name in SWEEP_COUNTERS]
+            percent_kept = self.num_kept[i] / max(1, self.num_positions) * 100
+            outfile.write(','.join(map(str, list(combination) + [self.num_positions, self.num_only_one_move] +
+                                   counts + [self.num_kept[i], f'{percent_kept:.2f}'])) + '\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Filter a positions .csv or .csv.zst file into a .binpack')
+    parser.add_argument('input_csv_file')
+    parser.add_argument('--plain', action='store_true',
+                        help='write a .plain file instead of a .binpack')
+    parser.add_argument('--no-chain', action='store_true',
+                        help="don't chain consecutive positions of a game into one binpack stem")
+    parser.add_argument('--batch', action='store_true',
+                        help='apply the score-only rules to blocks of rows as NumPy arrays')
+    parser.add_argument('--compress', type=int, metavar='LEVEL',
+                        help='with --plain, write a zstd-compressed .plain.zst at this compression level')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='filter like --batch, reading, filtering, encoding and writing in separate threads')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes filtering shards of the input in parallel')
+    parser.add_argument('--bloom-capacity', type=int,
+                        help='de-duplicate with an approximate bloom filter sized for this many positions')
+    parser.add_argument('--bloom-fpr', type=float, default=0.001,
+                        help='target false positive rate of the bloom filter')
+    parser.add_argument('--bloom-file',
+                        help='keep the bloom filter bits in this file, to de-duplicate across runs')
+    parser.add_argument('--sweep', action='append', metavar='PARAMETER=VALUE,...',
+                        help='instead of filtering, count the positions kept for every combination of these '
+                             f'thresholds. Parameters: {", ".join(SWEEP_PARAMETERS)}')
+    parser.add_argument('--sweep-output',
+                        help='write the sweep results to this .csv file instead of stdout')
+    parser.add_argument('--no-features', action='store_true',
+                        help="parse boards for the board checks even if there's a .features file from features.py")
+    parser.add_argument('--checkpoint-rows', type=int, default=5_000_000,
+                        help='checkpoint every this many rows to resume from if the run is killed, 0 to not checkpoint. '
+                             'With --workers, at the end of the shard holding that row')
+    args = parser.parse_args()
+    if args.sweep:
+        grid = {}
+        for sweep in args.sweep:
+            name, values = sweep.split('=')
+            grid[name] = [int(value) for value in values.split(',')]
+        sweep_csv(args.input_csv_file, grid, args.sweep_output, use_features=not args.no_features)
+        sys.exit(0)
+    seen = None
+    if args.bloom_capacity:
+        seen = BloomFilter(args.bloom_capacity, args.bloom_fpr, args.bloom_file)
+    filter_csv_to_plain(args.input_csv_file, write_plain=args.plain, chain=not args.no_chain,
+                        batch=args.batch, workers=args.workers, seen=seen, use_features=not args.no_features,
+                        pipeline=args.pipeline, compression_level=args.compress,
+                        checkpoint_rows=args.checkpoint_rows)
+    if seen is not None:
+        seen.close()
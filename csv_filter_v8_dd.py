@@ -1,6 +1,5 @@
-import dbm
+import argparse
 from glob import glob
-import io
 import os
 import os.path
 from pprint import pprint
@@ -8,50 +7,61 @@ import re
 import sys
 import textwrap
 
-import chess
-import zstandard
+from binpack import BinpackWriter
+from csv_reader import iter_csv_rows
+from dedup import BloomFilter, SharedPositionHashSet
+from fast_board import FastBoard
 
-''' Iterate over positions .csv files and output .plain files
+''' Iterate over positions .csv files and output .binpack files
 '''
-if len(sys.argv) < 2:
-    print('Usage: ./csv_filter_v8_dd.py <input_csv_file_glob>')
-    sys.exit(0)
+parser = argparse.ArgumentParser(description='Filter and de-duplicate positions .csv files into .binpack files')
+parser.add_argument('input_csv_file_glob')
+parser.add_argument('--dedup-file', default='/dev/shm/positions-dedupe.hashset',
+                    help='positions seen by every run sharing this file are filtered out')
+parser.add_argument('--dedup-capacity', type=int,
+                    help='number of positions the dedup file is sized for, needed to create it: the rows of '
+                         'every run that shares it. The file takes 8 bytes per position, rounded up to a power '
+                         'of 2, so 1<<30 positions take 8 GiB of memory on /dev/shm')
+parser.add_argument('--bloom-capacity', type=int,
+                    help='de-duplicate with an approximate bloom filter sized for this many positions instead')
+parser.add_argument('--bloom-fpr', type=float, default=0.001,
+                    help='target false positive rate of the bloom filter')
+parser.add_argument('--bloom-file', default='/dev/shm/positions-dedupe.bloom',
+                    help='file the bloom filter bits are kept in between runs')
+args = parser.parse_args()
 
-
-piece_orientations_db = dbm.open('/dev/shm/positions-dedupe.gdbm', 'c')
+if args.bloom_capacity:
+    # smaller than the hash set, but only one filter process may use it at a time
+    piece_orientations_db = BloomFilter(args.bloom_capacity, args.bloom_fpr, args.bloom_file)
+else:
+    # safe to share between filter processes running in parallel
+    if args.dedup_capacity is None and not os.path.isfile(args.dedup_file):
+        parser.error(f'--dedup-capacity is needed to create {args.dedup_file}')
+    piece_orientations_db = SharedPositionHashSet(args.dedup_file, capacity=args.dedup_capacity)
 
 def move_is_promo(uci_move):
     return len(uci_move) == 5 and uci_move[-1] in ['n','b','r','q']
 
 def filter_csv_to_plain(input_filename):
-    ''' Filter a .csv or .csv.zst file '''
+    ''' Filter a .csv or .csv.zst file into a .binpack '''
     print(f'Processing {input_filename} ...')
     if input_filename.endswith(".csv.zst"):
-        output_filename = input_filename.replace('.csv.zst', '.csv.zst.filter-v8-dd.plain')
+        plain_filename = input_filename.replace('.csv.zst', '.csv.zst.filter-v8-dd.plain')
     else:
-        output_filename = input_filename.replace('.csv', '.csv.filter-v8-dd.plain')
+        plain_filename = input_filename.replace('.csv', '.csv.filter-v8-dd.plain')
+    output_filename = plain_filename.replace('.filter-v8-dd.plain', '.filter-v8-dd.binpack')
     # skip filtering if the .plain file already exists
-    if os.path.isfile(output_filename):
+    if os.path.isfile(plain_filename):
         print(f'Found .csv.zst.filter-v8-dd.plain file, doing nothing:')
-        print(output_filename)
+        print(plain_filename)
         return
-    elif os.path.isfile(output_filename.replace('.csv.zst.filter-v8-dd.plain', '.csv.zst.filter-v8-dd.binpack')):
+    elif os.path.isfile(output_filename):
         print(f'Found .csv.zst.filter-v8-dd.binpack file, doing nothing:')
-        print(output_filename.replace('.csv.zst.filter-v8-dd.plain', '.csv.zst.filter-v8-dd.binpack'))
+        print(output_filename)
         return
-    # filter the file
-    if input_filename.endswith(".csv.zst"):
-        with open(input_filename, 'rb') as compressed_infile, \
-             open(output_filename, 'w+') as outfile:
-            dctx = zstandard.ZstdDecompressor()
-            stream_reader = dctx.stream_reader(compressed_infile)
-            text_stream = io.TextIOWrapper(stream_reader, encoding='utf-8')
-            PositionCsvIterator(text_stream, outfile).process_csv_rows()
-    else:
-        output_filename = input_filename.replace('.csv', '.csv.filter-v6-dd.plain')
-        with open(input_filename, 'r') as infile, \
-             open(output_filename, 'w+') as outfile:
-            PositionCsvIterator(infile, outfile).process_csv_rows()
+    # filter the file, encoding binpack chunks directly
+    with BinpackWriter(output_filename) as outfile:
+        PositionCsvIterator(iter_csv_rows(input_filename), outfile).process_csv_rows()
     print(f'Saved to {output_filename}')
     return output_filename
 
@@ -107,8 +117,7 @@ class PositionCsvIterator:
         sf_bestmove2_score = int(sf_bestmove2_score)
 
         piece_orientation = fen.split(' ')[0]
-        seen_position_before = piece_orientation in piece_orientations_db
-        piece_orientations_db[piece_orientation] = '1'
+        seen_position_before = piece_orientations_db.test_and_add(piece_orientation)
 
         # assume the dataset is a sequence of training games
         # and that we're at the beginning of a training game when this is true
@@ -167,28 +176,25 @@ class PositionCsvIterator:
             self.num_seen_before += 1
             return
 
-        # filtering is slower when needing to initialize a board
-        b = chess.Board(fen)
+        # filtering is slower when needing to parse the board
+        b = FastBoard(fen)
         if b.is_check():
             # skip if in check since eval never gets called when in check
             self.num_in_check += 1
             return
         # filter out if provided move is a capture or promo
-        bestmove = chess.Move.from_uci(bestmove_uci)
-        if b.is_capture(bestmove):
+        if b.is_capture(bestmove_uci):
             self.num_bestmove_captures += 1
             return
-        elif b.is_en_passant(bestmove):
+        elif b.is_en_passant(bestmove_uci):
             self.num_bestmove_ep_captures += 1
             return
         # check if moves from SF search are captures or promos
-        sf_bestmove1 = chess.Move.from_uci(sf_bestmove1_uci)
-        if b.is_capture(sf_bestmove1) or move_is_promo(sf_bestmove1_uci):
+        if b.is_capture(sf_bestmove1_uci) or move_is_promo(sf_bestmove1_uci):
             # skip if SF search 1st best move is a capture or promo
             self.num_sf_bestmove1_capture_promos += 1
             return
-        sf_bestmove2 = chess.Move.from_uci(sf_bestmove2_uci)
-        if b.is_capture(sf_bestmove2) or move_is_promo(sf_bestmove2_uci):
+        if b.is_capture(sf_bestmove2_uci) or move_is_promo(sf_bestmove2_uci):
             # skip if SF search 2nd best move is a capture or promo
             self.num_sf_bestmove2_capture_promos += 1
             return
@@ -200,14 +206,7 @@ class PositionCsvIterator:
             position = self.process_csv_row(row)
             self.num_positions += 1
             if position:
-                (fen, bestmove_uci, bestmove_score, ply, game_result) = position
-                positions.append({
-                    'fen': fen,
-                    'move': bestmove_uci,
-                    'score': bestmove_score,
-                    'ply': ply,
-                    'result': game_result,
-                })
+                positions.append(position)
             else:
                 self.num_positions_filtered_out += 1
             if self.write_positions_and_print_stats(positions, self.num_positions % 100000 == 0):
@@ -225,16 +224,9 @@ class PositionCsvIterator:
         return False
 
     def write_positions_to_file(self, positions):
-        game_plain = ''
+        ''' Write (fen, move, score, ply, result) tuples to the output file '''
         for position in positions:
-            game_plain += textwrap.dedent(f'''
-                fen {position['fen']}
-                score {position['score']}
-                move {str(position['move'])}
-                ply {position['ply']}
-                result {position['result']}
-                e''')
-        self.outfile.write(game_plain.strip() + "\n")
+            self.outfile.add_position(*position)
 
     def print_stats(self):
         num_positions_after_filter = self.num_positions - self.num_positions_filtered_out
@@ -250,6 +242,7 @@ class PositionCsvIterator:
                 # one good move (v6):        {self.num_one_good_move:8d}
                 # one good move (v8):        {self.num_one_good_move_v8:8d}
                 # seen before:               {self.num_seen_before:8d}
+                # seen set:                  {piece_orientations_db.stats()}
                 # bestmove promos:           {self.num_bestmove_promos:8d}
                 # bestmove captures:         {self.num_bestmove_captures:8d}
                 # bestmove en passant:       {self.num_bestmove_ep_captures:8d}
@@ -261,13 +254,10 @@ class PositionCsvIterator:
 
 
 # prioritize position scores from later in time (ie. seen end of month vs. beginning of month)
-for file in sorted(glob(sys.argv[1]))[::-1]:
-    filtered_plain_filename = filter_csv_to_plain(file)
-    if filtered_plain_filename:
-        # convert the filtered .plain file into a .binpack
-        filtered_binpack_filename = filtered_plain_filename.replace('-v8-dd.plain', '-v8-dd.binpack')
-        print(os.system(f"stockfish convert {filtered_plain_filename} {filtered_binpack_filename}"))
-        os.system(f"rm {filtered_plain_filename}")
+for file in sorted(glob(args.input_csv_file_glob))[::-1]:
+    filtered_binpack_filename = filter_csv_to_plain(file)
+    if filtered_binpack_filename:
         # minimize the binpack, then remove the unminified version
         print(os.system(f"minimize_binpack.sh {filtered_binpack_filename}"))
         os.system(f"rm {filtered_binpack_filename}")
+piece_orientations_db.close()
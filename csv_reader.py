@@ -0,0 +1,174 @@
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import mmap
+import os
+import sys
+
+import zstandard
+
+''' Block-based reading of positions .csv and .csv.zst files
+
+Files are read and decompressed in large blocks into a reused buffer, and line boundaries
+are found on the bytes. Rows are decoded as ASCII a whole block at a time, instead of
+line by line through an io.TextIOWrapper.
+
+A .csv.zst made of several zstd frames (eg. by pzstd) has its frames decompressed
+in parallel threads. A single-frame file is decompressed as a stream.
+
+One thread is used unless the caller asks for more, or CSV_READER_THREADS is set, since the
+filter scripts usually run one process per core (eg. under xargs -P) already.
+'''
+
+# small enough for the rows split from a block to stay in cache
+DEFAULT_BLOCK_SIZE = 1 << 18
+# the number of threads decompressing frames of a .csv.zst when the caller doesn't say
+THREADS_ENV_VAR = 'CSV_READER_THREADS'
+
+ZSTD_MAGIC = 0xfd2fb528
+ZSTD_SKIPPABLE_MAGIC = 0x184d2a50
+
+def zstd_frame_bounds(data):
+    ''' (start, end) offsets of the zstd frames in data, found from the frame and block headers
+        without decompressing. Skippable frames are left out.
+    '''
+    frames = []
+    pos = 0
+    while pos < len(data):
+        magic = int.from_bytes(data[pos:pos + 4], 'little')
+        if magic & 0xfffffff0 == ZSTD_SKIPPABLE_MAGIC:
+            pos += 8 + int.from_bytes(data[pos + 4:pos + 8], 'little')
+            continue
+        if magic != ZSTD_MAGIC:
+            raise ValueError(f'not a zstd frame at offset {pos}')
+        start = pos
+        descriptor = data[pos + 4]
+        single_segment = descriptor >> 5 & 1
+        content_size_bytes = (single_segment, 2, 4, 8)[descriptor >> 6]
+        pos += 5 + (not single_segment) + (0, 1, 2, 4)[descriptor & 3] + content_size_bytes
+        while True:
+            block_header = int.from_bytes(data[pos:pos + 3], 'little')
+            block_type = block_header >> 1 & 3
+            pos += 3 + (1 if block_type == 1 else block_header >> 3)
+            if block_header & 1:
+                break
+        if descriptor >> 2 & 1:
+            pos += 4  # content checksum
+        frames.append((start, pos))
+    return frames
+
+
+def _decompress_frame(frame):
+    return zstandard.ZstdDecompressor().stream_reader(frame).readall()
+
+def iter_zstd_frames_threaded(data, frames, threads):
+    ''' Decompressed frames in order, with up to 2 * threads frames in flight '''
+    with ThreadPoolExecutor(threads) as executor:
+        pending = collections.deque()
+        for start, end in frames:
+            pending.append(executor.submit(_decompress_frame, data[start:end]))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_line_blocks(input_filename, block_size=DEFAULT_BLOCK_SIZE, threads=None):
+    ''' Yield memoryviews of consecutive whole lines, including their trailing newlines
+
+        The views point into a buffer that is reused for the next block,
+        so consume each block before asking for the next one.
+    '''
+    threads = threads or int(os.environ.get(THREADS_ENV_VAR) or 1)
+    if input_filename.endswith('.zst'):
+        with open(input_filename, 'rb') as f:
+            if not os.path.getsize(input_filename):
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                frames = zstd_frame_bounds(data)
+                if len(frames) > 1 and threads > 1:
+                    yield from _iter_frame_line_blocks(iter_zstd_frames_threaded(data, frames, threads), block_size)
+                    return
+                with zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True) as reader:
+                    yield from _iter_stream_line_blocks(reader, block_size)
+    else:
+        with open(input_filename, 'rb') as f:
+            yield from _iter_stream_line_blocks(f, block_size)
+
+def _iter_stream_line_blocks(reader, block_size):
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    end = 0
+    while True:
+        if end == len(buffer):
+            # a line longer than the buffer
+            buffer = buffer + bytes(len(buffer))
+            view = memoryview(buffer)
+        num_read = reader.readinto(view[end:])
+        if not num_read:
+            if end:
+                yield view[:end]
+            return
+        end += num_read
+        cut = buffer.rfind(b'\n', 0, end) + 1
+        if cut:
+            yield view[:cut]
+            # move the partial last line to the front of the buffer
+            buffer[:end - cut] = buffer[cut:end]
+            end -= cut
+
+def _iter_frame_line_blocks(decompressed_frames, block_size):
+    tail = b''
+    for decompressed in decompressed_frames:
+        view = memoryview(decompressed)
+        start = 0
+        if tail:
+            # finish the line cut off at the end of the previous frame
+            start = decompressed.find(b'\n') + 1
+            if not start:
+                tail += decompressed
+                continue
+            yield memoryview(tail + decompressed[:start])
+        while start < len(decompressed):
+            cut = decompressed.rfind(b'\n', start, start + block_size) + 1 or \
+                  decompressed.find(b'\n', start + block_size) + 1
+            if not cut:
+                break
+            yield view[start:cut]
+            start = cut
+        tail = decompressed[start:]
+    if tail:
+        yield memoryview(tail)
+
+
+def iter_csv_row_batches(input_filename, block_size=DEFAULT_BLOCK_SIZE, threads=None, start_row=0):
+    ''' Lists of csv rows as str, with their newlines, one list per block
+
+        The first start_row rows are skipped, whole blocks at a time by counting
+        their newlines instead of decoding them.
+    '''
+    for block in iter_line_blocks(input_filename, block_size, threads):
+        if start_row:
+            data = bytes(block)
+            num_rows = data.count(b'\n')
+            if num_rows <= start_row and data.endswith(b'\n'):
+                start_row -= num_rows
+                continue
+            rows = str(block, 'ascii').splitlines(keepends=True)[start_row:]
+            start_row = 0
+            yield rows
+            continue
+        yield str(block, 'ascii').splitlines(keepends=True)
+
+def iter_csv_rows(input_filename, block_size=DEFAULT_BLOCK_SIZE, threads=None, start_row=0):
+    ''' Drop-in for iterating over the lines of a text stream of the file '''
+    for rows in iter_csv_row_batches(input_filename, block_size, threads, start_row):
+        yield from rows
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: ./csv_reader.py <input.csv or input.csv.zst> ...')
+        sys.exit(0)
+    for input_filename in sys.argv[1:]:
+        num_rows = sum(len(rows) for rows in iter_csv_row_batches(input_filename))
+        print(f'{input_filename}: {num_rows} rows')
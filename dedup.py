@@ -0,0 +1,413 @@
+import fcntl
+import hashlib
+import math
+import os
+import struct
+
+import numpy as np
+
+''' Compact sets of seen positions for de-duplicating training data
+
+Positions are keyed by a 64-bit hash of their piece placement (the first FEN field).
+With billions of positions a hash collision may wrongly drop the odd position,
+which is an acceptable trade for ~8-16 bytes per position instead of 100+.
+'''
+
+def placement_hash(piece_orientation):
+    ''' Stable 64-bit hash of a piece placement string, never 0 '''
+    h = int.from_bytes(hashlib.blake2b(piece_orientation.encode(), digest_size=8).digest(), 'little')
+    return h or 1
+
+def placement_hashes(piece_orientations):
+    return np.fromiter((placement_hash(p) for p in piece_orientations), dtype=np.uint64,
+                       count=len(piece_orientations))
+
+
+def insert_unique_hashes(table, hashes):
+    ''' Vectorized linear probing of distinct hashes into a power-of-2 sized table
+
+        Returns which hashes were already present. The caller makes sure the table has room.
+    '''
+    capacity = len(table)
+    found = np.zeros(len(hashes), dtype=bool)
+    slots = (hashes & np.uint64(capacity - 1)).astype(np.int64)
+    pending = np.arange(len(hashes))
+    while pending.size:
+        pending_hashes = hashes[pending]
+        pending_slots = slots[pending]
+        current = table[pending_slots]
+        is_found = current == pending_hashes
+        found[pending[is_found]] = True
+        is_empty = current == 0
+        done = is_found
+        empty_index = np.flatnonzero(is_empty)
+        if empty_index.size:
+            # the first hash probing an empty slot claims it, the others retry the slot next round
+            _, first = np.unique(pending_slots[empty_index], return_index=True)
+            claimed = empty_index[first]
+            table[pending_slots[claimed]] = pending_hashes[claimed]
+            done = done.copy()
+            done[claimed] = True
+        advance = ~done & ~is_empty
+        slots[pending[advance]] = (pending_slots[advance] + 1) & (capacity - 1)
+        pending = pending[~done]
+    return found
+
+def contains_in_table(table, h):
+    mask = len(table) - 1
+    slot = h & mask
+    while True:
+        current = table.item(slot)
+        if current == h:
+            return True
+        elif current == 0:
+            return False
+        slot = (slot + 1) & mask
+
+def test_and_add_to_table(table, h):
+    ''' Insert one hash into a power-of-2 sized table, returning True if it was already present '''
+    mask = len(table) - 1
+    slot = h & mask
+    while True:
+        current = table.item(slot)
+        if current == h:
+            return True
+        elif current == 0:
+            table[slot] = h
+            return False
+        slot = (slot + 1) & mask
+
+
+class PositionHashSet:
+    ''' Open-addressing hash table of 64-bit placement hashes in a NumPy array
+
+        Drop-in for the `piece_orientation in seen` / `seen.add(piece_orientation)` pattern
+        on a Python set of strings. The table doubles when it gets fuller than max_load_factor.
+    '''
+    def __init__(self, capacity=1 << 20, max_load_factor=0.7):
+        self.capacity = 1 << max(capacity - 1, 1).bit_length()
+        self.max_load_factor = max_load_factor
+        self.table = np.zeros(self.capacity, dtype=np.uint64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, piece_orientation):
+        return self.contains_hash(placement_hash(piece_orientation))
+
+    def add(self, piece_orientation):
+        self.test_and_add_hash(placement_hash(piece_orientation))
+
+    def test_and_add(self, piece_orientation):
+        ''' Add a piece placement, returning True if it was seen before '''
+        return self.test_and_add_hash(placement_hash(piece_orientation))
+
+    def update(self, piece_orientations):
+        self.test_and_add_hashes(placement_hashes(piece_orientations))
+
+    @property
+    def load_factor(self):
+        return self.size / self.capacity
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+    def contains_hash(self, h):
+        return contains_in_table(self.table, h)
+
+    def test_and_add_hash(self, h):
+        if (self.size + 1) > self.capacity * self.max_load_factor:
+            self.grow(self.size + 1)
+        seen_before = test_and_add_to_table(self.table, h)
+        if not seen_before:
+            self.size += 1
+        return seen_before
+
+    def test_and_add_hashes(self, hashes):
+        ''' Add an array of hashes in order, returning which of them were seen before '''
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        seen_before = np.ones(len(hashes), dtype=bool)
+        unique_hashes, first_index = np.unique(hashes, return_index=True)
+        seen_before[first_index] = self._insert_unique(unique_hashes)
+        return seen_before
+
+    def grow(self, min_size):
+        capacity = self.capacity
+        while min_size > capacity * self.max_load_factor:
+            capacity *= 2
+        old_table = self.table
+        self.capacity = capacity
+        self.table = np.zeros(capacity, dtype=np.uint64)
+        self.size = 0
+        self._insert_unique(old_table[old_table != 0])
+
+    def _insert_unique(self, hashes):
+        ''' Insert distinct hashes, returning which ones were already present '''
+        if (self.size + len(hashes)) > self.capacity * self.max_load_factor:
+            self.grow(self.size + len(hashes))
+        found = insert_unique_hashes(self.table, hashes)
+        self.size += len(hashes) - int(found.sum())
+        return found
+
+    def checkpoint_state(self):
+        ''' Arrays holding the whole set, for restore_state '''
+        return {'table': self.table, 'size': np.array(self.size)}
+
+    def restore_state(self, state):
+        self.table = state['table'].copy()
+        self.capacity = len(self.table)
+        self.size = int(state['size'])
+
+    def stats(self):
+        return f'{self.size} positions, load factor {self.load_factor:.2f}, {self.nbytes / 1024 / 1024:.1f} MiB'
+
+
+DEDUP_FILE_MAGIC = b'NNUEDDUP'
+DEDUP_FILE_VERSION = 1
+_DEDUP_FILE_HEADER = struct.Struct('<8sIIQ')
+DEDUP_FILE_HEADER_SIZE = 4096
+
+class SharedPositionHashSet:
+    ''' Memory-mapped hash set file of placement hashes that many processes can share
+
+        The file is split into num_shards fixed-size open-addressing tables, picked by the top bits
+        of a hash. Each shard starts with its uint64 count, and a test-and-insert holds a POSIX
+        record lock on just that shard, so concurrent filter processes rarely wait on each other.
+        Everything lives in the file, so the set survives restarts and can be reused across runs.
+        The capacity is fixed when the file is created, and has to be given then. The file takes
+        8 bytes per position of capacity, rounded up to a power of 2 per shard.
+    '''
+    def __init__(self, filename, capacity=None, num_shards=1024, max_load_factor=0.9):
+        if capacity is None and not os.path.isfile(filename):
+            raise ValueError(f'{filename} does not exist, and creating it needs a capacity')
+        self.filename = filename
+        self.max_load_factor = max_load_factor
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, DEDUP_FILE_HEADER_SIZE, 0)
+        try:
+            if os.fstat(self.fd).st_size == 0:
+                num_shards = 1 << max(num_shards - 1, 1).bit_length()
+                shard_capacity = 1 << max(capacity // num_shards - 1, 1).bit_length()
+                os.ftruncate(self.fd, DEDUP_FILE_HEADER_SIZE + num_shards * (shard_capacity + 1) * 8)
+                os.pwrite(self.fd, _DEDUP_FILE_HEADER.pack(
+                    DEDUP_FILE_MAGIC, DEDUP_FILE_VERSION, num_shards, shard_capacity), 0)
+            magic, version, num_shards, shard_capacity = _DEDUP_FILE_HEADER.unpack(
+                os.pread(self.fd, _DEDUP_FILE_HEADER.size, 0))
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, DEDUP_FILE_HEADER_SIZE, 0)
+        if magic != DEDUP_FILE_MAGIC or version != DEDUP_FILE_VERSION:
+            raise ValueError(f'{filename} is not a version {DEDUP_FILE_VERSION} dedup file')
+        self.num_shards = num_shards
+        self.shard_capacity = shard_capacity
+        self.shard_shift = 64 - (num_shards.bit_length() - 1)
+        self.shard_nbytes = (shard_capacity + 1) * 8
+        self.shards = np.memmap(filename, dtype=np.uint64, mode='r+', offset=DEDUP_FILE_HEADER_SIZE,
+                                shape=(num_shards, shard_capacity + 1))
+
+    def __len__(self):
+        return int(self.shards[:, 0].sum())
+
+    def __contains__(self, piece_orientation):
+        h = placement_hash(piece_orientation)
+        with self.locked_shard(h >> self.shard_shift) as shard:
+            return contains_in_table(shard[1:], h)
+
+    def add(self, piece_orientation):
+        self.test_and_add_hash(placement_hash(piece_orientation))
+
+    def test_and_add(self, piece_orientation):
+        ''' Add a piece placement, returning True if any process added it before '''
+        return self.test_and_add_hash(placement_hash(piece_orientation))
+
+    def update(self, piece_orientations):
+        self.test_and_add_hashes(placement_hashes(piece_orientations))
+
+    @property
+    def load_factor(self):
+        return len(self) / (self.num_shards * self.shard_capacity)
+
+    @property
+    def nbytes(self):
+        return self.shards.nbytes
+
+    def locked_shard(self, shard_index):
+        return _LockedShard(self, shard_index)
+
+    def reserve(self, shard, num_hashes):
+        if shard.item(0) + num_hashes > self.shard_capacity * self.max_load_factor:
+            raise RuntimeError(f'Dedup file {self.filename} is full, recreate it with a larger capacity')
+
+    def test_and_add_hash(self, h):
+        with self.locked_shard(h >> self.shard_shift) as shard:
+            self.reserve(shard, 1)
+            seen_before = test_and_add_to_table(shard[1:], h)
+            if not seen_before:
+                shard[0] += 1
+            return seen_before
+
+    def test_and_add_hashes(self, hashes):
+        ''' Add an array of hashes in order, returning which of them were seen before '''
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        seen_before = np.ones(len(hashes), dtype=bool)
+        unique_hashes, first_index = np.unique(hashes, return_index=True)
+        shard_indexes = (unique_hashes >> np.uint64(self.shard_shift)).astype(np.int64)
+        # unique_hashes is sorted, so every shard's hashes are contiguous
+        shard_starts = np.flatnonzero(np.diff(shard_indexes, prepend=-1))
+        shard_ends = np.append(shard_starts[1:], len(unique_hashes))
+        for start, end in zip(shard_starts, shard_ends):
+            with self.locked_shard(int(shard_indexes[start])) as shard:
+                self.reserve(shard, end - start)
+                found = insert_unique_hashes(shard[1:], unique_hashes[start:end])
+                shard[0] += np.uint64(end - start - int(found.sum()))
+            seen_before[first_index[start:end]] = found
+        return seen_before
+
+    def stats(self):
+        return f'{len(self)} positions, load factor {self.load_factor:.2f}, {self.nbytes / 1024 / 1024:.1f} MiB file'
+
+    def close(self):
+        self.shards.flush()
+        del self.shards
+        os.close(self.fd)
+
+
+class _LockedShard:
+    def __init__(self, hash_set, shard_index):
+        self.hash_set = hash_set
+        self.shard_index = shard_index
+        self.offset = DEDUP_FILE_HEADER_SIZE + shard_index * hash_set.shard_nbytes
+
+    def __enter__(self):
+        fcntl.lockf(self.hash_set.fd, fcntl.LOCK_EX, self.hash_set.shard_nbytes, self.offset)
+        return self.hash_set.shards[self.shard_index]
+
+    def __exit__(self, *exc_info):
+        fcntl.lockf(self.hash_set.fd, fcntl.LOCK_UN, self.hash_set.shard_nbytes, self.offset)
+
+
+BLOOM_FILE_MAGIC = b'NNUEBLOM'
+_BLOOM_FILE_HEADER = struct.Struct('<8sQQQd')
+BLOOM_FILE_HEADER_SIZE = 4096
+_GOLDEN_RATIO_64 = np.uint64(0x9e3779b97f4a7c15)
+
+class BloomFilter:
+    ''' Approximate set of placement hashes with a fixed size and false positive rate
+
+        Sized up front for capacity positions at target_fpr. A false positive drops a position
+        that was never seen, so the estimated rate is reported as the filter fills up.
+        With a filename, the bit array is a memory-mapped file that persists between runs.
+        Loading an existing file keeps the size it was created with.
+        Not safe to share between concurrent processes.
+    '''
+    def __init__(self, capacity, target_fpr=0.001, filename=None):
+        num_bits = math.ceil(-capacity * math.log(target_fpr) / math.log(2) ** 2)
+        num_bits = (num_bits + 63) // 64 * 64
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        self.filename = filename
+        self.num_added = 0
+        if filename is None:
+            self.bits = np.zeros(num_bits // 8, dtype=np.uint8)
+        else:
+            if not os.path.isfile(filename):
+                with open(filename, 'wb') as f:
+                    f.write(_BLOOM_FILE_HEADER.pack(BLOOM_FILE_MAGIC, num_bits, num_hashes, 0, target_fpr)
+                            .ljust(BLOOM_FILE_HEADER_SIZE, b'\0'))
+                    f.truncate(BLOOM_FILE_HEADER_SIZE + num_bits // 8)
+            with open(filename, 'rb') as f:
+                magic, num_bits, num_hashes, self.num_added, target_fpr = \
+                    _BLOOM_FILE_HEADER.unpack(f.read(_BLOOM_FILE_HEADER.size))
+            if magic != BLOOM_FILE_MAGIC:
+                raise ValueError(f'{filename} is not a bloom filter file')
+            self.bits = np.memmap(filename, dtype=np.uint8, mode='r+', offset=BLOOM_FILE_HEADER_SIZE,
+                                  shape=(num_bits // 8,))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.target_fpr = target_fpr
+
+    def __len__(self):
+        return self.num_added
+
+    def __contains__(self, piece_orientation):
+        return self.contains_hash(placement_hash(piece_orientation))
+
+    def add(self, piece_orientation):
+        self.test_and_add_hash(placement_hash(piece_orientation))
+
+    def test_and_add(self, piece_orientation):
+        ''' Add a piece placement, returning True if it was probably seen before '''
+        return self.test_and_add_hash(placement_hash(piece_orientation))
+
+    def update(self, piece_orientations):
+        self.test_and_add_hashes(placement_hashes(piece_orientations))
+
+    @property
+    def estimated_fpr(self):
+        return (1 - math.exp(-self.num_hashes * self.num_added / self.num_bits)) ** self.num_hashes
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def bit_indexes(self, h):
+        # double hashing, with a second hash derived from the first
+        h2 = ((h * 0x9e3779b97f4a7c15) & 0xffffffffffffffff) | 1
+        return [((h + i * h2) & 0xffffffffffffffff) % self.num_bits for i in range(self.num_hashes)]
+
+    def contains_hash(self, h):
+        bits = self.bits
+        return all(bits.item(i >> 3) >> (i & 7) & 1 for i in self.bit_indexes(h))
+
+    def test_and_add_hash(self, h):
+        bits = self.bits
+        seen_before = True
+        for i in self.bit_indexes(h):
+            byte = bits.item(i >> 3)
+            if not byte >> (i & 7) & 1:
+                bits[i >> 3] = byte | (1 << (i & 7))
+                seen_before = False
+        if not seen_before:
+            self.num_added += 1
+        return seen_before
+
+    def test_and_add_hashes(self, hashes):
+        ''' Add an array of hashes in order, returning which of them were probably seen before '''
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        seen_before = np.ones(len(hashes), dtype=bool)
+        unique_hashes, first_index = np.unique(hashes, return_index=True)
+        h2 = (unique_hashes * _GOLDEN_RATIO_64) | np.uint64(1)
+        num_bits = np.uint64(self.num_bits)
+        all_set = np.ones(len(unique_hashes), dtype=bool)
+        bit_indexes = []
+        for i in range(self.num_hashes):
+            bit_index = (unique_hashes + np.uint64(i) * h2) % num_bits
+            all_set &= (self.bits[bit_index >> np.uint64(3)] >> (bit_index & np.uint64(7)).astype(np.uint8)) & 1 == 1
+            bit_indexes.append(bit_index)
+        for bit_index in bit_indexes:
+            np.bitwise_or.at(self.bits, bit_index >> np.uint64(3),
+                             np.left_shift(1, (bit_index & np.uint64(7)).astype(np.uint8)).astype(np.uint8))
+        seen_before[first_index] = all_set
+        self.num_added += int((~all_set).sum())
+        return seen_before
+
+    def checkpoint_state(self):
+        ''' Arrays holding the whole filter, for restore_state '''
+        return {'bits': self.bits, 'num_added': np.array(self.num_added)}
+
+    def restore_state(self, state):
+        if len(state['bits']) != len(self.bits):
+            raise ValueError('the checkpointed bloom filter has a different size')
+        self.bits[:] = state['bits']
+        self.num_added = int(state['num_added'])
+
+    def stats(self):
+        return f'{self.num_added} positions, estimated false positive rate {self.estimated_fpr:.2e}, ' \
+               f'{self.nbytes / 1024 / 1024:.1f} MiB'
+
+    def close(self):
+        if self.filename is not None:
+            self.bits.flush()
+            with open(self.filename, 'r+b') as f:
+                f.write(_BLOOM_FILE_HEADER.pack(BLOOM_FILE_MAGIC, self.num_bits, self.num_hashes,
+                                                self.num_added, self.target_fpr))
@@ -5,9 +5,15 @@ import re
 import sys
 
 import chess
+import numpy as np
 import zstandard
 
+from columnar import ColumnarPositions, compress_fen, num_pieces
+from dedup import PositionHashSet
+
 ''' Iterate over positions .csv files and output .plain files
+
+A .cols file (columnar.py), or the one next to a .csv, is read a block of rows at a time instead.
 '''
 if len(sys.argv) != 2:
     print('Usage: ./dupe_count_csv.py <input_csv_file>')
@@ -51,7 +57,8 @@ num_pieces_gt7 = 0
 num_unique_num_pieces_lteq7 = 0
 num_pieces_lteq7 = 0
 
-piece_orientations_seen = set()
+piece_orientations_seen = PositionHashSet()
+STANDARD_START_BOARD = np.frombuffer(compress_fen(chess.STARTING_FEN), dtype=np.uint8)
 
 def move_is_promo(uci_move):
     return len(uci_move) == 5 and uci_move[-1] in ['n','b','r','q']
@@ -120,37 +127,84 @@ def process_csv_rows(infile):
         piece_orientations_seen.add(piece_orientation)
         num_positions += 1
         if (num_positions % 1000000 == 0) and num_positions > 0:
-            print(f"Processed {num_positions} positions")
-            print(f'  # standard games:           {num_standard_games}')
-            print(f'  # non-standard games:       {num_non_standard_games}')
-            print(f'  # positions:                {num_positions}')
-            print(f'    # unique:                 {num_unique_piece_orientations}')
-            print(f'    % unique:                 {num_unique_piece_orientations / num_positions * 100:.2f}')
-            print(f'  # positions ply > 30:       {num_ply_gt_30}')
-            print(f'    # unique:                 {num_unique_gt_30}')
-            print(f'    % unique:                 {num_unique_gt_30 / num_ply_gt_30 * 100:.2f}')
-            print(f'  # positions ply > 28:       {num_ply_gt_28}')
-            print(f'    # unique:                 {num_unique_gt_28}')
-            print(f'    % unique:                 {num_unique_gt_28 / num_ply_gt_28 * 100:.2f}')
-            print(f'  # positions ply > 24:       {num_ply_gt_24}')
-            print(f'    # unique:                 {num_unique_gt_24}')
-            print(f'    % unique:                 {num_unique_gt_24 / num_ply_gt_24 * 100:.2f}')
-            print(f'  # positions ply > 20:       {num_ply_gt_20}')
-            print(f'    # unique:                 {num_unique_gt_20}')
-            print(f'    % unique:                 {num_unique_gt_20 / num_ply_gt_20 * 100:.2f}')
-            print(f'  # positions ply <= 20:      {num_ply_lteq_20}')
-            print(f'    # unique:                 {num_unique_lteq_20}')
-            print(f'    % unique:                 {num_unique_lteq_20 / num_ply_lteq_20 * 100:.2f}')
-            print(f'  # positions pieces  > 7     {num_pieces_gt7}')
-            print(f'    # unique:                 {num_unique_num_pieces_gt7}')
-            print(f'    % unique:                 {num_unique_num_pieces_gt7 / num_pieces_gt7 * 100:.2f}')
-            print(f'  # positions pieces <= 7     {num_pieces_lteq7}')
-            print(f'    # unique:                 {num_unique_num_pieces_lteq7}')
-            print(f'    % unique:                 {num_unique_num_pieces_lteq7 / num_pieces_lteq7 * 100:.2f}')
+            print_progress()
+
+def process_columnar_blocks(columns):
+    ''' Same counts as process_csv_rows from the columns of a .cols file '''
+    global num_games, num_positions, num_standard_games, num_non_standard_games, num_unique_piece_orientations, \
+           num_ply_gt_30, num_unique_gt_30, \
+           num_ply_gt_28, num_unique_gt_28, \
+           num_ply_gt_24, num_unique_gt_24, \
+           num_ply_gt_20, num_unique_gt_20, \
+           num_ply_lteq_20, num_unique_lteq_20, \
+           num_unique_num_pieces_gt7, num_pieces_gt7, \
+           num_unique_num_pieces_lteq7, num_pieces_lteq7
+    for block in columns.iter_blocks():
+        ply = block['ply']
+        is_game_start = ply == 0
+        is_standard_start = is_game_start & (block['board'] == STANDARD_START_BOARD).all(axis=1)
+        num_games += int(is_game_start.sum())
+        num_standard_games += int(is_standard_start.sum())
+        num_non_standard_games += int((is_game_start & ~is_standard_start).sum())
+        # .cols placement hashes are the ones PositionHashSet.add uses for placement strings
+        not_seen_before = ~piece_orientations_seen.test_and_add_hashes(block['placement_hash'])
+        pieces = num_pieces(block['board'])
+        num_unique_num_pieces_gt7 += int((not_seen_before & (pieces > 7)).sum())
+        num_pieces_gt7 += int((pieces > 7).sum())
+        num_unique_num_pieces_lteq7 += int((not_seen_before & (pieces <= 7)).sum())
+        num_pieces_lteq7 += int((pieces <= 7).sum())
+        num_unique_gt_30 += int((not_seen_before & (ply > 30)).sum())
+        num_ply_gt_30 += int((ply > 30).sum())
+        num_unique_gt_28 += int((not_seen_before & (ply > 28)).sum())
+        num_ply_gt_28 += int((ply > 28).sum())
+        num_unique_gt_24 += int((not_seen_before & (ply > 24)).sum())
+        num_ply_gt_24 += int((ply > 24).sum())
+        num_unique_gt_20 += int((not_seen_before & (ply > 20)).sum())
+        num_ply_gt_20 += int((ply > 20).sum())
+        num_unique_lteq_20 += int((not_seen_before & (ply <= 20)).sum())
+        num_ply_lteq_20 += int((ply <= 20).sum())
+        num_unique_piece_orientations += int(not_seen_before.sum())
+        prev_num_positions = num_positions
+        num_positions += len(ply)
+        if num_positions // 1000000 > prev_num_positions // 1000000:
+            print_progress()
+
+def print_progress():
+    print(f"Processed {num_positions} positions")
+    print(f'  # standard games:           {num_standard_games}')
+    print(f'  # non-standard games:       {num_non_standard_games}')
+    print(f'  # positions:                {num_positions}')
+    print(f'    # unique:                 {num_unique_piece_orientations}')
+    print(f'    % unique:                 {num_unique_piece_orientations / num_positions * 100:.2f}')
+    print(f'  # positions ply > 30:       {num_ply_gt_30}')
+    print(f'    # unique:                 {num_unique_gt_30}')
+    print(f'    % unique:                 {num_unique_gt_30 / num_ply_gt_30 * 100:.2f}')
+    print(f'  # positions ply > 28:       {num_ply_gt_28}')
+    print(f'    # unique:                 {num_unique_gt_28}')
+    print(f'    % unique:                 {num_unique_gt_28 / num_ply_gt_28 * 100:.2f}')
+    print(f'  # positions ply > 24:       {num_ply_gt_24}')
+    print(f'    # unique:                 {num_unique_gt_24}')
+    print(f'    % unique:                 {num_unique_gt_24 / num_ply_gt_24 * 100:.2f}')
+    print(f'  # positions ply > 20:       {num_ply_gt_20}')
+    print(f'    # unique:                 {num_unique_gt_20}')
+    print(f'    % unique:                 {num_unique_gt_20 / num_ply_gt_20 * 100:.2f}')
+    print(f'  # positions ply <= 20:      {num_ply_lteq_20}')
+    print(f'    # unique:                 {num_unique_lteq_20}')
+    print(f'    % unique:                 {num_unique_lteq_20 / num_ply_lteq_20 * 100:.2f}')
+    print(f'  # positions pieces  > 7     {num_pieces_gt7}')
+    print(f'    # unique:                 {num_unique_num_pieces_gt7}')
+    print(f'    % unique:                 {num_unique_num_pieces_gt7 / num_pieces_gt7 * 100:.2f}')
+    print(f'  # positions pieces <= 7     {num_pieces_lteq7}')
+    print(f'    # unique:                 {num_unique_num_pieces_lteq7}')
+    print(f'    % unique:                 {num_unique_num_pieces_lteq7 / num_pieces_lteq7 * 100:.2f}')
+
 
 for input_filename in glob(input_filename_glob):
     print(f'Processing {input_filename} ...')
-    if input_filename.endswith(".csv.zst"):
+    columns = ColumnarPositions.for_file(input_filename)
+    if columns:
+        process_columnar_blocks(columns)
+    elif input_filename.endswith(".csv.zst"):
         with open(input_filename, 'rb') as compressed_infile:
             dctx = zstandard.ZstdDecompressor()
             stream_reader = dctx.stream_reader(compressed_infile)
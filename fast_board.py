@@ -0,0 +1,134 @@
+import sys
+
+import chess
+
+from bitboards import (
+    WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, PIECE_SYMBOLS,
+    KNIGHT_ATTACKS, KING_ATTACKS, PAWN_ATTACKS, bishop_attacks, rook_attacks, lsb,
+)
+
+''' Fast check and capture classification straight from a FEN
+
+Only the piece placement, side to move and en passant fields are parsed, into bitboards.
+Answers match python-chess's Board.is_check(), is_capture() and is_en_passant()
+for the same FEN and UCI move, at a fraction of the cost of building a chess.Board.
+'''
+
+# a FEN rank string -> (piece, bits on the first rank) pairs, filled in as new ranks are seen
+_rank_pieces = {}
+
+def _parse_rank(rank_str):
+    pieces = []
+    file = 0
+    for c in rank_str:
+        if c.isdigit():
+            file += int(c)
+        else:
+            pieces.append((PIECE_SYMBOLS.index(c), 1 << file))
+            file += 1
+    _rank_pieces[rank_str] = pieces
+    return pieces
+
+
+def _square_index(name):
+    file = ord(name[0]) - 97
+    rank = ord(name[1]) - 49
+    if not (0 <= file < 8 and 0 <= rank < 8):
+        raise ValueError(f'invalid square: {name}')
+    return rank * 8 + file
+
+
+class FastBoard:
+    __slots__ = ('pieces', 'colors', 'occupied', 'turn', 'ep_square', '_is_check')
+
+    def __init__(self, fen):
+        fields = fen.split(' ')
+        pieces = [0] * 12
+        shift = 56
+        for rank_str in fields[0].split('/'):
+            rank_pieces = _rank_pieces.get(rank_str) or _parse_rank(rank_str)
+            for piece, bits in rank_pieces:
+                pieces[piece] |= bits << shift
+            shift -= 8
+        self.pieces = pieces
+        self.colors = [
+            pieces[0] | pieces[2] | pieces[4] | pieces[6] | pieces[8] | pieces[10],
+            pieces[1] | pieces[3] | pieces[5] | pieces[7] | pieces[9] | pieces[11],
+        ]
+        self.occupied = self.colors[WHITE] | self.colors[BLACK]
+        self.turn = BLACK if len(fields) > 1 and fields[1] == 'b' else WHITE
+        self.ep_square = _square_index(fields[3]) if len(fields) > 3 and fields[3] != '-' else None
+        self._is_check = None
+
+    def is_check(self):
+        ''' Is the side to move in check, worked out once per board '''
+        if self._is_check is None:
+            self._is_check = self._king_attacked()
+        return self._is_check
+
+    def _king_attacked(self):
+        us = self.turn
+        them = us ^ 1
+        king = self.pieces[KING * 2 + us]
+        if not king:
+            return False
+        sq = lsb(king)
+        p = self.pieces
+        if PAWN_ATTACKS[us][sq] & p[PAWN * 2 + them] or \
+           KNIGHT_ATTACKS[sq] & p[KNIGHT * 2 + them] or \
+           KING_ATTACKS[sq] & p[KING * 2 + them]:
+            return True
+        queens = p[QUEEN * 2 + them]
+        return bool(bishop_attacks(sq, self.occupied) & (p[BISHOP * 2 + them] | queens) or
+                    rook_attacks(sq, self.occupied) & (p[ROOK * 2 + them] | queens))
+
+    def is_en_passant(self, uci_move):
+        from_sq, to_sq = _square_index(uci_move[0:2]), _square_index(uci_move[2:4])
+        return self.ep_square == to_sq and \
+               bool((self.pieces[PAWN * 2 + WHITE] | self.pieces[PAWN * 2 + BLACK]) >> from_sq & 1) and \
+               abs(to_sq - from_sq) in (7, 9) and \
+               not self.occupied >> to_sq & 1
+
+    def is_capture(self, uci_move):
+        ''' Does the UCI move capture, including en passant '''
+        from_sq, to_sq = _square_index(uci_move[0:2]), _square_index(uci_move[2:4])
+        touched = (1 << from_sq) ^ (1 << to_sq)
+        return bool(touched & self.colors[self.turn ^ 1]) or self.is_en_passant(uci_move)
+
+    def is_promotion(self, uci_move):
+        return len(uci_move) == 5 and uci_move[4] in 'nbrq'
+
+
+def verify_plain_file(input_filename):
+    ''' Compare FastBoard against python-chess for every fen/move record in a .plain file '''
+    num_positions = 0
+    num_mismatches = 0
+    fen = None
+    with open(input_filename, 'r') as infile:
+        for row in infile:
+            if row.startswith('fen '):
+                fen = row[4:].strip()
+            elif row.startswith('move ') and fen:
+                uci_move = row[5:].strip()
+                try:
+                    move = chess.Move.from_uci(uci_move)
+                except ValueError:
+                    continue
+                b = chess.Board(fen)
+                fast_board = FastBoard(fen)
+                expected = (b.is_check(), b.is_capture(move), b.is_en_passant(move))
+                actual = (fast_board.is_check(), fast_board.is_capture(uci_move), fast_board.is_en_passant(uci_move))
+                num_positions += 1
+                if expected != actual:
+                    num_mismatches += 1
+                    print(f'Mismatch: {fen} {uci_move} python-chess: {expected} fast board: {actual}')
+    print(f'{input_filename}: {num_positions} positions, {num_mismatches} mismatches')
+    return num_mismatches
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: ./fast_board.py <input.plain> ...')
+        sys.exit(0)
+    num_mismatches = sum(verify_plain_file(input_filename) for input_filename in sys.argv[1:])
+    sys.exit(1 if num_mismatches else 0)
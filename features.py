@@ -0,0 +1,194 @@
+import multiprocessing
+import os
+import os.path
+import struct
+import sys
+
+import numpy as np
+
+from csv_reader import iter_csv_row_batches
+from fast_board import FastBoard
+from manifest import fast_hash
+
+''' Sidecar files of the board-derived features of every row in a positions .csv file
+
+The features of a position never change between filter versions, so they're worked out
+once per .csv file, in parallel, and saved next to it as <input>.features.
+Each feature is a bit-packed column with one bit per csv row, including the rows
+with only one possible move, so row n of the .csv is bit n of every column.
+
+The header records the size and fast hash of the .csv file, like the build manifest does,
+so a sidecar of a .csv file that was rewritten since isn't used.
+
+File layout: a 4096 byte header, then each column as ceil(num_rows / 8) bytes,
+least significant bit first.
+'''
+
+FEATURE_COLUMNS = [
+    'full_row',  # the row has all 10 fields
+    'in_check',
+    'bestmove_capture',
+    'bestmove_en_passant',
+    'bestmove_promotion',
+    'sf_bestmove1_capture',
+    'sf_bestmove1_en_passant',
+    'sf_bestmove1_promotion',
+    'sf_bestmove2_capture',
+    'sf_bestmove2_en_passant',
+    'sf_bestmove2_promotion',
+]
+FEATURE_INDEX = {name: i for i, name in enumerate(FEATURE_COLUMNS)}
+
+# same names and order as board_check_failure in csv_filter_v8.py
+BOARD_CHECK_FAILURES = [
+    'num_in_check',
+    'num_bestmove_captures',
+    'num_sf_bestmove1_capture_promos',
+    'num_sf_bestmove2_capture_promos',
+]
+
+FEATURES_FILE_MAGIC = b'NNUEFEAT'
+FEATURES_FILE_VERSION = 2
+_FEATURES_FILE_HEADER = struct.Struct('<8sIIQQ16s')
+FEATURES_FILE_HEADER_SIZE = 4096
+BOARD_CHECK_WINDOW_ROWS = 100000
+
+def features_filename(input_filename):
+    return input_filename + '.features'
+
+
+def move_features(board, uci_move):
+    return board.is_capture(uci_move), board.is_en_passant(uci_move), board.is_promotion(uci_move)
+
+def row_features(split_row):
+    ''' The feature bits of a split csv row, in FEATURE_COLUMNS order '''
+    if len(split_row) < 8:
+        return (False,) * len(FEATURE_COLUMNS)
+    board = FastBoard(split_row[1])
+    features = (len(split_row) == 10, board.is_check())
+    features += move_features(board, split_row[2])
+    features += move_features(board, split_row[6])
+    if len(split_row) == 10:
+        return features + move_features(board, split_row[8])
+    return features + (False, False, False)
+
+def batch_features(csv_rows):
+    ''' A (rows, columns) bool array of the features of a list of csv rows '''
+    features = np.zeros((len(csv_rows), len(FEATURE_COLUMNS)), dtype=bool)
+    for i, csv_row in enumerate(csv_rows):
+        features[i] = row_features(csv_row.strip().split(","))
+    return features
+
+
+def build_features(input_filename, workers=None):
+    ''' Work out the features of every row of a .csv or .csv.zst file and save them next to it '''
+    output_filename = features_filename(input_filename)
+    input_size, input_fast_hash = os.path.getsize(input_filename), fast_hash(input_filename)
+    packed_columns = [bytearray() for _ in FEATURE_COLUMNS]
+    # bits left over from the last batch, until there are 8 to make a byte
+    carry = np.zeros((0, len(FEATURE_COLUMNS)), dtype=bool)
+    num_rows = 0
+    with multiprocessing.Pool(workers) as pool:
+        for features in pool.imap(batch_features, iter_csv_row_batches(input_filename)):
+            num_rows += len(features)
+            features = np.concatenate([carry, features])
+            num_whole_bytes = len(features) // 8 * 8
+            for column, bits in zip(packed_columns, features[:num_whole_bytes].T):
+                column += np.packbits(bits, bitorder='little').tobytes()
+            carry = features[num_whole_bytes:]
+    for column, bits in zip(packed_columns, carry.T):
+        column += np.packbits(bits, bitorder='little').tobytes()
+    tmp_filename = output_filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(_FEATURES_FILE_HEADER.pack(FEATURES_FILE_MAGIC, FEATURES_FILE_VERSION, len(FEATURE_COLUMNS),
+                                           num_rows, input_size, bytes.fromhex(input_fast_hash))
+                .ljust(FEATURES_FILE_HEADER_SIZE, b'\0'))
+        for column in packed_columns:
+            f.write(column)
+    os.replace(tmp_filename, output_filename)
+    print(f'Saved features of {num_rows} rows to {output_filename}')
+    return output_filename
+
+
+class PositionFeatures:
+    ''' Memory-mapped feature columns of a .csv file, read by row ranges '''
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            magic, version, num_columns, self.num_rows, self.input_size, self.input_fast_hash = \
+                _FEATURES_FILE_HEADER.unpack(f.read(_FEATURES_FILE_HEADER.size))
+        if magic != FEATURES_FILE_MAGIC or version != FEATURES_FILE_VERSION or num_columns != len(FEATURE_COLUMNS):
+            raise ValueError(f'{filename} is not a version {FEATURES_FILE_VERSION} features file')
+        self.columns = np.memmap(filename, dtype=np.uint8, mode='r', offset=FEATURES_FILE_HEADER_SIZE,
+                                 shape=(num_columns, (self.num_rows + 7) // 8))
+        # the board check failures of the rows board_check_failure looked at last
+        self.window_start = None
+        self.window_failures = None
+
+    @classmethod
+    def for_input(cls, input_filename):
+        ''' The features saved next to an input file, or None if there are none for its current contents '''
+        filename = features_filename(input_filename)
+        if not os.path.isfile(filename):
+            return None
+        try:
+            features = cls(filename)
+        except ValueError as e:
+            print(f'Ignoring {filename}: {e}')
+            return None
+        if features.input_size != os.path.getsize(input_filename) or \
+           features.input_fast_hash != bytes.fromhex(fast_hash(input_filename)):
+            print(f'Ignoring {filename}, it was built from a different version of {input_filename}')
+            return None
+        return features
+
+    def column(self, name, start=0, stop=None):
+        ''' The bits of rows start to stop of a feature column, as a bool array '''
+        stop = self.num_rows if stop is None else stop
+        packed = self.columns[FEATURE_INDEX[name], start // 8:(stop + 7) // 8]
+        bits = np.unpackbits(packed, bitorder='little').astype(bool)
+        return bits[start % 8:start % 8 + stop - start]
+
+    def rows(self, start=0, stop=None):
+        ''' A (rows, columns) bool array of rows start to stop, like batch_features '''
+        return np.stack([self.column(name, start, stop) for name in FEATURE_COLUMNS], axis=1)
+
+    def board_check_failures(self, start=0, stop=None):
+        ''' For rows start to stop, 0 if the row passes the v8 board checks,
+            else 1 + the index in BOARD_CHECK_FAILURES of the first check it fails
+        '''
+        failures = np.zeros(len(self.column('full_row', start, stop)), dtype=np.int8)
+        checks = [
+            self.column('in_check', start, stop),
+            self.column('bestmove_capture', start, stop),
+            self.column('sf_bestmove1_capture', start, stop) | self.column('sf_bestmove1_promotion', start, stop),
+            self.column('sf_bestmove2_capture', start, stop) | self.column('sf_bestmove2_promotion', start, stop),
+        ]
+        # fill in the last check first, so the earliest failing check wins
+        for i in reversed(range(len(checks))):
+            failures[checks[i]] = 1 + i
+        return failures
+
+    def board_check_failure(self, row_index):
+        ''' Same as board_check_failure in csv_filter_v8.py, for one row
+
+            The failures are unpacked for a window of rows at a time, since unpacking
+            the columns for every row is slower than parsing the board.
+        '''
+        window_start = row_index - row_index % BOARD_CHECK_WINDOW_ROWS
+        if window_start != self.window_start:
+            self.window_failures = self.board_check_failures(window_start,
+                                                             window_start + BOARD_CHECK_WINDOW_ROWS).tolist()
+            self.window_start = window_start
+        failure = self.window_failures[row_index - window_start]
+        return BOARD_CHECK_FAILURES[failure - 1] if failure else None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: ./features.py <input.csv or input.csv.zst> ...')
+        sys.exit(0)
+    for input_filename in sys.argv[1:]:
+        if PositionFeatures.for_input(input_filename):
+            print(f'Found {features_filename(input_filename)}, doing nothing')
+            continue
+        build_features(input_filename)
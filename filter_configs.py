@@ -0,0 +1,161 @@
+from features import FEATURE_INDEX
+from filter_engine import BOARD, SCORE, STRING, FilterConfig, Rule
+
+''' Filter versions as FilterConfigs for filter_engine.py
+
+Each rule's test is true exactly when the matching branch of the csv_filter_vN.py script
+would drop the position, whatever order the rules run in. Branches that only run for rows
+whose 2 best moves favor the same side (promos and dedup in v6-dd and v8) say so in their test.
+
+csv_filter_v5/v6/v7.py only write a game's positions once the next game starts, so they
+lose the positions kept from the last game of every file, a few dozen per file. The engine
+writes them, so its v5, v6 and v7 outputs are the scripts' outputs followed by those positions.
+csv_filter_v6_dd.py and csv_filter_v8.py write the last game too, and v8 is the same as the
+script byte for byte. test/filter_engine_test.py checks both against the scripts.
+'''
+
+def move_is_promo(uci_move):
+    return len(uci_move) == 5 and uci_move[-1] in ['n','b','r','q']
+
+def favor_different_sides(row):
+    return (row.sf_bestmove1_score > 0) != (row.sf_bestmove2_score > 0)
+
+def board_feature(row, name, compute):
+    ''' A feature of the row's board, from its features sidecar bits if it has them '''
+    if row.features is not None:
+        return row.features[FEATURE_INDEX[name]]
+    return compute(row.board)
+
+
+def start_position():
+    return Rule('start_position', SCORE, 'num_start_positions', lambda row: row.is_start_of_game)
+
+def early_ply(max_ply):
+    return Rule('early_ply', SCORE, 'num_early_plies', lambda row: row.ply <= max_ply, max_ply=max_ply)
+
+def equal_then_losing(counter, max_equal, min_losing):
+    ''' best move about equal, 2nd best move loses '''
+    return Rule(f'equal_then_losing_{max_equal}_{min_losing}', SCORE, counter,
+                lambda row: abs(row.sf_bestmove1_score) < max_equal and abs(row.sf_bestmove2_score) > min_losing,
+                max_equal=max_equal, min_losing=min_losing)
+
+def advantage_then_equal(counter, min_advantage, max_equal):
+    ''' best move gains advantage, 2nd best move equalizes '''
+    return Rule(f'advantage_then_equal_{min_advantage}_{max_equal}', SCORE, counter,
+                lambda row: abs(row.sf_bestmove1_score) > min_advantage and abs(row.sf_bestmove2_score) < max_equal,
+                min_advantage=min_advantage, max_equal=max_equal)
+
+def different_sides(name, counter, min_both=None, min_diff=None, not_min_both=None, not_min_diff=None):
+    ''' the 2 best move scores favor different sides and
+        both scores are above min_both or their difference is above min_diff.
+        The not_ thresholds leave out rows an earlier branch already took.
+    '''
+    def test(row):
+        if not favor_different_sides(row):
+            return False
+        abs_score1 = abs(row.sf_bestmove1_score)
+        abs_score2 = abs(row.sf_bestmove2_score)
+        score_diff = abs(row.sf_bestmove1_score - row.sf_bestmove2_score)
+        if not_min_both is not None and abs_score1 > not_min_both and abs_score2 > not_min_both or \
+           not_min_diff is not None and score_diff > not_min_diff:
+            return False
+        return min_both is not None and abs_score1 > min_both and abs_score2 > min_both or \
+               min_diff is not None and score_diff > min_diff
+    return Rule(name, SCORE, counter, test,
+                min_both=min_both, min_diff=min_diff, not_min_both=not_min_both, not_min_diff=not_min_diff)
+
+def bestmove_promo():
+    return Rule('bestmove_promo', STRING, 'num_bestmove_promos',
+                lambda row: not favor_different_sides(row) and move_is_promo(row.bestmove_uci))
+
+def seen_before():
+    return Rule('seen_before', STRING, 'num_seen_before',
+                lambda row: not favor_different_sides(row) and row.seen_before)
+
+def in_check():
+    return Rule('in_check', BOARD, 'num_in_check',
+                lambda row: board_feature(row, 'in_check', lambda board: board.is_check()))
+
+def bestmove_capture():
+    return Rule('bestmove_capture', BOARD, 'num_bestmove_captures',
+                lambda row: board_feature(row, 'bestmove_capture', lambda board: board.is_capture(row.bestmove_uci)))
+
+def sf_bestmove_capture_promo(n):
+    def test(row):
+        uci_move = row.sf_bestmove1_uci if n == 1 else row.sf_bestmove2_uci
+        return board_feature(row, f'sf_bestmove{n}_capture', lambda board: board.is_capture(uci_move)) or \
+               board_feature(row, f'sf_bestmove{n}_promotion', lambda board: board.is_promotion(uci_move))
+    return Rule(f'sf_bestmove{n}_capture_promo', BOARD, f'num_sf_bestmove{n}_capture_promos', test)
+
+
+def filter_v5():
+    return FilterConfig('v5', [
+        start_position(),
+        early_ply(28),
+        Rule('obvious_draw', SCORE, 'num_obvious_draw',
+             lambda row: row.bestmove_score == 0 and
+                         abs(row.sf_bestmove1_score) <= 1 and abs(row.sf_bestmove2_score) <= 1),
+        Rule('large_sf_score_gap', SCORE, 'num_large_sf_score_gap',
+             lambda row: abs(row.sf_bestmove1_score - row.sf_bestmove2_score) > 225, max_diff=225),
+        Rule('score_mismatch', SCORE, 'num_score_mismatch',
+             lambda row: abs(row.bestmove_score - row.sf_bestmove1_score) > 500, max_diff=500),
+        equal_then_losing('num_one_good_move', 100, 150),
+        advantage_then_equal('num_one_good_move', 150, 100),
+        different_sides('different_sides', 'num_one_good_move', min_both=150, min_diff=150),
+    ], start_of_game='ply_zero')
+
+def filter_v6(dedup=False):
+    rules = [
+        start_position(),
+        early_ply(28),
+        equal_then_losing('num_one_good_move', 100, 150),
+        advantage_then_equal('num_one_good_move', 150, 100),
+        different_sides('different_sides', 'num_one_good_move', min_both=150, min_diff=200),
+    ]
+    if dedup:
+        rules.append(seen_before())
+    return FilterConfig('v6-dd' if dedup else 'v6', rules, dedup=dedup)
+
+def filter_v7():
+    return FilterConfig('v7', [
+        start_position(),
+        early_ply(28),
+        equal_then_losing('num_one_good_move_v6', 100, 150),
+        advantage_then_equal('num_one_good_move_v6', 150, 100),
+        equal_then_losing('num_one_good_move_v7', 80, 120),
+        advantage_then_equal('num_one_good_move_v7', 120, 80),
+        different_sides('different_sides_v6', 'num_one_good_move_v6', min_diff=200),
+        different_sides('different_sides_v7', 'num_one_good_move_v7', min_diff=120, not_min_diff=200),
+    ])
+
+def filter_v8(name='v8', early_ply_skip=36):
+    return FilterConfig(name, [
+        start_position(),
+        early_ply(early_ply_skip),
+        equal_then_losing('num_one_good_move', 100, 150),
+        advantage_then_equal('num_one_good_move', 150, 100),
+        different_sides('different_sides', 'num_one_good_move', min_both=150, min_diff=200),
+        different_sides('different_sides_v8', 'num_one_good_move_v8', min_both=100, min_diff=150,
+                        not_min_both=150, not_min_diff=200),
+        bestmove_promo(),
+        seen_before(),
+        in_check(),
+        bestmove_capture(),
+        sf_bestmove_capture_promo(1),
+        sf_bestmove_capture_promo(2),
+    ], start_of_game='first_row_or_ply_reset', dedup=True)
+
+
+FILTER_VERSIONS = {
+    'v5': filter_v5,
+    'v6': filter_v6,
+    'v6-dd': lambda: filter_v6(dedup=True),
+    'v7': filter_v7,
+    'v8': filter_v8,
+    # csv_filter_v8_dd.py kept the v6 early ply cutoff
+    'v8-dd': lambda: filter_v8('v8-dd', early_ply_skip=28),
+}
+
+def cross_file_dedup(version):
+    ''' -dd versions de-duplicate against the positions of every file filtered before, not just their own '''
+    return version.endswith('-dd')
@@ -0,0 +1,253 @@
+import collections
+import time
+
+from dedup import PositionHashSet
+from fast_board import FastBoard
+
+''' Filter positions .csv rows with a filter version given as a list of rules
+
+Every rule is a named predicate over one csv row that rejects the position when true,
+with a counter it adds to and a cost tag saying what it needs to look at:
+
+  score  - only the ply and scores of the row
+  string - the fen or move strings
+  board  - a FastBoard parsed from the fen, or the row's bits of a features.py sidecar
+
+A position is kept when no rule rejects it, so the rules can be evaluated in any order.
+The engine samples each rule's cost and rejection rate as it runs and moves the cheap,
+selective rules to the front. Which positions are kept never depends on the order.
+Each rejected position is counted once, by the first rule that rejected it,
+so per-rule counts can shift between rules that overlap when the order changes.
+'''
+
+SCORE = 'score'
+STRING = 'string'
+BOARD = 'board'
+COST_TAGS = (SCORE, STRING, BOARD)
+
+STARTPOS_PREFIX = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq'
+
+
+class Rule:
+    def __init__(self, name, cost, counter, test, **params):
+        if cost not in COST_TAGS:
+            raise ValueError(f'unknown cost tag for rule {name}: {cost}')
+        self.name = name
+        self.cost = cost
+        self.counter = counter
+        self.test = test
+        # thresholds baked into test, kept for printing and parameter sweeps
+        self.params = params
+
+    def __repr__(self):
+        params = ', '.join(f'{name}={value}' for name, value in self.params.items())
+        return f'{self.name}({params})'
+
+
+class FilterConfig:
+    ''' A filter version: its rules in declared order, and how rows are tracked across the file
+
+        start_of_game picks how a new training game is detected:
+          'ply_zero'  - the row's ply is 0
+          'ply_reset' - the ply went down since the previous row
+          'first_row_or_ply_reset' - same, also counting the first row of the file
+        With dedup set, every row's piece placement is added to a seen set before the rules run.
+    '''
+    def __init__(self, name, rules, start_of_game='ply_reset', dedup=False):
+        self.name = name
+        self.rules = rules
+        self.start_of_game = start_of_game
+        self.dedup = dedup
+        self.counters = list(dict.fromkeys(rule.counter for rule in rules))
+
+
+class CsvRow:
+    __slots__ = ('ply', 'fen', 'bestmove_uci', 'bestmove_score', 'game_result',
+                 'sf_bestmove1_uci', 'sf_bestmove1_score', 'sf_bestmove2_uci', 'sf_bestmove2_score',
+                 'is_start_of_game', 'seen_before', 'features', '_board')
+
+    def __init__(self, split_row):
+        ply, self.fen, self.bestmove_uci, bestmove_score, self.game_result, \
+        sf_search_method, self.sf_bestmove1_uci, sf_bestmove1_score, \
+        self.sf_bestmove2_uci, sf_bestmove2_score = \
+            split_row
+        self.ply = int(ply)
+        self.bestmove_score = int(bestmove_score)
+        self.sf_bestmove1_score = int(sf_bestmove1_score)
+        self.sf_bestmove2_score = int(sf_bestmove2_score)
+        self.is_start_of_game = False
+        self.seen_before = False
+        # the row's bits from a features.py sidecar, if there is one
+        self.features = None
+        self._board = None
+
+    @property
+    def board(self):
+        if self._board is None:
+            self._board = FastBoard(self.fen)
+        return self._board
+
+    def to_position(self):
+        ''' The (fen, move, score, ply, result) of the row, as taken by BinpackWriter.add_position '''
+        return (self.fen, self.bestmove_uci, self.bestmove_score, self.ply, self.game_result)
+
+
+class RuleStats:
+    __slots__ = ('num_rejected', 'num_sampled', 'num_sample_rejects', 'sample_seconds')
+
+    def __init__(self):
+        self.num_rejected = 0
+        self.num_sampled = 0
+        self.num_sample_rejects = 0
+        self.sample_seconds = 0.0
+
+    @property
+    def reject_rate(self):
+        return self.num_sample_rejects / self.num_sampled if self.num_sampled else 0.0
+
+    @property
+    def seconds_per_row(self):
+        return self.sample_seconds / self.num_sampled if self.num_sampled else 0.0
+
+
+class FilterEngine:
+    ''' Runs a FilterConfig over csv rows, keeping per-rule and per-counter stats
+
+        The first sample_size full rows of every reorder_interval rows are checked against every rule
+        while timing them. The rules are then sorted by their expected cost per rejected position,
+        cost / rejection rate, which is the cheapest order for independent filters.
+        With adaptive off, the rules always run in their declared order.
+    '''
+    def __init__(self, config, seen=None, adaptive=True, reorder_interval=100000, sample_size=1000):
+        self.config = config
+        self.adaptive = adaptive
+        self.reorder_interval = reorder_interval
+        self.sample_size = sample_size
+        if adaptive:
+            # before anything is measured, the cost tags decide
+            self.rules = sorted(config.rules, key=lambda rule: COST_TAGS.index(rule.cost))
+        else:
+            self.rules = list(config.rules)
+        self.rule_stats = {rule.name: RuleStats() for rule in config.rules}
+        self.has_board_rules = any(rule.cost == BOARD for rule in config.rules)
+        self.board_seconds = 0.0
+        self.piece_orientations_seen = None
+        if config.dedup:
+            self.piece_orientations_seen = seen if seen is not None else PositionHashSet()
+
+        self.prev_ply = -1
+        self.num_games = 0
+        self.num_standard_games = 0
+        self.num_non_standard_games = 0
+        self.num_positions = 0
+        self.num_only_one_move = 0
+        self.num_positions_filtered_out = 0
+        self.num_rows_checked = 0
+        self.counters = collections.Counter({counter: 0 for counter in config.counters})
+
+    def process_csv_row(self, csv_row):
+        ''' The position of a csv row as a tuple if it passes every rule, else None '''
+        split_row = csv_row.strip().split(",")
+        return self.process_row(CsvRow(split_row) if len(split_row) == 10 else None)
+
+    def process_row(self, row):
+        ''' Same as process_csv_row for an already parsed CsvRow, or None for rows with only one move
+
+            A CsvRow can be shared by several engines, each one processing it in turn.
+        '''
+        self.num_positions += 1
+        if row is None:
+            # only one possible move in the position
+            self.num_only_one_move += 1
+            self.num_positions_filtered_out += 1
+            return
+        self.track_row(row)
+        self.num_rows_checked += 1
+        if self.adaptive and self.num_rows_checked % self.reorder_interval <= self.sample_size:
+            rejected_by = self.sample_rules(row)
+            if self.num_rows_checked % self.reorder_interval == self.sample_size:
+                self.reorder_rules()
+        else:
+            rejected_by = None
+            for rule in self.rules:
+                if rule.test(row):
+                    rejected_by = rule
+                    break
+        if rejected_by is not None:
+            self.rule_stats[rejected_by.name].num_rejected += 1
+            self.counters[rejected_by.counter] += 1
+            self.num_positions_filtered_out += 1
+            return
+        return row.to_position()
+
+    def track_row(self, row):
+        ''' Updates done for every row before any rule runs '''
+        start_of_game = self.config.start_of_game
+        if start_of_game == 'ply_zero':
+            row.is_start_of_game = row.ply == 0
+        elif start_of_game == 'ply_reset':
+            row.is_start_of_game = row.ply < self.prev_ply
+        else:
+            row.is_start_of_game = self.prev_ply == -1 or row.ply < self.prev_ply
+        self.prev_ply = row.ply
+        if row.is_start_of_game:
+            if STARTPOS_PREFIX in row.fen:
+                self.num_standard_games += 1
+            else:
+                self.num_non_standard_games += 1
+            self.num_games += 1
+        row.seen_before = self.piece_orientations_seen is not None and \
+                          self.piece_orientations_seen.test_and_add(row.fen.split(' ')[0])
+
+    def sample_rules(self, row):
+        ''' Evaluate every rule on a row while timing them. Returns the first rule in order that rejects. '''
+        if self.has_board_rules and row.features is None:
+            # whichever board rule runs first pays for parsing the board
+            start = time.perf_counter()
+            row.board
+            self.board_seconds += time.perf_counter() - start
+        rejected_by = None
+        for rule in self.rules:
+            stats = self.rule_stats[rule.name]
+            start = time.perf_counter()
+            rejects = rule.test(row)
+            stats.sample_seconds += time.perf_counter() - start
+            stats.num_sampled += 1
+            if rejects:
+                stats.num_sample_rejects += 1
+                if rejected_by is None:
+                    rejected_by = rule
+        return rejected_by
+
+    def expected_cost(self, rule):
+        stats = self.rule_stats[rule.name]
+        seconds = stats.seconds_per_row
+        if rule.cost == BOARD and stats.num_sampled:
+            seconds += self.board_seconds / stats.num_sampled
+        if not stats.num_sample_rejects:
+            return (float('inf'), seconds)
+        return (seconds / stats.reject_rate, seconds)
+
+    def reorder_rules(self):
+        self.rules.sort(key=self.expected_cost)
+
+    def print_stats(self):
+        num_positions_after_filter = self.num_positions - self.num_positions_filtered_out
+        print(f'Processed {self.num_positions} positions with filter {self.config.name}')
+        print(f'  # games:                       {self.num_games:8d}')
+        print(f'    # standard games:            {self.num_standard_games:8d}')
+        print(f'    # non-standard games:        {self.num_non_standard_games:8d}')
+        print(f'  # positions:                   {self.num_positions:8d}')
+        print(f'    # only one move:             {self.num_only_one_move:8d}')
+        for counter, value in self.counters.items():
+            print(f'    # {counter[4:].replace("_", " ") + ":":<27}{value:8d}')
+        print(f'  # positions after filtering:   {num_positions_after_filter:8d}')
+        print(f'    % positions kept:            {num_positions_after_filter/max(1, self.num_positions)*100:8.1f}')
+        print(f'  rules in evaluation order:')
+        for rule in self.rules:
+            stats = self.rule_stats[rule.name]
+            print(f'    {rule.name:<28} {rule.cost:<7} rejected {stats.num_rejected:8d}'
+                  f'  sampled reject rate {stats.reject_rate*100:5.1f}%'
+                  f'  {stats.seconds_per_row*1e9:6.0f} ns/row')
+        if self.piece_orientations_seen is not None:
+            print(f'  # seen set: {self.piece_orientations_seen.stats()}')
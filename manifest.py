@@ -0,0 +1,200 @@
+import argparse
+import hashlib
+import json
+import os
+import os.path
+import sys
+import time
+
+''' A manifest of built files, to decide whether the step building one needs to run again
+
+A directory's manifest.jsonl has a line for every file built in it, recording:
+  - the size, mtime, fast hash and checksum of the file
+  - the size, mtime and fast hash of each input file
+  - the fast hash of each tool: the scripts and binaries that built it
+  - the parameters it was built with
+A later line for a file replaces the earlier ones.
+
+A file is up to date if its latest line matches what it was built from now. A file whose
+size is the same but whose mtime isn't is hashed, so touching a file doesn't rebuild
+anything. The output's fast hash is checked even when its mtime is the same, so an output
+overwritten in place with its mtime kept is built again. A file built from another built
+file is only up to date if that one is too, so a changed tool or parameter rebuilds every
+step after it. An input that was deleted after it was used, like a .csv once it's
+compressed, is up to date if its own line is.
+
+Files built before the manifest have no line, so they're built again,
+unless they're recorded as they are with `python3 manifest.py record`.
+
+From shell scripts:
+
+  python3 manifest.py check OUTPUT [--input FILE] [--tool FILE] [--param NAME=VALUE]   exits 0 if up to date
+  python3 manifest.py record OUTPUT --input FILE --tool FILE [--param NAME=VALUE]
+'''
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+FAST_HASH_SAMPLE_SIZE = 1 << 20
+
+def fast_hash(filename):
+    ''' Hash of the size and the first, middle and last MiB of a file '''
+    size = os.path.getsize(filename)
+    h = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(filename, 'rb') as f:
+        if size <= 3 * FAST_HASH_SAMPLE_SIZE:
+            h.update(f.read())
+        else:
+            for offset in (0, (size - FAST_HASH_SAMPLE_SIZE) // 2, size - FAST_HASH_SAMPLE_SIZE):
+                f.seek(offset)
+                h.update(f.read(FAST_HASH_SAMPLE_SIZE))
+    return h.hexdigest()
+
+def checksum(filename):
+    ''' Hash of the whole file '''
+    h = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_state(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'fast_hash': fast_hash(filename)}
+
+def matches_state(filename, state, verify_hash=True):
+    ''' Whether a file is the same as when its state was recorded, only hashing it if its mtime
+        changed, unless verify_hash is set
+    '''
+    if not os.path.isfile(filename):
+        return False
+    stat = os.stat(filename)
+    if stat.st_size != state['size']:
+        return False
+    if stat.st_mtime_ns == state['mtime_ns'] and not verify_hash:
+        return True
+    return fast_hash(filename) == state['fast_hash']
+
+
+class Manifest:
+    ''' The manifest.jsonl of the directory that built files are in '''
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.filename = os.path.join(self.directory, MANIFEST_FILENAME)
+        self.entries = {}
+        self.offset = 0
+        self.update()
+
+    def update(self):
+        ''' Read the lines added to the manifest file since it was last read '''
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # leave a line that's still being written for the next update
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # a line cut off by a crash
+                continue
+            self.entries[entry['output']] = entry
+        self.offset += end
+
+    @classmethod
+    def for_file(cls, filename):
+        return cls(os.path.dirname(os.path.abspath(filename)))
+
+    def relpath(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.directory)
+
+    def path(self, relpath):
+        return os.path.normpath(os.path.join(self.directory, relpath))
+
+    def entry(self, output_filename):
+        return self.entries.get(self.relpath(output_filename))
+
+    def is_current(self, output_filename, inputs=None, tools=None, params=None, allow_missing=False):
+        ''' Whether output_filename was built from inputs, with tools and params, as they are now
+
+            inputs, tools and params that aren't given aren't compared with the recorded ones,
+            to check whether a file is still up to date without knowing how it's built.
+            With allow_missing set, a deleted output is up to date if its inputs and tools are.
+        '''
+        entry = self.entry(output_filename)
+        if entry is None:
+            return False
+        if inputs is not None and sorted(map(self.relpath, inputs)) != sorted(entry['inputs']):
+            return False
+        if tools is not None and sorted(os.path.abspath(tool) for tool in tools) != sorted(entry['tools']):
+            return False
+        if params is not None and json.loads(json.dumps(params)) != entry['params']:
+            return False
+        if os.path.isfile(output_filename):
+            # hashed even with the same mtime, so a step isn't skipped over a damaged output
+            if not matches_state(output_filename, entry['output_state'], verify_hash=True):
+                return False
+        elif not allow_missing:
+            return False
+        for tool, state in entry['tools'].items():
+            if not matches_state(tool, state):
+                return False
+        for input_relpath, state in entry['inputs'].items():
+            input_filename = self.path(input_relpath)
+            manifest = self if os.path.dirname(input_filename) == self.directory else \
+                       Manifest.for_file(input_filename)
+            input_entry = manifest.entry(input_filename)
+            if os.path.isfile(input_filename):
+                if not matches_state(input_filename, state):
+                    return False
+            elif input_entry is None or input_entry['output_state']['fast_hash'] != state['fast_hash']:
+                # deleted, and it's not the file that was built here
+                return False
+            # a built input has to be up to date too, even if it was deleted after it was used
+            if input_entry is not None and not manifest.is_current(input_filename, allow_missing=True):
+                return False
+        return True
+
+    def record(self, output_filename, inputs, tools=(), params=None):
+        ''' Add a line for a file that was just built '''
+        output_state = file_state(output_filename)
+        output_state['checksum'] = checksum(output_filename)
+        entry = {
+            'output': self.relpath(output_filename),
+            'output_state': output_state,
+            'inputs': {self.relpath(f): file_state(f) for f in inputs},
+            'tools': {os.path.abspath(tool): file_state(tool) for tool in tools},
+            'params': json.loads(json.dumps(params or {})),
+            'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        # a single append of a whole line, so concurrent builds don't interleave lines
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(entry) + '\n').encode())
+        finally:
+            os.close(fd)
+        self.entries[entry['output']] = entry
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check or record whether a built file is up to date')
+    parser.add_argument('command', choices=['check', 'record'])
+    parser.add_argument('output')
+    parser.add_argument('--input', action='append', help='a file the output was built from')
+    parser.add_argument('--tool', action='append', help='a script or binary the output was built with')
+    parser.add_argument('--param', action='append', metavar='NAME=VALUE',
+                        help='a parameter the output was built with')
+    parser.add_argument('--allow-missing', action='store_true',
+                        help="with check, an output that's been deleted is up to date if its inputs are")
+    args = parser.parse_args()
+    # like the empty path of `command -v` for a binary that isn't installed
+    for tool in args.tool or []:
+        if not os.path.isfile(tool):
+            parser.error(f'tool not found: {tool!r}')
+    params = None
+    if args.param:
+        params = dict(param.split('=', 1) for param in args.param)
+    manifest = Manifest.for_file(args.output)
+    if args.command == 'check':
+        sys.exit(0 if manifest.is_current(args.output, args.input, args.tool, params, args.allow_missing) else 1)
+    manifest.record(args.output, args.input or [], args.tool or [], params)
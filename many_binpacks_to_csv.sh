@@ -4,22 +4,33 @@ if [ "$#" -ne 1 ]; then
   exit 0
 fi
 
+csv_tool=$(command -v stockfish-output-positions-csv)
+if [ -z "$csv_tool" ]; then
+  echo stockfish-output-positions-csv not found in PATH
+  exit 1
+fi
+export csv_tool
+
 function binpack_to_csv() {
   input_filename=$1
   output_filename=$(basename $1).csv
   output_dir=$2
   output_csv_filepath=$output_dir/$output_filename
-  if [ -f $output_csv_filepath ]; then
-    echo "Doing nothing, csv exists: $output_csv_filepath"
-  elif [ -f ${output_csv_filepath}.zst ]; then
-    echo "Doing nothing, csv.zst exists: ${output_csv_filepath}.zst"
+  manifest_args="--input $input_filename --tool binpack_to_csv.sh --tool $csv_tool"
+  if python3 manifest.py check $output_csv_filepath $manifest_args; then
+    echo "Doing nothing, csv is up to date: $output_csv_filepath"
+  elif python3 manifest.py check $output_csv_filepath $manifest_args --allow-missing && \
+       python3 manifest.py check ${output_csv_filepath}.zst; then
+    echo "Doing nothing, csv.zst is up to date: ${output_csv_filepath}.zst"
   else
     echo "Converting... $input_filename -> .csv"
-    ./binpack_to_csv.sh $input_filename | grep "d6 pv2" > $output_csv_filepath
+    ./binpack_to_csv.sh $input_filename | grep "d6 pv2" > ${output_csv_filepath}.tmp && \
+      mv ${output_csv_filepath}.tmp $output_csv_filepath && \
+      python3 manifest.py record $output_csv_filepath $manifest_args
   fi
 }
 export -f binpack_to_csv
 
 # Converts binpacks to csv with search eval data for each position
 concurrency=$(( $(nproc) - 1 ))
-ls -1v $1/*.binpack | xargs -P $concurrency -I{} bash -c 'binpack_to_csv "$@"' _ {} $1
+ls -1S $1/*.binpack | grep -v '\.prefilter\.binpack$' | xargs -P $concurrency -I{} bash -c 'binpack_to_csv "$@"' _ {} $1
@@ -28,4 +28,4 @@ export -f csv_zst_to_filtered_binpack
 # Converts csv.zst files into filtered binpacks
 concurrency=$(( $(nproc) - 1 ))
 cd $1
-ls -1v *.csv.zst | xargs -P $concurrency -I{} bash -c 'csv_zst_to_filtered_binpack "$@"' _ {}
+ls -1S *.csv.zst | xargs -P $concurrency -I{} bash -c 'csv_zst_to_filtered_binpack "$@"' _ {}
@@ -6,4 +6,4 @@ fi
 
 # concurrency=$(( $(nproc) - 1 ))
 concurrency=70
-ls -1v $1/*.binpack | xargs -P $concurrency -n1 ./verify_and_compress.sh
+ls -1S $1/*.binpack | grep -v '\.prefilter\.binpack$' | xargs -P $concurrency -n1 ./verify_and_compress.sh
@@ -4,10 +4,17 @@ if [ "$#" -ne 1 ]; then
   exit 0
 fi
 
+stockfish=$(command -v stockfish)
+if [ -z "$stockfish" ]; then
+  echo stockfish not found in PATH
+  exit 1
+fi
+
 input_binpack=$1
 output_binpack=${input_binpack}.min.binpack
-if [ -f $output_binpack ]; then
-  echo Minimized binpack already exists: $output_binpack
+manifest_args="--input $input_binpack --tool $0 --tool $stockfish"
+if python3 $(dirname $0)/manifest.py check $output_binpack $manifest_args; then
+  echo Minimized binpack is up to date: $output_binpack
   exit 0
 fi
 
@@ -18,4 +25,7 @@ isready
 transform minimize_binpack input_file ${input_binpack} output_file ${output_binpack}
 quit"
 
-printf "$options" | stockfish
+printf "$options" | $stockfish
+if [ -f $output_binpack ]; then
+  python3 $(dirname $0)/manifest.py record $output_binpack $manifest_args
+fi
@@ -0,0 +1,311 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from glob import glob
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+from binpack_prefilter import PREFILTER_SUFFIX, prefiltered_filename
+from columnar import ColumnarPositions, columnar_filename
+from features import PositionFeatures
+from manifest import Manifest
+
+''' Run every stage of turning .binpack files into filtered training data, for a whole directory
+
+Each .binpack goes through:
+
+  rescore    X.binpack -> X.binpack.csv                  binpack_to_csv.sh, keeping "d6 pv2" rows
+  compress   X.binpack.csv -> X.binpack.csv.zst          verify_and_compress.sh
+  filter     -> X.binpack.csv.zst.filter-v8.binpack      csv_filter_v8.py
+  minimize   -> X.binpack.csv.zst.filter-v8.binpack.min.binpack    minimize_binpack.sh
+
+With --prefilter, binpack_prefilter.py first drops the positions csv_filter_v8.py would drop
+anyway, into X.binpack.prefilter.binpack, and the later stages run on that instead, so every
+output is named after it, eg. X.binpack.prefilter.binpack.csv.zst. Its rows only suit v8, so
+it's kept apart from the X.binpack.csv.zst the other filters read. With --rescore-cache,
+positions already in a rescore_cache.py cache aren't rescored.
+
+A file starts its next stage as soon as its previous one finishes, instead of every file
+waiting at a barrier for the whole directory to finish a stage. At most --jobs stages run
+at once, and at most --workers STAGE=N of one stage, eg. to limit the memory of zstd -22.
+Stages of files that are further along are started first, then the files with the most
+positions, so the biggest files don't start last and leave one core busy at the end.
+
+A stage is skipped when the build manifest from manifest.py shows its output, or the output
+of a stage after it, is up to date. Every stage records its output there.
+Stage output goes to X.binpack.log. A failed stage stops that file's later stages
+and makes the exit status nonzero.
+
+  ./orchestrate.py /mnt/data/binpacks --jobs 63 --workers compress=16
+'''
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+FILTERED_SUFFIX = '.csv.zst.filter-v8.binpack'
+
+# rough sizes of a position, to compare files that have no sidecar with a row count
+BYTES_PER_POSITION = {
+    '.binpack': 3,
+    '.csv': 100,
+    '.csv.zst': 25,
+}
+
+def natural_sort_key(filename):
+    ''' Same order as `ls -1v` for names that differ in their numbers '''
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', filename)]
+
+def estimated_positions(filename):
+    ''' Number of positions in a file, from its features or columnar sidecar if it has one,
+        or else estimated from its size
+    '''
+    if not os.path.isfile(filename):
+        return 0
+    size = os.path.getsize(filename)
+    features = PositionFeatures.for_input(filename)
+    if features:
+        return features.num_rows
+    if os.path.isfile(columnar_filename(filename)):
+        columns = ColumnarPositions(columnar_filename(filename))
+        if columns.input_size == size:
+            return columns.num_rows
+    for suffix, bytes_per_position in BYTES_PER_POSITION.items():
+        if filename.endswith(suffix):
+            return size // bytes_per_position
+    return size
+
+
+class Stage:
+    ''' A step run on each .binpack file, making one output file from the output of the stage before it
+
+        input and output map a .binpack filename to the stage's input and output files.
+        run(binpack_filename, log) runs the stage, logging to the log file, and returns its exit status.
+    '''
+    def __init__(self, name, input, output, run):
+        self.name = name
+        self.input = input
+        self.output = output
+        self.run = run
+
+
+def run_rescore(input_filename, log, rescore_cache=None):
+    ''' binpack_to_csv.sh piped through grep into a temp .csv, renamed once it's finished
+
+        With a rescore_cache file from rescore_cache.py, only the positions that aren't in it are rescored.
+    '''
+    csv_filename = input_filename + '.csv'
+    tools = [os.path.join(SCRIPT_DIR, 'binpack_to_csv.sh'), shutil.which('stockfish-output-positions-csv')]
+    command = [tools[0], input_filename]
+    if rescore_cache:
+        # the cache isn't a tool, so adding to it doesn't make every rescored .csv out of date
+        tools.append(os.path.join(SCRIPT_DIR, 'rescore_cache.py'))
+        command = [sys.executable, tools[-1], 'rescore', rescore_cache, input_filename]
+    with open(csv_filename + '.tmp', 'wb') as outfile:
+        rescore = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=log)
+        grep = subprocess.run(['grep', 'd6 pv2'], stdin=rescore.stdout, stdout=outfile, stderr=log)
+        rescore.stdout.close()
+        if rescore.wait() != 0 or grep.returncode != 0:
+            return rescore.returncode or grep.returncode
+    os.replace(csv_filename + '.tmp', csv_filename)
+    Manifest.for_file(csv_filename).record(csv_filename, [input_filename], tools)
+    return 0
+
+def run_script(command, argument):
+    ''' Run a stage by running command on argument(binpack_filename) '''
+    def run(binpack_filename, log):
+        return subprocess.run(command + [argument(binpack_filename)], stdout=log, stderr=log).returncode
+    return run
+
+STAGE_NAMES = ['prefilter', 'rescore', 'compress', 'filter', 'minimize']
+
+def build_stages(prefilter=False, rescore_cache=None):
+    ''' The stages to run on each .binpack, all but prefilter on the .prefilter.binpack if prefilter is set '''
+    source = prefiltered_filename if prefilter else lambda f: f
+    stages = [
+        Stage('rescore', source, lambda f: source(f) + '.csv',
+              lambda f, log: run_rescore(source(f), log, rescore_cache)),
+        Stage('compress', lambda f: source(f) + '.csv', lambda f: source(f) + '.csv.zst',
+              run_script([os.path.join(SCRIPT_DIR, 'verify_and_compress.sh')], source)),
+        Stage('filter', lambda f: source(f) + '.csv.zst', lambda f: source(f) + FILTERED_SUFFIX,
+              run_script([sys.executable, os.path.join(SCRIPT_DIR, 'csv_filter_v8.py')],
+                         lambda f: source(f) + '.csv.zst')),
+        Stage('minimize', lambda f: source(f) + FILTERED_SUFFIX, lambda f: source(f) + FILTERED_SUFFIX + '.min.binpack',
+              run_script([os.path.join(SCRIPT_DIR, 'minimize_binpack.sh')], lambda f: source(f) + FILTERED_SUFFIX)),
+    ]
+    if prefilter:
+        stages.insert(0, Stage('prefilter', lambda f: f, prefiltered_filename,
+                               run_script([sys.executable, os.path.join(SCRIPT_DIR, 'binpack_prefilter.py')],
+                                          lambda f: f)))
+    return stages
+
+
+class Job:
+    __slots__ = ('binpack_filename', 'stage_index', 'stage', 'num_positions', 'start_time')
+
+    def __init__(self, binpack_filename, stage_index, stage):
+        self.binpack_filename = binpack_filename
+        self.stage_index = stage_index
+        self.stage = stage
+        # the cost estimate for longest job first
+        self.num_positions = estimated_positions(stage.input(binpack_filename))
+        self.start_time = None
+
+
+class Orchestrator:
+    def __init__(self, max_jobs, worker_limits=None, stages=STAGE_NAMES, prefilter=False, rescore_cache=None):
+        self.max_jobs = max_jobs
+        self.all_stages = build_stages(prefilter, rescore_cache)
+        self.worker_limits = {name: worker_limits.get(name, max_jobs) for name in STAGE_NAMES} \
+                             if worker_limits else {name: max_jobs for name in STAGE_NAMES}
+        self.stages = stages
+        self.num_running = {name: 0 for name in STAGE_NAMES}
+        self.busy_seconds = {name: 0.0 for name in STAGE_NAMES}
+        self.num_done = {name: 0 for name in STAGE_NAMES}
+        self.failed = []
+        # the build manifest of each directory, updated with the lines stages add
+        self.manifests = {}
+
+    def is_done(self, stage, binpack_filename):
+        output_filename = stage.output(binpack_filename)
+        directory = os.path.dirname(os.path.abspath(output_filename))
+        if directory not in self.manifests:
+            self.manifests[directory] = Manifest(directory)
+        manifest = self.manifests[directory]
+        manifest.update()
+        return manifest.is_current(output_filename)
+
+    def next_stage_index(self, binpack_filename, stage_index=0):
+        ''' Index of the file's first stage to run from stage_index on, or None if there's none left
+
+            A stage counts as done if its output or the output of any later stage is up to date.
+        '''
+        stage_indexes = [i for i in range(stage_index, len(self.all_stages)) if self.all_stages[i].name in self.stages]
+        for i in reversed(stage_indexes):
+            if self.is_done(self.all_stages[i], binpack_filename):
+                stage_indexes = [j for j in stage_indexes if j > i]
+                break
+        return stage_indexes[0] if stage_indexes else None
+
+    def run_job(self, job):
+        with open(job.binpack_filename + '.log', 'ab') as log:
+            log.write(f'=== {job.stage.name} {job.binpack_filename}\n'.encode())
+            log.flush()
+            return job.stage.run(job.binpack_filename, log)
+
+    def pick_job(self, ready):
+        ''' The ready job to start next: the furthest along file whose stage has a free worker,
+            then the one with the most positions
+        '''
+        for job in sorted(ready, key=lambda job: (-job.stage_index, -job.num_positions)):
+            if self.num_running[job.stage.name] < self.worker_limits[job.stage.name]:
+                return job
+
+    def run(self, binpack_filenames):
+        ready = []
+        for binpack_filename in binpack_filenames:
+            stage_index = self.next_stage_index(binpack_filename)
+            if stage_index is not None:
+                ready.append(Job(binpack_filename, stage_index, self.all_stages[stage_index]))
+        print(f'{len(ready)} of {len(binpack_filenames)} files have stages to run')
+        start_time = time.perf_counter()
+        running = {}
+        with ThreadPoolExecutor(self.max_jobs) as executor:
+            while ready or running:
+                while len(running) < self.max_jobs:
+                    job = self.pick_job(ready)
+                    if job is None:
+                        break
+                    ready.remove(job)
+                    job.start_time = time.perf_counter()
+                    self.num_running[job.stage.name] += 1
+                    print(f'Starting {job.stage.name:<8} {job.binpack_filename} (~{job.num_positions} positions)')
+                    running[executor.submit(self.run_job, job)] = job
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job = running.pop(future)
+                    seconds = time.perf_counter() - job.start_time
+                    self.num_running[job.stage.name] -= 1
+                    self.busy_seconds[job.stage.name] += seconds
+                    next_job = self.finish_job(job, future, seconds)
+                    if next_job is not None:
+                        ready.append(next_job)
+        self.print_summary(time.perf_counter() - start_time)
+        return not self.failed
+
+    def finish_job(self, job, future, seconds):
+        ''' The file's next job, or None if it's finished or failed '''
+        try:
+            returncode = future.result()
+        except Exception as e:
+            returncode = repr(e)
+        if returncode == 0 and not self.is_done(job.stage, job.binpack_filename):
+            returncode = f'no up to date output {job.stage.output(job.binpack_filename)}'
+        if returncode != 0:
+            print(f'Failed   {job.stage.name:<8} {job.binpack_filename} ({returncode}), '
+                  f'see {job.binpack_filename}.log')
+            self.failed.append((job.binpack_filename, job.stage.name))
+            return
+        self.num_done[job.stage.name] += 1
+        print(f'Finished {job.stage.name:<8} {job.binpack_filename} in {seconds:.1f}s')
+        stage_index = self.next_stage_index(job.binpack_filename, job.stage_index + 1)
+        if stage_index is not None:
+            return Job(job.binpack_filename, stage_index, self.all_stages[stage_index])
+
+    def print_summary(self, wall_seconds):
+        print(f'Ran for {wall_seconds:.1f}s with up to {self.max_jobs} jobs at once')
+        for name in [stage.name for stage in self.all_stages if stage.name in self.stages]:
+            print(f'  {name:<10} {self.num_done[name]:6d} done   {self.busy_seconds[name]:10.1f}s busy'
+                  f'   up to {self.worker_limits[name]} at once')
+        for binpack_filename, name in self.failed:
+            print(f'  failed {name}: {binpack_filename}')
+
+
+def find_binpacks(data_dir, prefilter=False):
+    ''' The source .binpack files of a directory, including ones only left as a .csv or .csv.zst,
+        or with prefilter set, as a .prefilter.binpack or its .csv or .csv.zst
+    '''
+    binpack_filenames = set(glob(os.path.join(data_dir, '*.binpack')))
+    binpack_filenames |= {f[:-len('.csv.zst')] for f in glob(os.path.join(data_dir, '*.binpack.csv.zst'))}
+    binpack_filenames |= {f[:-len('.csv')] for f in glob(os.path.join(data_dir, '*.binpack.csv'))}
+    if prefilter:
+        binpack_filenames = {f[:-len(PREFILTER_SUFFIX)] if f.endswith(PREFILTER_SUFFIX) else f
+                             for f in binpack_filenames}
+    binpack_filenames = {f for f in binpack_filenames
+                         if '.csv' not in os.path.basename(f) and not f.endswith(PREFILTER_SUFFIX)}
+    return sorted(binpack_filenames, key=natural_sort_key)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rescore, compress, filter and minimize every .binpack in a directory')
+    parser.add_argument('data_dir')
+    parser.add_argument('--jobs', type=int, default=max(1, os.cpu_count() - 1),
+                        help='most stages to run at once, across every file')
+    parser.add_argument('--workers', action='append', default=[], metavar='STAGE=N',
+                        help=f'most jobs of one stage to run at once. Stages: {", ".join(STAGE_NAMES)}')
+    parser.add_argument('--stages', default=','.join(STAGE_NAMES),
+                        help='comma-separated stages to run, the others are assumed done or not wanted')
+    parser.add_argument('--rescore-cache', metavar='FILE',
+                        help='a rescore_cache.py cache file of positions to not rescore again')
+    parser.add_argument('--prefilter', action='store_true',
+                        help="drop positions csv_filter_v8.py would drop before rescoring, and rescore into "
+                             "X.binpack.prefilter.binpack.csv.zst instead of X.binpack.csv.zst, for v8 only")
+    args = parser.parse_args()
+    worker_limits = {}
+    for workers in args.workers:
+        name, num_workers = workers.split('=')
+        if name not in STAGE_NAMES:
+            parser.error(f'unknown stage: {name}')
+        worker_limits[name] = int(num_workers)
+        if worker_limits[name] < 1:
+            parser.error(f'{name} needs at least 1 worker')
+    stages = args.stages.split(',')
+    for name in stages:
+        if name not in STAGE_NAMES:
+            parser.error(f'unknown stage: {name}')
+    if args.stages != parser.get_default('stages') and 'prefilter' in stages and not args.prefilter:
+        parser.error('the prefilter stage only runs with --prefilter')
+    orchestrator = Orchestrator(args.jobs, worker_limits, stages, args.prefilter, args.rescore_cache)
+    if not orchestrator.run(find_binpacks(args.data_dir, args.prefilter)):
+        sys.exit(1)
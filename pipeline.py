@@ -0,0 +1,148 @@
+import queue
+import threading
+import time
+
+''' Run a chain of processing stages in threads connected by bounded queues
+
+The first stage pulls items from a source iterator, each later stage applies its function
+to the items of the stage before it. Queues hold at most queue_size items, so a fast stage
+runs at most that many items ahead of a slow one (queue_size=2 double-buffers them).
+
+Threads only overlap where a stage releases the GIL, like zstd decompression and file I/O.
+Each stage times how long it is busy and how long it waits on its neighbours,
+so the bottleneck is the stage that is busy the whole time.
+'''
+
+_DONE = object()
+
+class StageStats:
+    __slots__ = ('name', 'num_items', 'busy_seconds', 'input_wait_seconds', 'output_wait_seconds')
+
+    def __init__(self, name):
+        self.name = name
+        self.num_items = 0
+        self.busy_seconds = 0.0
+        self.input_wait_seconds = 0.0
+        self.output_wait_seconds = 0.0
+
+
+class Stage:
+    ''' A named function applied to every item. Items it returns None for are dropped. '''
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+
+
+class _Stopped(Exception):
+    pass
+
+class Pipeline:
+    def __init__(self, source_name, source, stages, queue_size=2):
+        self.source = source
+        self.stages = stages
+        self.stats = [StageStats(source_name)] + [StageStats(stage.name) for stage in stages]
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.stopped = threading.Event()
+        self.errors = []
+        self.wall_seconds = 0.0
+
+    def get(self, q):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if self.stopped.is_set():
+                    raise _Stopped()
+
+    def put(self, q, item):
+        while True:
+            try:
+                return q.put(item, timeout=0.1)
+            except queue.Full:
+                if self.stopped.is_set():
+                    raise _Stopped()
+
+    def run_source(self):
+        stats = self.stats[0]
+        output = self.queues[0] if self.queues else None
+        iterator = iter(self.source)
+        while True:
+            start = time.perf_counter()
+            item = next(iterator, _DONE)
+            stats.busy_seconds += time.perf_counter() - start
+            if item is _DONE:
+                break
+            stats.num_items += 1
+            if output is not None:
+                start = time.perf_counter()
+                self.put(output, item)
+                stats.output_wait_seconds += time.perf_counter() - start
+        if output is not None:
+            self.put(output, _DONE)
+
+    def run_stage(self, i):
+        stage = self.stages[i]
+        stats = self.stats[i + 1]
+        input_queue = self.queues[i]
+        output = self.queues[i + 1] if i + 1 < len(self.queues) else None
+        while True:
+            start = time.perf_counter()
+            item = self.get(input_queue)
+            stats.input_wait_seconds += time.perf_counter() - start
+            if item is _DONE:
+                break
+            start = time.perf_counter()
+            result = stage.function(item)
+            stats.busy_seconds += time.perf_counter() - start
+            stats.num_items += 1
+            if output is not None and result is not None:
+                start = time.perf_counter()
+                self.put(output, result)
+                stats.output_wait_seconds += time.perf_counter() - start
+        if output is not None:
+            self.put(output, _DONE)
+
+    def run_thread(self, target, *args):
+        try:
+            target(*args)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            self.errors.append(e)
+            self.stopped.set()
+
+    def run(self):
+        ''' Run every stage to completion, re-raising the first error of any stage '''
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self.run_thread, args=(self.run_source,), daemon=True)]
+        threads += [threading.Thread(target=self.run_thread, args=(self.run_stage, i), daemon=True)
+                    for i in range(len(self.stages))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.wall_seconds = time.perf_counter() - start
+        if self.errors:
+            raise self.errors[0]
+        return self.stats
+
+    def print_utilization(self):
+        print(f'Pipeline stages over {self.wall_seconds:.2f}s:')
+        print(f'  {"stage":<10} {"items":>8} {"busy":>8} {"% busy":>7} {"% wait in":>10} {"% wait out":>11}')
+        wall_seconds = max(self.wall_seconds, 1e-9)
+        for stats in self.stats:
+            print(f'  {stats.name:<10} {stats.num_items:8d} {stats.busy_seconds:7.2f}s'
+                  f' {stats.busy_seconds / wall_seconds * 100:6.1f}%'
+                  f' {stats.input_wait_seconds / wall_seconds * 100:9.1f}%'
+                  f' {stats.output_wait_seconds / wall_seconds * 100:10.1f}%')
+        bottleneck = max(self.stats, key=lambda stats: stats.busy_seconds)
+        print(f'  bottleneck: {bottleneck.name}')
+
+
+def run_pipeline(source_name, source, stages, queue_size=2, print_utilization=True):
+    ''' Run stages over the items of source in threads, returning the StageStats of each stage '''
+    pipeline = Pipeline(source_name, source, stages, queue_size)
+    stats = pipeline.run()
+    if print_utilization:
+        pipeline.print_utilization()
+    return stats
@@ -0,0 +1,60 @@
+import os
+
+import zstandard
+
+''' Write training positions as .plain text records, a whole batch per write call
+
+A position is a (fen, move, score, ply, result) tuple, the argument order of
+BinpackWriter.add_position. A batch is formatted by one join over the records and
+written as one bytes object, optionally through a zstd compressor that runs while
+the next batch is being filtered, since zstd releases the GIL.
+'''
+
+def format_plain_records(positions):
+    ''' The .plain text of a batch of positions as ascii bytes '''
+    return ''.join([
+        f'fen {fen}\nscore {score}\nmove {move}\nply {ply}\nresult {result}\ne\n'
+        for fen, move, score, ply, result in positions
+    ]).encode('ascii')
+
+
+class PlainWriter:
+    ''' A .plain file, zstd-compressed when compression_level is given (eg. for a .plain.zst) '''
+    def __init__(self, output_filename, compression_level=None, threads=0, append=False):
+        self.file = open(output_filename, 'ab' if append else 'wb')
+        self.compressor = None
+        self.outfile = self.file
+        if compression_level is not None:
+            self.compressor = zstandard.ZstdCompressor(level=compression_level, threads=threads)
+            self.outfile = self.compressor.stream_writer(self.file, closefd=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        ''' Write already formatted .plain bytes '''
+        self.outfile.write(data)
+
+    def write_positions(self, positions):
+        if positions:
+            self.write(format_plain_records(positions))
+
+    def flush(self):
+        ''' Write out everything written so far and sync the file, returning its length
+
+            A compressed file is flushed to the end of a zstd frame, so it decompresses
+            completely and more frames can be appended to it.
+        '''
+        if self.compressor is not None:
+            self.outfile.flush(zstandard.FLUSH_FRAME)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        if self.compressor is not None:
+            self.outfile.close()
+        self.file.close()
@@ -0,0 +1,209 @@
+import argparse
+import collections
+from glob import glob
+import operator
+import re
+import time
+
+import numpy as np
+
+from columnar import ColumnarPositions, ROW_DTYPE, SECOND_MOVE_COLUMNS, ZONE_COLUMNS, num_pieces
+
+''' Ad-hoc counting queries over columnar .cols files from columnar.py
+
+A query is a list of predicates like 'ply > 30' or 'abs(sf_bestmove1_score) < 100', all of
+which must hold, evaluated as NumPy masks over whole blocks. Blocks whose zone map shows
+no row can match are skipped without being read. Matching rows are counted, optionally
+grouped by a column and counting distinct piece placements.
+Rows with only one possible move never match a predicate on sf_bestmove2 or its score.
+
+  ./query.py 'ply > 30' 'abs(sf_bestmove1_score) < 100' --distinct data/*.cols
+  ./query.py 'num_sf_moves == 2' --group-by num_pieces --distinct data/*.cols
+  ./query.py --group-by ply:10 data/*.cols
+'''
+
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+DERIVED_COLUMNS = ['num_pieces']
+_PREDICATE_RE = re.compile(r'^\s*(abs\(\s*)?(\w+)\s*(?(1)\))\s*(<=|>=|==|!=|<|>)\s*(-?\d+)\s*$')
+
+def block_column(block, name):
+    ''' A stored or derived column of a block '''
+    if name == 'num_pieces':
+        return num_pieces(block['board'])
+    return block[name]
+
+
+class Predicate:
+    def __init__(self, column, op, value, absolute=False):
+        if column not in ROW_DTYPE.names and column not in DERIVED_COLUMNS or \
+           column in ROW_DTYPE.names and ROW_DTYPE[column].shape:
+            raise ValueError(f'unknown column: {column}')
+        if op not in OPERATORS:
+            raise ValueError(f'unknown operator: {op}')
+        self.column = column
+        self.op = op
+        self.value = value
+        self.absolute = absolute
+
+    @classmethod
+    def parse(cls, text):
+        ''' A predicate from text like 'ply > 30' or 'abs(sf_bestmove1_score) < 100' '''
+        match = _PREDICATE_RE.match(text)
+        if not match:
+            raise ValueError(f'bad predicate: {text}')
+        absolute, column, op, value = match.groups()
+        return cls(column, op, int(value), absolute=bool(absolute))
+
+    def __repr__(self):
+        column = f'abs({self.column})' if self.absolute else self.column
+        return f'{column} {self.op} {self.value}'
+
+    def mask(self, block):
+        values = block_column(block, self.column).astype(np.int32)
+        if self.absolute:
+            values = np.abs(values)
+        mask = OPERATORS[self.op](values, self.value)
+        if self.column in SECOND_MOVE_COLUMNS:
+            # rows with only one possible move have no 2nd best move, just a 0
+            mask &= block['num_sf_moves'] == 2
+        return mask
+
+    def may_match(self, zone_maps):
+        ''' For each block's zone map, False if no row in the block can match '''
+        if self.column not in ZONE_COLUMNS:
+            return np.ones(len(zone_maps), dtype=bool)
+        lo = zone_maps[f'{self.column}_min'].astype(np.int64)
+        hi = zone_maps[f'{self.column}_max'].astype(np.int64)
+        # a block with no values of the column, see block_zone_map
+        has_values = lo <= hi
+        return has_values & self.may_match_range(lo, hi)
+
+    def may_match_range(self, lo, hi):
+        ''' For each block's min and max of the column, False if no row in the block can match '''
+        if self.absolute:
+            lo, hi = np.where((lo <= 0) & (hi >= 0), 0, np.minimum(np.abs(lo), np.abs(hi))), \
+                     np.maximum(np.abs(lo), np.abs(hi))
+        if self.op == '<':
+            return lo < self.value
+        elif self.op == '<=':
+            return lo <= self.value
+        elif self.op == '>':
+            return hi > self.value
+        elif self.op == '>=':
+            return hi >= self.value
+        elif self.op == '==':
+            return (lo <= self.value) & (self.value <= hi)
+        # != only rules out blocks where every row has the value
+        return (lo != self.value) | (hi != self.value)
+
+
+class Query:
+    ''' Count the rows of .cols files matching every predicate
+
+        group_by is a column name, with rows bucketed by group_width.
+        With distinct set, the distinct piece placements of each group's rows
+        are counted too, across every file.
+    '''
+    def __init__(self, predicates, group_by=None, group_width=1, distinct=False):
+        if group_by is not None and group_by not in ROW_DTYPE.names and group_by not in DERIVED_COLUMNS:
+            raise ValueError(f'unknown column: {group_by}')
+        self.predicates = predicates
+        self.group_by = group_by
+        self.group_width = group_width
+        self.distinct = distinct
+        self.num_rows = 0
+        self.num_blocks = 0
+        self.num_blocks_skipped = 0
+        self.counts = collections.Counter()
+        self.distinct_hashes = collections.defaultdict(list)
+
+    def run(self, columnar_files):
+        for columns in columnar_files:
+            may_match = np.ones(columns.num_blocks, dtype=bool)
+            for predicate in self.predicates:
+                may_match &= predicate.may_match(columns.zone_maps)
+            self.num_blocks += columns.num_blocks
+            self.num_blocks_skipped += int((~may_match).sum())
+            for block_index in np.flatnonzero(may_match):
+                self.process_block(columns.block(block_index))
+        return self.results()
+
+    def process_block(self, block):
+        self.num_rows += len(block['ply'])
+        mask = np.ones(len(block['ply']), dtype=bool)
+        for predicate in self.predicates:
+            mask &= predicate.mask(block)
+            if not mask.any():
+                return
+        if self.group_by is None:
+            groups = np.zeros(int(mask.sum()), dtype=np.int64)
+        else:
+            groups = block_column(block, self.group_by)[mask].astype(np.int64) // self.group_width * self.group_width
+        if self.distinct:
+            hashes = block['placement_hash'][mask]
+            for group in np.unique(groups):
+                self.distinct_hashes[int(group)].append(np.unique(hashes[groups == group]))
+        values, counts = np.unique(groups, return_counts=True)
+        self.counts.update(dict(zip(values.tolist(), counts.tolist())))
+
+    def results(self):
+        ''' {group: (num matching rows, num distinct placements or None)}, group None if not grouped '''
+        results = {}
+        for group in sorted(self.counts):
+            num_distinct = None
+            if self.distinct:
+                num_distinct = len(np.unique(np.concatenate(self.distinct_hashes[group])))
+            results[group if self.group_by is not None else None] = (self.counts[group], num_distinct)
+        return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count positions in columnar .cols files matching predicates')
+    parser.add_argument('args', nargs='+', metavar='PREDICATE or FILE',
+                        help="predicates like 'ply > 30' or 'abs(sf_bestmove1_score) < 100', then .cols files or globs")
+    parser.add_argument('--group-by', metavar='COLUMN[:WIDTH]',
+                        help='count per value of a column, bucketed by WIDTH')
+    parser.add_argument('--distinct', action='store_true',
+                        help='also count distinct piece placements')
+    args = parser.parse_intermixed_args()
+    predicates = []
+    filenames = []
+    for arg in args.args:
+        if _PREDICATE_RE.match(arg):
+            try:
+                predicates.append(Predicate.parse(arg))
+            except ValueError as e:
+                parser.error(f'{e}, in {arg!r}')
+            continue
+        matches = sorted(glob(arg))
+        if not matches:
+            parser.error(f'{arg!r} is neither a predicate nor a file')
+        filenames += matches
+    if not filenames:
+        parser.error('no .cols files given')
+    group_by, group_width = None, 1
+    if args.group_by:
+        group_by, _, width = args.group_by.partition(':')
+        group_width = int(width or 1)
+    start = time.perf_counter()
+    try:
+        query = Query(predicates, group_by, group_width, args.distinct)
+    except ValueError as e:
+        parser.error(str(e))
+    results = query.run(ColumnarPositions(filename) for filename in filenames)
+    print(f'Where {" and ".join(map(repr, predicates)) or "any position"}:')
+    for group, (count, num_distinct) in results.items():
+        label = 'total' if group is None else f'{group_by} {group}' if group_width == 1 else \
+                f'{group_by} {group}-{group + group_width - 1}'
+        distinct = '' if num_distinct is None else \
+                   f'   distinct {num_distinct:10d}   % distinct {num_distinct / count * 100:6.2f}'
+        print(f'  {label:<24} {count:10d}{distinct}')
+    print(f'Scanned {query.num_rows} rows in {query.num_blocks - query.num_blocks_skipped} of {query.num_blocks} blocks, '
+          f'{query.num_blocks_skipped} skipped by zone maps, in {time.perf_counter() - start:.2f}s')
@@ -0,0 +1,245 @@
+import argparse
+import hashlib
+import os
+import os.path
+import struct
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from binpack import BinpackWriter, iter_entries, move_to_uci
+from bitboards import parse_square, square_name
+from csv_reader import iter_csv_row_batches
+
+''' A cache of rescore results, so positions searched before aren't searched again
+
+The cache maps a position and the search settings to the two best moves and scores of
+the search, the last 4 fields of a rescored .csv row. It's built from the .csv.zst files
+of earlier months, and rescoring a .binpack through it only sends the positions that
+aren't in it to binpack_to_csv.sh:
+
+  ./rescore_cache.py add rescore.cache /mnt/data/*.binpack.csv.zst
+  ./rescore_cache.py rescore rescore.cache X.binpack | grep 'd6 pv2' > X.binpack.csv
+
+A position's key is a 64-bit hash of its FEN without the move number, so the side to move,
+castling rights, en passant square and rule50 count are part of it, plus the search method
+field of the rows, eg. "d6 pv2". Results depend on the engine and network too, so use
+one cache file per Stockfish build.
+
+The rows of cached positions are made from the .binpack entries, with the FEN's move
+number worked out from the ply. It's the only field that can differ from a rescored row,
+and it isn't used when filtering since .binpack entries only keep the ply.
+
+File layout: a 4096 byte header, then the entries as CACHE_DTYPE sorted by key,
+memory-mapped and binary searched for lookups.
+'''
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SEARCH_METHOD = 'd6 pv2'
+
+CACHE_DTYPE = np.dtype([
+    ('key', '<u8'),
+    ('sf_bestmove1', '<u2'),
+    ('sf_bestmove2', '<u2'),
+    ('sf_bestmove1_score', '<i4'),
+    ('sf_bestmove2_score', '<i4'),
+])
+CACHE_FILE_MAGIC = b'NNUERSCC'
+CACHE_FILE_VERSION = 1
+_CACHE_FILE_HEADER = struct.Struct('<8sIQ')
+CACHE_FILE_HEADER_SIZE = 4096
+
+PROMOTION_PIECES = ' nbrq'
+
+def position_key(fen, search_method):
+    ''' 64-bit key of a FEN, ignoring its move number, searched with search_method '''
+    position = fen.rsplit(' ', 1)[0]
+    return int.from_bytes(hashlib.blake2b(f'{position}|{search_method}'.encode(), digest_size=8).digest(), 'little')
+
+def encode_uci(uci):
+    ''' A uci move as a uint16, 0 for no move '''
+    if not uci:
+        return 0
+    promotion = PROMOTION_PIECES.index(uci[4]) if len(uci) == 5 else 0
+    return 1 << 15 | promotion << 12 | parse_square(uci[0:2]) << 6 | parse_square(uci[2:4])
+
+def decode_uci(packed):
+    if not packed:
+        return ''
+    promotion = PROMOTION_PIECES[(packed >> 12) & 7].strip()
+    return square_name((packed >> 6) & 63) + square_name(packed & 63) + promotion
+
+def rows_to_entries(csv_rows):
+    ''' Cache entries of the rescored rows of a list of csv rows '''
+    entries = np.zeros(len(csv_rows), dtype=CACHE_DTYPE)
+    num_entries = 0
+    for csv_row in csv_rows:
+        split_row = csv_row.strip().split(",")
+        if len(split_row) == 10:
+            sf_bestmove2, sf_bestmove2_score = split_row[8], int(split_row[9])
+        elif len(split_row) == 8:
+            # only one possible move in the position
+            sf_bestmove2, sf_bestmove2_score = '', 0
+        else:
+            continue
+        entries[num_entries] = (position_key(split_row[1], split_row[5]), encode_uci(split_row[6]),
+                                encode_uci(sf_bestmove2), int(split_row[7]), sf_bestmove2_score)
+        num_entries += 1
+    return entries[:num_entries]
+
+def format_cached_row(entry, search_method, cached):
+    ''' A rescored .csv row of a .binpack entry from its cache entry '''
+    csv_row = f'{entry.ply},{entry.pos.fen()},{move_to_uci(entry.move)},{entry.score},{entry.result},' \
+              f'{search_method},{decode_uci(cached["sf_bestmove1"])},{cached["sf_bestmove1_score"]}'
+    if cached['sf_bestmove2']:
+        csv_row += f',{decode_uci(cached["sf_bestmove2"])},{cached["sf_bestmove2_score"]}'
+    return csv_row + '\n'
+
+
+class RescoreCache:
+    ''' The memory-mapped entries of a cache file, or an empty cache if there's no file yet '''
+    def __init__(self, filename):
+        self.filename = filename
+        if not os.path.isfile(filename):
+            self.entries = np.zeros(0, dtype=CACHE_DTYPE)
+            return
+        with open(filename, 'rb') as f:
+            magic, version, num_entries = _CACHE_FILE_HEADER.unpack(f.read(_CACHE_FILE_HEADER.size))
+        if magic != CACHE_FILE_MAGIC or version != CACHE_FILE_VERSION:
+            raise ValueError(f'{filename} is not a version {CACHE_FILE_VERSION} rescore cache file')
+        if num_entries == 0:
+            self.entries = np.zeros(0, dtype=CACHE_DTYPE)
+            return
+        self.entries = np.memmap(filename, dtype=CACHE_DTYPE, mode='r', offset=CACHE_FILE_HEADER_SIZE,
+                                 shape=(num_entries,))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, keys):
+        ''' Index of the cache entry of each key, or -1 if it's not cached '''
+        keys = np.asarray(keys, dtype=np.uint64)
+        if len(self.entries) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        cached_keys = self.entries['key']
+        indexes = np.minimum(np.searchsorted(cached_keys, keys), len(cached_keys) - 1)
+        return np.where(cached_keys[indexes] == keys, indexes, -1)
+
+    def add(self, csv_filenames):
+        ''' Add the rescored rows of .csv or .csv.zst files and rewrite the cache file
+
+            A position that's already cached keeps its cached result.
+        '''
+        parts = [np.array(self.entries)]
+        for csv_filename in csv_filenames:
+            num_rows = 0
+            for csv_rows in iter_csv_row_batches(csv_filename):
+                parts.append(rows_to_entries(csv_rows))
+                num_rows += len(parts[-1])
+            print(f'Read {num_rows} rescored rows from {csv_filename}')
+        entries = np.concatenate(parts)
+        # a stable sort keeps the earliest entry of a key first
+        entries = entries[np.argsort(entries['key'], kind='stable')]
+        is_first = np.ones(len(entries), dtype=bool)
+        is_first[1:] = entries['key'][1:] != entries['key'][:-1]
+        entries = entries[is_first]
+        num_added = len(entries) - len(self.entries)
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(_CACHE_FILE_HEADER.pack(CACHE_FILE_MAGIC, CACHE_FILE_VERSION, len(entries))
+                    .ljust(CACHE_FILE_HEADER_SIZE, b'\0'))
+            f.write(entries.tobytes())
+        os.replace(tmp_filename, self.filename)
+        self.__init__(self.filename)
+        print(f'Added {num_added} positions to {self.filename}, {len(self)} cached')
+
+
+def rescore_with_cache(binpack_filename, cache, outfile, search_method=DEFAULT_SEARCH_METHOD,
+                       rescore_command=None, batch_size=10000):
+    ''' Write the rescored .csv rows of a .binpack to outfile in .binpack order,
+        rescoring only the positions that aren't in the cache
+
+        The uncached positions are written to a temp .binpack next to the input and rescored
+        with rescore_command, binpack_to_csv.sh by default, while the cached rows go to a temp
+        .csv. The two are then merged back into the order of the input.
+    '''
+    rescore_command = rescore_command or [os.path.join(SCRIPT_DIR, 'binpack_to_csv.sh')]
+    tmp_dir = tempfile.mkdtemp(prefix='rescore-cache-', dir=os.path.dirname(os.path.abspath(binpack_filename)))
+    misses_filename = os.path.join(tmp_dir, 'misses.binpack')
+    hits_filename = os.path.join(tmp_dir, 'hits.csv')
+    rescore = None
+    try:
+        # whether each entry is cached, in .binpack order
+        is_cached = []
+        with BinpackWriter(misses_filename) as misses, open(hits_filename, 'w') as hits:
+            def process_batch(entries):
+                keys = [position_key(entry.pos.fen(), search_method) for entry in entries]
+                indexes = cache.lookup(keys)
+                for entry, index in zip(entries, indexes):
+                    if index < 0:
+                        misses.add_entry(entry)
+                    else:
+                        hits.write(format_cached_row(entry, search_method, cache.entries[index]))
+                is_cached.append(indexes >= 0)
+            entries = []
+            for entry in iter_entries(binpack_filename):
+                entries.append(entry)
+                if len(entries) == batch_size:
+                    process_batch(entries)
+                    entries = []
+            if entries:
+                process_batch(entries)
+            num_misses = misses.num_entries
+        is_cached = np.concatenate(is_cached) if is_cached else np.zeros(0, dtype=bool)
+        num_positions = len(is_cached)
+        print(f'{num_positions - num_misses} of {num_positions} positions of {binpack_filename} are cached, '
+              f'rescoring {num_misses}', file=sys.stderr)
+
+        rescored_rows = iter(())
+        if num_misses:
+            rescore = subprocess.Popen(rescore_command + [misses_filename], stdout=subprocess.PIPE, text=True)
+            rescored_rows = (row for row in rescore.stdout if search_method in row)
+        with open(hits_filename) as hits:
+            for cached in is_cached:
+                row = next(hits) if cached else next(rescored_rows, None)
+                if row is None:
+                    raise RuntimeError(f'Rescoring {num_misses} uncached positions of {binpack_filename} '
+                                       f'gave fewer rows, {rescore_command[0]} exited with status {rescore.wait()}')
+                outfile.write(row)
+        if rescore:
+            num_extra_rows = sum(1 for _ in rescored_rows)
+            if rescore.wait() != 0:
+                raise RuntimeError(f'{rescore_command[0]} exited with status {rescore.returncode}')
+            if num_extra_rows:
+                raise RuntimeError(f'Rescoring {num_misses} uncached positions of {binpack_filename} '
+                                   f'gave {num_extra_rows} more rows')
+    finally:
+        if rescore and rescore.poll() is None:
+            rescore.kill()
+            rescore.wait()
+        for filename in (misses_filename, hits_filename):
+            if os.path.isfile(filename):
+                os.remove(filename)
+        os.rmdir(tmp_dir)
+    return num_positions, num_misses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cache rescore results, and rescore only the positions not cached')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help='add the rows of rescored .csv or .csv.zst files to the cache')
+    add_parser.add_argument('cache_file')
+    add_parser.add_argument('csv_files', nargs='+')
+    rescore_parser = subparsers.add_parser('rescore', help='write the rescored .csv rows of a .binpack to stdout')
+    rescore_parser.add_argument('cache_file')
+    rescore_parser.add_argument('input_binpack')
+    rescore_parser.add_argument('--search-method', default=DEFAULT_SEARCH_METHOD,
+                                help='the search method field of the rows binpack_to_csv.sh writes')
+    args = parser.parse_args()
+    cache = RescoreCache(args.cache_file)
+    if args.command == 'add':
+        cache.add(args.csv_files)
+    else:
+        rescore_with_cache(args.input_binpack, cache, sys.stdout, args.search_method)
@@ -3,9 +3,14 @@ import os.path
 import sys
 
 import chess
+import numpy as np
 import zstandard
 
+from columnar import ColumnarPositions, compress_fen, move_is_capture
+
 ''' Iterate over positions .csv files and output .plain files
+
+A .cols file (columnar.py), or the one next to a .csv, is read a block of rows at a time instead.
 '''
 if len(sys.argv) != 2:
     print('Usage: ./iterate_csv.py <input_csv_file>')
@@ -16,6 +21,8 @@ if input_filename.endswith(".csv"):
     output_filename = input_filename.replace('.csv', '.csv.plain')
 elif input_filename.endswith(".csv.zst"):
     output_filename = input_filename.replace('.csv.zst', '.csv.zst.plain')
+elif input_filename.endswith(".cols"):
+    output_filename = input_filename.replace('.cols', '.plain')
 
 if os.path.isfile(output_filename):
     print(f'Found .csv.plain file. Doing nothing: {output_filename}')
@@ -34,6 +41,7 @@ num_overlap_sf_bestmove_captures = 0
 is_standard_game = False
 num_standard_games = 0
 num_non_standard_games = 0
+STANDARD_START_BOARD = np.frombuffer(compress_fen(chess.STARTING_FEN), dtype=np.uint8)
 
 def move_is_promo(uci_move):
     return len(uci_move) == 5 and uci_move[-1] in ['n','b','r','q']
@@ -90,16 +98,47 @@ def process_csv_rows(infile):
         if should_filter_out:
             num_positions_filtered_out += 1
         if num_positions % 10000 == 0:
-            print(f"Processed {num_positions} positions")
-            print(f'  # positions:                {num_positions}')
-            print(f'    # bestmove captures:      {num_bestmove_captures}')
-            print(f'    # bestmove promos:        {num_bestmove_promos}')
-            print(f'    # sf bestmove1 captures:  {num_sf_bestmove1_captures}')
-            print(f'      # overlap w/ bestmove:  {num_overlap_sf_bestmove_captures}')
-            print(f'    # filtered out:           {num_positions_filtered_out}')
+            print_progress()
+
+def process_columnar_blocks(columns):
+    ''' Same counts as process_csv_rows from the columns of a .cols file '''
+    global num_games, num_positions, num_positions_filtered_out, \
+           num_bestmove_captures, num_bestmove_promos, num_sf_bestmove1_captures, \
+           num_standard_games, num_non_standard_games, num_overlap_sf_bestmove_captures
+    for block in columns.iter_blocks():
+        is_game_start = block['ply'] == 0
+        is_standard_start = is_game_start & (block['board'] == STANDARD_START_BOARD).all(axis=1)
+        num_games += int(is_game_start.sum())
+        num_standard_games += int(is_standard_start.sum())
+        num_non_standard_games += int((is_game_start & ~is_standard_start).sum())
+        bestmove_is_capture = move_is_capture(block, 'bestmove')
+        # the promotion piece is in the top bits of a packed move
+        bestmove_is_promo = block['bestmove'] >> 12 != 0
+        sf_bestmove1_is_capture = move_is_capture(block, 'sf_bestmove1')
+        num_bestmove_captures += int(bestmove_is_capture.sum())
+        num_bestmove_promos += int(bestmove_is_promo.sum())
+        num_sf_bestmove1_captures += int(sf_bestmove1_is_capture.sum())
+        num_overlap_sf_bestmove_captures += int((sf_bestmove1_is_capture & (bestmove_is_capture | bestmove_is_promo)).sum())
+        num_positions_filtered_out += int((bestmove_is_capture | bestmove_is_promo | sf_bestmove1_is_capture).sum())
+        prev_num_positions = num_positions
+        num_positions += len(is_game_start)
+        if num_positions // 10000 > prev_num_positions // 10000:
+            print_progress()
+
+def print_progress():
+    print(f"Processed {num_positions} positions")
+    print(f'  # positions:                {num_positions}')
+    print(f'    # bestmove captures:      {num_bestmove_captures}')
+    print(f'    # bestmove promos:        {num_bestmove_promos}')
+    print(f'    # sf bestmove1 captures:  {num_sf_bestmove1_captures}')
+    print(f'      # overlap w/ bestmove:  {num_overlap_sf_bestmove_captures}')
+    print(f'    # filtered out:           {num_positions_filtered_out}')
 
 print(f'Processing {input_filename} ...')
-if input_filename.endswith(".csv.zst"):
+columns = ColumnarPositions.for_file(input_filename)
+if columns:
+    process_columnar_blocks(columns)
+elif input_filename.endswith(".csv.zst"):
     with open(input_filename, 'rb') as compressed_infile:
         dctx = zstandard.ZstdDecompressor()
         stream_reader = dctx.stream_reader(compressed_infile)
@@ -0,0 +1,102 @@
+import errno
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+import time
+
+from plain_writer import format_plain_records
+
+''' Stream .plain positions into `stockfish convert` through a named pipe
+
+`stockfish convert` picks the input format from the file extension, so it's given a FIFO
+named positions.plain instead of a .plain file on disk. Writes block while the pipe is full,
+so filtering never runs more than a pipe buffer ahead of the conversion, and a converter
+that fails makes the next write or close raise with its exit status.
+'''
+
+class ConverterError(Exception):
+    pass
+
+
+class StockfishConverter:
+    ''' A writer of .plain positions that are converted into output_filename as they're written '''
+    def __init__(self, output_filename, stockfish='stockfish', stdout=None):
+        self.output_filename = output_filename
+        self.tmp_dir = tempfile.mkdtemp(prefix='stockfish-convert-')
+        self.fifo_filename = os.path.join(self.tmp_dir, 'positions.plain')
+        os.mkfifo(self.fifo_filename)
+        self.process = subprocess.Popen([stockfish, 'convert', self.fifo_filename, output_filename],
+                                        stdout=stdout)
+        try:
+            self.fd = self.open_fifo()
+        except BaseException:
+            self.process.kill()
+            self.process.wait()
+            shutil.rmtree(self.tmp_dir)
+            raise
+
+    def open_fifo(self):
+        ''' Open the write end once the converter opens the read end, failing if it exits first '''
+        while True:
+            try:
+                fd = os.open(self.fifo_filename, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+            if self.process.poll() is not None:
+                raise ConverterError(f'stockfish convert exited with status {self.process.returncode} '
+                                     f'before reading {self.fifo_filename}')
+            time.sleep(0.01)
+        # blocking writes from here on, for backpressure
+        os.set_blocking(fd, True)
+        return fd
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        ''' Write already formatted .plain bytes '''
+        view = memoryview(data)
+        try:
+            while view:
+                view = view[os.write(self.fd, view):]
+        except BrokenPipeError:
+            self.abort()
+            raise ConverterError(f'stockfish convert exited with status {self.process.returncode} '
+                                 f'while converting into {self.output_filename}')
+
+    def write_positions(self, positions):
+        if positions:
+            self.write(format_plain_records(positions))
+
+    def close(self):
+        ''' Finish the input and wait for the conversion, raising if it failed '''
+        os.close(self.fd)
+        returncode = self.process.wait()
+        shutil.rmtree(self.tmp_dir)
+        if returncode != 0:
+            raise ConverterError(f'stockfish convert exited with status {returncode} '
+                                 f'while converting into {self.output_filename}')
+
+    def abort(self):
+        ''' Stop the converter without finishing its output '''
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        # so a partial output isn't mistaken for a finished one
+        if os.path.isfile(self.output_filename):
+            os.remove(self.output_filename)
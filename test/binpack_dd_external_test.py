@@ -0,0 +1,70 @@
+import os
+import os.path
+import sys
+
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+GAMES_CSV_FILENAME = os.path.join(TEST_DIR, 'test.filter-games.csv')
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+from binpack import BinpackWriter
+from binpack_dd_external import dedup_files, output_filename_for
+
+''' The bucketed de-duplication against the same rules run on a Python set
+
+Three files share slices of the test games, so most of their positions are duplicates
+of another file's, and each has to keep just the positions no file before it had.
+'''
+
+def write_csv_files(tmp_dir):
+    with open(GAMES_CSV_FILENAME) as f:
+        csv_rows = f.readlines()
+    slices = {'a.csv': csv_rows[:700], 'b.csv': csv_rows[400:], 'c.csv': csv_rows[:300] + csv_rows[900:]}
+    filenames = []
+    for name, rows in slices.items():
+        filenames.append(os.path.join(tmp_dir, name))
+        with open(filenames[-1], 'w') as f:
+            f.writelines(rows)
+    return filenames
+
+def write_expected(input_filenames, tmp_dir):
+    ''' The .binpack of each file de-duplicated in memory, later files first '''
+    seen = set()
+    expected_filenames = []
+    for input_filename in sorted(input_filenames)[::-1]:
+        expected_filenames.append(os.path.join(tmp_dir, os.path.basename(input_filename) + '.expected.binpack'))
+        prev_ply = -1
+        with open(input_filename) as infile, BinpackWriter(expected_filenames[-1]) as outfile:
+            for csv_row in infile:
+                split_row = csv_row.strip().split(',')
+                if len(split_row) != 10:
+                    continue
+                ply, fen, bestmove_uci, bestmove_score, game_result = split_row[:5]
+                ply = int(ply)
+                piece_orientation = fen.split(' ')[0]
+                # the first row of a placement takes it, even if it's a dropped start position
+                seen_before = piece_orientation in seen
+                seen.add(piece_orientation)
+                if ply >= prev_ply and not seen_before:
+                    outfile.add_position(fen, bestmove_uci, bestmove_score, ply, game_result)
+                prev_ply = ply
+    return sorted(input_filenames)[::-1], expected_filenames
+
+def read_bytes(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def test_dedup_files(tmp_path):
+    input_filenames = write_csv_files(str(tmp_path))
+    ordered_filenames, expected_filenames = write_expected(input_filenames, str(tmp_path))
+    output_filenames = dedup_files(input_filenames, str(tmp_path), num_buckets=4, workers=1)
+    assert output_filenames == [output_filename_for(f) for f in ordered_filenames]
+    for output_filename, expected_filename in zip(output_filenames, expected_filenames):
+        assert read_bytes(output_filename) == read_bytes(expected_filename)
+    assert not [f for f in os.listdir(tmp_path) if f.startswith('binpack-dd-') or f.endswith('.tmp')]
+    # a finished run isn't redone, and an unfinished one isn't finished with stale outputs
+    assert dedup_files(input_filenames, str(tmp_path), num_buckets=4, workers=1) is None
+    os.remove(output_filenames[-1])
+    with pytest.raises(RuntimeError):
+        dedup_files(input_filenames, str(tmp_path), num_buckets=4, workers=1)
@@ -0,0 +1,90 @@
+import os
+import os.path
+import shutil
+import sys
+
+import chess
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+GAMES_CSV_FILENAME = os.path.join(TEST_DIR, 'test.filter-games.csv')
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+from binpack import BinpackWriter, iter_entries, move_to_uci
+from binpack_prefilter import EARLY_PLY_SKIP, prefilter_binpack, prefiltered_filename
+from csv_filter_v8 import filter_csv_to_plain
+
+''' The positions a .prefilter.binpack keeps against the rules worked out with python-chess,
+and against the positions csv_filter_v8.py keeps from the rescored games
+
+The .binpack is written from the test games, with their bestmoves and scores.
+'''
+
+def read_split_rows():
+    with open(GAMES_CSV_FILENAME) as f:
+        return [csv_row.strip().split(',') for csv_row in f]
+
+def position_key(fen, move, ply):
+    ''' A position by its board, side to move, move and ply, leaving out what a .binpack may write differently '''
+    return ' '.join(fen.split(' ')[:2]), move, int(ply)
+
+def write_games_binpack(tmp_dir):
+    binpack_filename = os.path.join(tmp_dir, 'games.binpack')
+    with BinpackWriter(binpack_filename) as outfile:
+        for split_row in read_split_rows():
+            ply, fen, bestmove_uci, bestmove_score, game_result = split_row[:5]
+            outfile.add_position(fen, bestmove_uci, bestmove_score, ply, game_result)
+    return binpack_filename
+
+def expected_positions(dedup):
+    positions = []
+    seen = set()
+    prev_ply = -1
+    for split_row in read_split_rows():
+        ply, fen, bestmove_uci = int(split_row[0]), split_row[1], split_row[2]
+        board = chess.Board(fen)
+        seen_before = board.board_fen() in seen
+        seen.add(board.board_fen())
+        is_start_of_game = ply < prev_ply or prev_ply == -1
+        prev_ply = ply
+        if not is_start_of_game and (ply <= EARLY_PLY_SKIP or dedup and seen_before or board.is_check() or
+                                     board.is_capture(chess.Move.from_uci(bestmove_uci))):
+            continue
+        positions.append(position_key(fen, bestmove_uci, ply))
+    return positions
+
+def read_plain_positions(plain_filename):
+    positions = []
+    with open(plain_filename) as f:
+        for record in f.read().split('e\n')[:-1]:
+            fields = dict(line.split(' ', 1) for line in record.splitlines())
+            positions.append(position_key(fields['fen'], fields['move'], fields['ply']))
+    return positions
+
+@pytest.mark.parametrize('dedup', [True, False])
+def test_prefilter(dedup, tmp_path):
+    binpack_filename = write_games_binpack(str(tmp_path))
+    prefilter = prefilter_binpack(binpack_filename, dedup)
+    positions = [position_key(entry.pos.fen(), move_to_uci(entry.move), entry.ply)
+                 for entry in iter_entries(prefiltered_filename(binpack_filename))]
+    expected = expected_positions(dedup)
+    assert positions == expected
+    assert prefilter.num_kept == len(expected)
+    assert prefilter.num_positions == len(read_split_rows())
+    assert prefilter.num_games == 8
+    assert (prefilter.num_seen_before > 0) == dedup
+    # already up to date
+    assert prefilter_binpack(binpack_filename, dedup) is None
+
+def test_v8_keeps_prefiltered_positions(tmp_path):
+    ''' Every position v8 keeps from the rescored games is kept by the prefilter '''
+    binpack_filename = write_games_binpack(str(tmp_path))
+    prefilter_binpack(binpack_filename, dedup=False)
+    prefiltered = {position_key(entry.pos.fen(), move_to_uci(entry.move), entry.ply)
+                   for entry in iter_entries(prefiltered_filename(binpack_filename))}
+    csv_filename = os.path.join(str(tmp_path), 'games.csv')
+    shutil.copy(GAMES_CSV_FILENAME, csv_filename)
+    v8_positions = read_plain_positions(filter_csv_to_plain(csv_filename, write_plain=True, use_features=False))
+    assert v8_positions
+    assert set(v8_positions) <= prefiltered
+    assert len(prefiltered) > len(v8_positions)
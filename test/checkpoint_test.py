@@ -0,0 +1,65 @@
+import os
+import os.path
+import sys
+
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+GAMES_CSV_FILENAME = os.path.join(TEST_DIR, 'test.filter-games.csv')
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+from checkpoint import FilterCheckpoint
+from csv_filter_v8 import filter_csv_to_plain
+
+''' A filter run killed after a checkpoint, then rerun, against one that ran through
+
+The input is the test games with the first half of them again, so the positions kept after
+the checkpoint depend on the de-duplication state it restores. The run is stopped right after
+its checkpoint at KILLED_ROW is saved, with positions after it already written to the temp
+output by the time it stops in some modes. The rerun has to resume from the checkpoint and
+write the same bytes as an uninterrupted run.
+'''
+
+CHECKPOINT_ROWS = 250
+KILLED_ROW = 1000
+
+class Killed(Exception):
+    pass
+
+def write_games_csv(tmp_dir):
+    with open(GAMES_CSV_FILENAME) as f:
+        csv_rows = f.readlines()
+    os.makedirs(tmp_dir)
+    csv_filename = os.path.join(tmp_dir, 'games.csv')
+    with open(csv_filename, 'w') as f:
+        f.writelines(csv_rows + csv_rows[:600])
+    return csv_filename
+
+def read_bytes(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+@pytest.mark.parametrize('write_plain', [False, True])
+@pytest.mark.parametrize('mode', ['rows', 'batch', 'pipeline'])
+def test_resume(mode, write_plain, tmp_path, monkeypatch, capsys):
+    options = {'write_plain': write_plain, 'use_features': False, 'checkpoint_rows': CHECKPOINT_ROWS,
+               'batch': mode == 'batch', 'pipeline': mode == 'pipeline'}
+    expected = read_bytes(filter_csv_to_plain(write_games_csv(str(tmp_path / 'through')), **options))
+
+    write = FilterCheckpoint.write
+    def write_and_kill(self, counters, seen_state, output_length):
+        write(self, counters, seen_state, output_length)
+        if counters['num_positions'] == KILLED_ROW:
+            raise Killed()
+    monkeypatch.setattr(FilterCheckpoint, 'write', write_and_kill)
+    csv_filename = write_games_csv(str(tmp_path / 'killed'))
+    with pytest.raises(Killed):
+        filter_csv_to_plain(csv_filename, **options)
+    [temp_filename] = [f for f in os.listdir(tmp_path / 'killed') if f.endswith('.tmp')]
+    assert os.path.getsize(tmp_path / 'killed' / temp_filename) > 0
+    capsys.readouterr()
+
+    output_filename = filter_csv_to_plain(csv_filename, **options)
+    assert f'from the checkpoint at row {KILLED_ROW}' in capsys.readouterr().out
+    assert read_bytes(output_filename) == expected
+    assert sorted(os.listdir(tmp_path / 'killed')) == sorted(os.listdir(tmp_path / 'through'))
@@ -0,0 +1,95 @@
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+
+import chess
+import numpy as np
+import zstandard
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TEST_DIR)
+GAMES_CSV_FILENAME = os.path.join(TEST_DIR, 'test.filter-games.csv')
+sys.path.insert(0, REPO_DIR)
+
+from columnar import ColumnarPositions, black_to_move, convert_csv, encode_rows, move_is_capture, num_pieces
+
+''' .cols files against the .csv rows they were converted from
+
+A .cols file has to convert back to the same bytes as its .csv, and the columns and board
+helpers have to agree with the rows and python-chess. The scripts that read a .cols file
+instead of the .csv have to print the same counts from either.
+'''
+
+def read_csv_rows():
+    with open(GAMES_CSV_FILENAME) as f:
+        return f.readlines()
+
+def convert_games_csv(tmp_dir, zst=False):
+    csv_filename = os.path.join(tmp_dir, 'games.csv')
+    shutil.copy(GAMES_CSV_FILENAME, csv_filename)
+    if zst:
+        with open(csv_filename, 'rb') as f:
+            data = f.read()
+        csv_filename += '.zst'
+        with open(csv_filename, 'wb') as f:
+            f.write(zstandard.ZstdCompressor().compress(data))
+    # small blocks, so the last one is a partial one and zone maps have several blocks
+    convert_csv(csv_filename, block_rows=64, workers=1)
+    return csv_filename
+
+def test_back_to_csv(tmp_path):
+    for zst in (False, True):
+        csv_filename = convert_games_csv(str(tmp_path), zst)
+        columns = ColumnarPositions.for_input(csv_filename)
+        assert ''.join(columns.iter_csv_rows()) == ''.join(read_csv_rows())
+
+def test_columns(tmp_path):
+    columns = ColumnarPositions.for_input(convert_games_csv(str(tmp_path)))
+    split_rows = [csv_row.strip().split(',') for csv_row in read_csv_rows()]
+    assert len(columns) == len(split_rows)
+    assert columns.num_blocks == (len(split_rows) + 63) // 64
+    assert columns.column('ply', 100, 300).tolist() == [int(split_row[0]) for split_row in split_rows[100:300]]
+    assert columns.column('num_sf_moves').tolist() == [len(split_row) // 2 - 3 for split_row in split_rows]
+    assert len(columns.zone_maps) == columns.num_blocks
+    assert columns.zone_maps['ply_min'][0] == min(int(split_row[0]) for split_row in split_rows[:64])
+
+def test_board_helpers():
+    csv_rows = read_csv_rows() + [
+        # en passant, castling and a capture by black
+        '20,rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3,e5f6,10,0,d6,e5d6,5,e5f6,3\n',
+        '20,rnbqkbnr/ppp1pppp/8/8/2Pp4/8/PP1PPPPP/RNBQKBNR b KQkq c3 0 3,d4c3,10,0,d6,d4c3,5\n',
+        '20,r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 3,e1g1,10,0,d6,a1a8,5\n',
+        '20,r3k2r/8/8/8/8/8/8/R3K2R b KQkq - 0 3,e8c8,10,0,d6,a8a1,5\n',
+        '20,rnbqkbnr/pppp1ppp/8/4p3/3P4/8/PPP1PPPP/RNBQKBNR b KQkq - 0 2,e5d4,10,0,d6,d8d4,5\n',
+    ]
+    rows, _ = encode_rows(csv_rows)
+    block = {name: rows[name] for name in rows.dtype.names}
+    boards = [chess.Board(csv_row.split(',')[1]) for csv_row in csv_rows]
+    assert num_pieces(block['board']).tolist() == [len(board.piece_map()) for board in boards]
+    assert black_to_move(block['board']).tolist() == [board.turn == chess.BLACK for board in boards]
+    for name, field in (('bestmove', 2), ('sf_bestmove1', 6)):
+        expected = [board.is_capture(chess.Move.from_uci(csv_row.split(',')[field]))
+                    for board, csv_row in zip(boards, csv_rows)]
+        assert any(expected)
+        assert move_is_capture(block, name).tolist() == expected
+
+def script_output(script, input_filename):
+    ''' What a script prints, but for the lines naming the input file '''
+    output = subprocess.run([sys.executable, os.path.join(REPO_DIR, script), input_filename], cwd=REPO_DIR,
+                            capture_output=True, text=True, check=True).stdout
+    return [line for line in output.splitlines() if 'games.csv' not in line]
+
+def test_scripts_read_cols(tmp_path):
+    csv_filename = os.path.join(str(tmp_path), 'games.csv')
+    shutil.copy(GAMES_CSV_FILENAME, csv_filename)
+    cols_dir = tmp_path / 'cols'
+    cols_dir.mkdir()
+    cols_filename = ColumnarPositions.for_input(convert_games_csv(str(cols_dir))).filename
+    for script in ('dupe_count_csv.py', 'stats_from_csv.py'):
+        expected = script_output(script, csv_filename)
+        assert len(expected) > 5
+        assert script_output(script, cols_filename) == expected
+        # and the .cols next to a .csv is used instead of it
+        assert script_output(script, cols_filename[:-len('.cols')]) == expected
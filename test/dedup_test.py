@@ -0,0 +1,162 @@
+import multiprocessing
+import os
+import os.path
+import sys
+
+import numpy as np
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+GAMES_CSV_FILENAME = os.path.join(TEST_DIR, 'test.filter-games.csv')
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+from dedup import BloomFilter, PositionHashSet, SharedPositionHashSet, placement_hash, placement_hashes
+
+''' The de-duplication sets against a Python set of the same positions
+
+Hashes are drawn from a seeded generator with plenty of repeats, within a batch and across
+batches, and the piece placements of the test games cover the string methods.
+'''
+
+def random_hashes(num_hashes, num_distinct, seed=1):
+    rng = np.random.default_rng(seed)
+    distinct = rng.integers(1, 1 << 64, size=num_distinct, dtype=np.uint64)
+    return distinct[rng.integers(0, num_distinct, size=num_hashes)]
+
+def expected_seen_before(hashes, seen=None):
+    ''' Which hashes a set would have seen before, in order, and the Python set after them '''
+    seen = set() if seen is None else seen
+    seen_before = []
+    for h in hashes.tolist():
+        seen_before.append(h in seen)
+        seen.add(h)
+    return np.array(seen_before), seen
+
+def game_placements():
+    with open(GAMES_CSV_FILENAME) as f:
+        return [csv_row.split(',')[1].split(' ')[0] for csv_row in f]
+
+
+def test_placement_hashes():
+    placements = game_placements()
+    assert placement_hashes(placements).tolist() == [placement_hash(p) for p in placements]
+    assert 0 not in placement_hashes(placements)
+
+def test_hash_set_strings():
+    placements = game_placements()
+    seen = PositionHashSet(capacity=16)
+    expected = set()
+    for placement in placements:
+        assert (placement in seen) == (placement in expected)
+        assert seen.test_and_add(placement) == (placement in expected)
+        expected.add(placement)
+    assert len(seen) == len(expected)
+    assert all(placement in seen for placement in placements)
+
+def test_hash_set_batches_grow():
+    hashes = random_hashes(200000, 50000)
+    seen = PositionHashSet(capacity=16)
+    expected = None
+    for batch in np.array_split(hashes, 7):
+        expected_batch, expected = expected_seen_before(batch, expected)
+        assert (seen.test_and_add_hashes(batch) == expected_batch).all()
+        assert seen.load_factor <= seen.max_load_factor
+    assert len(seen) == len(expected)
+    # one at a time gives the same answers
+    one_at_a_time = PositionHashSet(capacity=16)
+    assert [one_at_a_time.test_and_add_hash(h) for h in hashes.tolist()] == \
+           expected_seen_before(hashes)[0].tolist()
+
+def test_hash_set_checkpoint():
+    hashes = random_hashes(20000, 5000)
+    seen = PositionHashSet()
+    seen.test_and_add_hashes(hashes[:10000])
+    state = {name: np.array(value) for name, value in seen.checkpoint_state().items()}
+    after = seen.test_and_add_hashes(hashes[10000:])
+    restored = PositionHashSet()
+    restored.restore_state(state)
+    assert (restored.test_and_add_hashes(hashes[10000:]) == after).all()
+    assert len(restored) == len(seen)
+
+
+def test_shared_hash_set(tmp_path):
+    filename = str(tmp_path / 'positions.hashset')
+    hashes = random_hashes(100000, 30000)
+    seen = SharedPositionHashSet(filename, capacity=1 << 16, num_shards=16)
+    expected_first, expected = expected_seen_before(hashes[:50000])
+    assert (seen.test_and_add_hashes(hashes[:50000]) == expected_first).all()
+    expected_second, expected = expected_seen_before(hashes[50000:], expected)
+    assert [seen.test_and_add_hash(h) for h in hashes[50000:].tolist()] == expected_second.tolist()
+    assert len(seen) == len(expected)
+    seen.close()
+    # the set lives in the file, with the size it was created with
+    reopened = SharedPositionHashSet(filename, capacity=1 << 20, num_shards=1024)
+    assert (reopened.num_shards, reopened.shard_capacity) == (16, 1 << 12)
+    assert len(reopened) == len(expected)
+    assert all(reopened.test_and_add_hash(h) for h in hashes[:5000].tolist())
+    reopened.close()
+
+def add_to_shared_hash_set(filename, hashes):
+    seen = SharedPositionHashSet(filename)
+    seen_before = seen.test_and_add_hashes(hashes)
+    seen.close()
+    return hashes[~seen_before]
+
+def test_shared_hash_set_processes(tmp_path):
+    filename = str(tmp_path / 'positions.hashset')
+    SharedPositionHashSet(filename, capacity=1 << 16, num_shards=16).close()
+    hashes = random_hashes(80000, 30000)
+    # overlapping halves, so most hashes are added by both processes
+    with multiprocessing.Pool(2) as pool:
+        first_added = pool.starmap(add_to_shared_hash_set, [(filename, hashes[:50000]), (filename, hashes[30000:])])
+    added = np.concatenate(first_added)
+    # every distinct hash was new to exactly one process
+    assert len(added) == len(np.unique(added)) == len(np.unique(hashes))
+    seen = SharedPositionHashSet(filename)
+    assert len(seen) == len(np.unique(hashes))
+    seen.close()
+
+def test_shared_hash_set_needs_a_capacity(tmp_path):
+    filename = str(tmp_path / 'positions.hashset')
+    with pytest.raises(ValueError):
+        SharedPositionHashSet(filename)
+    assert not os.path.exists(filename)
+
+def test_shared_hash_set_full(tmp_path):
+    seen = SharedPositionHashSet(str(tmp_path / 'positions.hashset'), capacity=1 << 10, num_shards=4)
+    with pytest.raises(RuntimeError):
+        seen.test_and_add_hashes(random_hashes(4000, 4000))
+    seen.close()
+
+
+def test_bloom_filter():
+    hashes = random_hashes(60000, 20000)
+    bloom = BloomFilter(20000, target_fpr=0.01)
+    expected, _ = expected_seen_before(hashes)
+    seen_before = bloom.test_and_add_hashes(hashes)
+    # no false negatives, and few false positives
+    assert seen_before[expected].all()
+    num_false_positives = int((seen_before & ~expected).sum())
+    assert num_false_positives < 0.02 * 20000
+    assert len(bloom) == len(np.unique(hashes)) - num_false_positives
+    assert bloom.estimated_fpr < 0.02
+    # one at a time sets the same bits, and can only add false positives from bits set earlier in the batch
+    one_at_a_time = BloomFilter(20000, target_fpr=0.01)
+    one_at_a_time_seen_before = np.array([one_at_a_time.test_and_add_hash(h) for h in hashes.tolist()])
+    assert one_at_a_time_seen_before[seen_before].all()
+    assert (one_at_a_time.bits == bloom.bits).all()
+    new_hashes = random_hashes(10000, 10000, seed=2)
+    assert sum(bloom.contains_hash(h) for h in new_hashes.tolist()) < 0.02 * 10000
+
+def test_bloom_filter_file(tmp_path):
+    filename = str(tmp_path / 'positions.bloom')
+    hashes = random_hashes(30000, 10000)
+    bloom = BloomFilter(10000, target_fpr=0.001, filename=filename)
+    bloom.test_and_add_hashes(hashes)
+    num_added = len(bloom)
+    bloom.close()
+    # the filter keeps the size it was created with
+    reopened = BloomFilter(1000, target_fpr=0.1, filename=filename)
+    assert (reopened.num_bits, len(reopened)) == (bloom.num_bits, num_added)
+    assert reopened.test_and_add_hashes(hashes).all()
+    reopened.close()
@@ -0,0 +1,61 @@
+import os
+import os.path
+import sys
+
+import chess
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+GAMES_CSV_FILENAME = os.path.join(TEST_DIR, 'test.filter-games.csv')
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+from fast_board import FastBoard, verify_plain_file
+
+''' FastBoard's checks, captures and promotions against python-chess
+
+On every move of the test games, of the round-trip game with castling, en passant and
+promotions, and of positions picked for the cases python-chess has to get right.
+'''
+
+def classify(board, uci_move):
+    if isinstance(board, FastBoard):
+        return board.is_check(), board.is_capture(uci_move), board.is_en_passant(uci_move), \
+               board.is_promotion(uci_move)
+    move = chess.Move.from_uci(uci_move)
+    return board.is_check(), board.is_capture(move), board.is_en_passant(move), move.promotion is not None
+
+@pytest.mark.parametrize('fen, uci_move', [
+    # en passant, by white and by black
+    ('rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3', 'e5f6'),
+    ('rnbqkbnr/ppp1pppp/8/8/2Pp4/8/PP1PPPPP/RNBQKBNR b KQkq c3 0 3', 'd4c3'),
+    # a pawn push to the en passant square's file isn't en passant
+    ('rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3', 'e5e6'),
+    # castling, and a chess960 castling move onto the own rook
+    ('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1', 'e1g1'),
+    ('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1', 'e1h1'),
+    # checks by a pawn, a knight, a slider through a gap and a blocked slider
+    ('4k3/3P4/8/8/8/8/8/4K3 b - - 0 1', 'e8d7'),
+    ('4k3/8/3N4/8/8/8/8/4K3 b - - 0 1', 'e8f8'),
+    ('4k3/8/8/8/8/8/8/4K2Q b - - 0 1', 'e8d8'),
+    ('4k3/8/8/8/4p3/8/8/4R1K1 b - - 0 1', 'e8d8'),
+    # promotions, with and without a capture
+    ('3rk3/2P5/8/8/8/8/8/4K3 w - - 0 1', 'c7d8q'),
+    ('4k3/2P5/8/8/8/8/8/4K3 w - - 0 1', 'c7c8n'),
+])
+def test_positions(fen, uci_move):
+    assert classify(FastBoard(fen), uci_move) == classify(chess.Board(fen), uci_move)
+
+def test_game_moves():
+    with open(GAMES_CSV_FILENAME) as f:
+        csv_rows = [csv_row.strip().split(',') for csv_row in f]
+    num_moves = 0
+    for split_row in csv_rows:
+        fen = split_row[1]
+        for uci_move in [split_row[2]] + split_row[6::2]:
+            assert classify(FastBoard(fen), uci_move) == classify(chess.Board(fen), uci_move), (fen, uci_move)
+            num_moves += 1
+    assert num_moves > 3000
+
+def test_plain_files():
+    for filename in ['test.round-trip-game.plain', 'test.remove-in-check.plain', 'test.remove-captures.plain']:
+        assert verify_plain_file(os.path.join(TEST_DIR, filename)) == 0
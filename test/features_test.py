@@ -0,0 +1,72 @@
+import os
+import os.path
+import shutil
+import sys
+
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+GAMES_CSV_FILENAME = os.path.join(TEST_DIR, 'test.filter-games.csv')
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+from csv_filter import filter_csv
+from csv_filter_v8 import board_check_failure, filter_csv_to_plain
+from features import PositionFeatures, batch_features, build_features, features_filename
+
+''' The features sidecar against the boards it was worked out from
+
+The sidecar's bits and v8 board check failures have to be the ones FastBoard gives for
+every row, and filtering with the sidecar has to write the same output as without it.
+'''
+
+def copy_games_csv(tmp_dir):
+    os.makedirs(tmp_dir, exist_ok=True)
+    csv_filename = os.path.join(tmp_dir, 'games.csv')
+    shutil.copy(GAMES_CSV_FILENAME, csv_filename)
+    return csv_filename
+
+def read_bytes(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+def test_features(tmp_path):
+    csv_filename = copy_games_csv(str(tmp_path))
+    build_features(csv_filename, workers=1)
+    features = PositionFeatures.for_input(csv_filename)
+    with open(csv_filename) as f:
+        csv_rows = f.readlines()
+    expected = batch_features(csv_rows)
+    assert features.num_rows == len(csv_rows)
+    assert (features.rows() == expected).all()
+    # ranges that don't start or end on a byte
+    for start, stop in [(3, 4), (5, 21), (997, len(csv_rows))]:
+        assert (features.rows(start, stop) == expected[start:stop]).all()
+    for row_index, csv_row in enumerate(csv_rows):
+        split_row = csv_row.strip().split(',')
+        if len(split_row) == 10:
+            assert features.board_check_failure(row_index) == \
+                   board_check_failure(split_row[1], split_row[2], split_row[6], split_row[8])
+
+def test_features_of_a_changed_file(tmp_path):
+    csv_filename = copy_games_csv(str(tmp_path))
+    build_features(csv_filename, workers=1)
+    data = bytearray(read_bytes(csv_filename))
+    # the same size, with the first move's score changed
+    data[data.index(b',1,0,') + 1] = ord('2')
+    with open(csv_filename, 'wb') as f:
+        f.write(data)
+    assert os.path.isfile(features_filename(csv_filename))
+    assert PositionFeatures.for_input(csv_filename) is None
+
+def test_filter_with_features(tmp_path):
+    outputs = {}
+    for use_features in (False, True):
+        csv_filename = copy_games_csv(str(tmp_path / f'features-{use_features}'))
+        if use_features:
+            build_features(csv_filename, workers=1)
+        # both write the same output file
+        v8_output = read_bytes(filter_csv_to_plain(csv_filename, use_features=use_features))
+        [v8_engine_filename] = filter_csv(csv_filename, ['v8'], use_features=use_features)
+        outputs[use_features] = v8_output, read_bytes(v8_engine_filename)
+    assert outputs[True] == outputs[False]
+    assert all(outputs[True])
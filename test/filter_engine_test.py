@@ -0,0 +1,76 @@
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TEST_DIR)
+GAMES_CSV_FILENAME = os.path.join(TEST_DIR, 'test.filter-games.csv')
+sys.path.insert(0, REPO_DIR)
+
+from csv_filter import filter_csv
+from filter_configs import FILTER_VERSIONS
+from filter_engine import FilterEngine
+
+''' The rule engine's filter versions against the csv_filter_vN.py scripts they replace
+
+test.filter-games.csv is 8 rescored games. The scripts and csv_filter.py write outputs
+with the same names, so each runs on its own copy of it. v6-dd is left out, since its
+script converts its output with the stockfish binary.
+
+The engine has to keep the same positions whichever order it runs the rules in.
+'''
+
+def run_script(version, tmp_dir):
+    ''' The .plain output of csv_filter_<version>.py on the test games '''
+    csv_filename = os.path.join(tmp_dir, 'games.csv')
+    os.makedirs(tmp_dir)
+    shutil.copy(GAMES_CSV_FILENAME, csv_filename)
+    options = ['--plain'] if version == 'v8' else []
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, f'csv_filter_{version}.py'), csv_filename] + options,
+                   cwd=tmp_dir, stdout=subprocess.DEVNULL, check=True)
+    with open(os.path.join(tmp_dir, f'games.csv.filter-{version}.plain')) as f:
+        return f.read()
+
+def run_engine(version, tmp_dir, csv_rows):
+    ''' The .plain output of the engine's version on csv_rows '''
+    csv_filename = os.path.join(tmp_dir, 'games.csv')
+    os.makedirs(tmp_dir)
+    with open(csv_filename, 'w') as f:
+        f.writelines(csv_rows)
+    [output_filename] = filter_csv(csv_filename, [version], write_plain=True, use_features=False)
+    with open(output_filename) as f:
+        return f.read()
+
+def read_csv_rows():
+    with open(GAMES_CSV_FILENAME) as f:
+        return f.readlines()
+
+def test_v8_is_the_same_as_the_script(tmp_path):
+    expected = run_script('v8', str(tmp_path / 'script'))
+    assert expected
+    assert run_engine('v8', str(tmp_path / 'engine'), read_csv_rows()) == expected
+
+@pytest.mark.parametrize('version', ['v5', 'v6', 'v7'])
+def test_scripts_lose_the_last_game(version, tmp_path):
+    expected = run_script(version, str(tmp_path / 'script'))
+    csv_rows = read_csv_rows()
+    last_game_start = max(i for i, csv_row in enumerate(csv_rows) if csv_row.startswith('0,'))
+    assert run_engine(version, str(tmp_path / 'engine-without-last-game'), csv_rows[:last_game_start]) == expected
+    output = run_engine(version, str(tmp_path / 'engine'), csv_rows)
+    assert output.startswith(expected) and len(output) > len(expected)
+
+@pytest.mark.parametrize('version', list(FILTER_VERSIONS))
+def test_rule_order_keeps_the_same_positions(version):
+    csv_rows = read_csv_rows()
+    declared_order = FilterEngine(FILTER_VERSIONS[version](), adaptive=False)
+    # reordered every 100 rows, after sampling 20 of them
+    adaptive = FilterEngine(FILTER_VERSIONS[version](), reorder_interval=100, sample_size=20)
+    kept = [declared_order.process_csv_row(csv_row) for csv_row in csv_rows]
+    assert any(kept)
+    assert [adaptive.process_csv_row(csv_row) for csv_row in csv_rows] == kept
+    assert adaptive.num_positions_filtered_out == declared_order.num_positions_filtered_out
+    assert sum(adaptive.counters.values()) == sum(declared_order.counters.values())
@@ -0,0 +1,101 @@
+import os
+import os.path
+import subprocess
+import sys
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TEST_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from manifest import MANIFEST_FILENAME, Manifest
+
+''' Whether the manifest says a built file is up to date after its files are changed, touched,
+damaged in place or deleted
+'''
+
+def write_file(filename, data, mtime_ns=None):
+    with open(filename, 'w') as f:
+        f.write(data)
+    if mtime_ns is not None:
+        os.utime(filename, ns=(mtime_ns, mtime_ns))
+
+def build(tmp_path):
+    ''' out.txt recorded as built from in.txt with tool.sh, and out.txt.zst from out.txt '''
+    filenames = {name: str(tmp_path / name) for name in ('in.txt', 'tool.sh', 'out.txt', 'out.txt.zst')}
+    for name, filename in filenames.items():
+        write_file(filename, f'{name}\n')
+    manifest = Manifest(str(tmp_path))
+    manifest.record(filenames['out.txt'], [filenames['in.txt']], [filenames['tool.sh']], {'level': '3'})
+    manifest.record(filenames['out.txt.zst'], [filenames['out.txt']])
+    return filenames
+
+def is_current(filenames, params={'level': '3'}, allow_missing=False):
+    # read from the file like a later run, with params as strings like from the command line
+    return Manifest.for_file(filenames['out.txt']).is_current(
+        filenames['out.txt'], [filenames['in.txt']], [filenames['tool.sh']], params, allow_missing)
+
+def test_up_to_date(tmp_path):
+    filenames = build(tmp_path)
+    assert is_current(filenames)
+    assert not is_current(filenames, params={'level': '4'})
+    manifest = Manifest(str(tmp_path))
+    assert manifest.is_current(filenames['out.txt'])
+    assert not manifest.is_current(filenames['out.txt'], inputs=[filenames['tool.sh']])
+    assert not manifest.is_current(filenames['in.txt'])
+
+def test_touched_files(tmp_path):
+    filenames = build(tmp_path)
+    for filename in filenames.values():
+        os.utime(filename, ns=(1, 1))
+    assert is_current(filenames)
+
+def test_changed_files(tmp_path):
+    for name in ('in.txt', 'tool.sh'):
+        filenames = build(tmp_path)
+        write_file(filenames[name], name.upper() + '\n')
+        assert not is_current(filenames)
+
+def test_damaged_output(tmp_path):
+    filenames = build(tmp_path)
+    mtime_ns = os.stat(filenames['out.txt']).st_mtime_ns
+    # the same size and mtime, so only its hash tells
+    write_file(filenames['out.txt'], 'OUT.TXT\n', mtime_ns)
+    assert not is_current(filenames)
+    # and out.txt.zst was built from the out.txt that was there before
+    assert not Manifest(str(tmp_path)).is_current(filenames['out.txt.zst'])
+
+def test_deleted_output(tmp_path):
+    filenames = build(tmp_path)
+    os.remove(filenames['out.txt'])
+    assert not is_current(filenames)
+    assert is_current(filenames, allow_missing=True)
+    assert Manifest(str(tmp_path)).is_current(filenames['out.txt.zst'])
+    write_file(filenames['in.txt'], 'IN.TXT\n')
+    assert not Manifest(str(tmp_path)).is_current(filenames['out.txt.zst'])
+
+def test_later_lines_replace_earlier_ones(tmp_path):
+    filenames = build(tmp_path)
+    write_file(filenames['in.txt'], 'IN.TXT\n')
+    write_file(filenames['out.txt'], 'OUT.TXT\n')
+    Manifest(str(tmp_path)).record(filenames['out.txt'], [filenames['in.txt']], [filenames['tool.sh']], {'level': '3'})
+    assert is_current(filenames)
+    with open(tmp_path / MANIFEST_FILENAME) as f:
+        assert len(f.readlines()) == 3
+
+def run_manifest(*args):
+    return subprocess.run([sys.executable, os.path.join(REPO_DIR, 'manifest.py')] + list(args),
+                          capture_output=True, text=True).returncode
+
+def test_command_line(tmp_path):
+    filenames = build(tmp_path)
+    args = [filenames['out.txt'], '--input', filenames['in.txt'], '--tool', filenames['tool.sh']]
+    assert run_manifest('check', *args, '--param', 'level=3') == 0
+    assert run_manifest('check', *args, '--param', 'level=4') == 1
+    assert run_manifest('check', filenames['out.txt.zst']) == 0
+    # an empty path from `command -v` for a missing binary, or a binary that isn't there
+    for tool in ('', str(tmp_path / 'no-such-tool')):
+        assert run_manifest('check', *args, '--tool', tool) == 2
+        assert run_manifest('record', *args, '--tool', tool) == 2
+    assert run_manifest('record', *args) == 0
+    assert run_manifest('check', *args) == 0
+    assert run_manifest('check', *args, '--param', 'level=3') == 1
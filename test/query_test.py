@@ -0,0 +1,90 @@
+import os
+import os.path
+import shutil
+import sys
+
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+GAMES_CSV_FILENAME = os.path.join(TEST_DIR, 'test.filter-games.csv')
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+from columnar import ColumnarPositions, convert_csv
+from query import OPERATORS, Predicate, Query
+
+''' Queries over a .cols file against the same counts worked out row by row from the .csv
+
+The .cols file has 64 row blocks, so zone maps have several blocks to skip.
+'''
+
+def read_rows():
+    ''' The values predicates can look at and the piece placement of each csv row '''
+    rows = []
+    with open(GAMES_CSV_FILENAME) as f:
+        for csv_row in f:
+            split_row = csv_row.strip().split(',')
+            piece_orientation = split_row[1].split(' ')[0]
+            rows.append(({
+                'ply': int(split_row[0]),
+                'bestmove_score': int(split_row[3]),
+                'sf_bestmove1_score': int(split_row[7]),
+                # rows with only one possible move have no 2nd best move
+                'sf_bestmove2_score': int(split_row[9]) if len(split_row) == 10 else None,
+                'num_pieces': sum(c.isalpha() for c in piece_orientation),
+            }, piece_orientation))
+    return rows
+
+def expected_results(predicates, group_by, group_width):
+    counts = {}
+    placements = {}
+    for values, piece_orientation in read_rows():
+        matches = True
+        for predicate in predicates:
+            value = values[predicate.column]
+            if value is None:
+                matches = False
+            elif predicate.absolute:
+                matches &= OPERATORS[predicate.op](abs(value), predicate.value)
+            else:
+                matches &= OPERATORS[predicate.op](value, predicate.value)
+        if not matches:
+            continue
+        group = None if group_by is None else values[group_by] // group_width * group_width
+        counts[group] = counts.get(group, 0) + 1
+        placements.setdefault(group, set()).add(piece_orientation)
+    return {group: (counts[group], len(placements[group])) for group in counts}
+
+@pytest.fixture(scope='module')
+def columns(tmp_path_factory):
+    csv_filename = str(tmp_path_factory.mktemp('query') / 'games.csv')
+    shutil.copy(GAMES_CSV_FILENAME, csv_filename)
+    convert_csv(csv_filename, block_rows=64, workers=1)
+    return ColumnarPositions.for_input(csv_filename)
+
+@pytest.mark.parametrize('predicates, group_by, group_width', [
+    ([], None, 1),
+    (['ply > 30'], None, 1),
+    (['ply > 30', 'abs(sf_bestmove1_score) < 100'], None, 1),
+    (['ply <= 4'], 'num_pieces', 1),
+    (['sf_bestmove2_score > -50'], 'ply', 10),
+    (['abs(bestmove_score) >= 200', 'num_pieces != 32'], 'ply', 20),
+])
+def test_query(columns, predicates, group_by, group_width):
+    predicates = [Predicate.parse(text) for text in predicates]
+    expected = expected_results(predicates, group_by, group_width)
+    assert expected
+    assert Query(predicates, group_by, group_width, distinct=True).run([columns]) == expected
+    counts = {group: (count, None) for group, (count, _) in expected.items()}
+    assert Query(predicates, group_by, group_width).run([columns]) == counts
+
+def test_zone_maps_skip_blocks(columns):
+    # the test games start over at ply 0 every ~150 rows, so most blocks have no early plies
+    query = Query([Predicate.parse('ply <= 4')])
+    query.run([columns])
+    assert query.num_blocks == columns.num_blocks
+    assert 0 < query.num_blocks_skipped < query.num_blocks
+
+@pytest.mark.parametrize('text', ['ply >> 3', 'ply > x', 'abs(ply > 3', 'board > 0', 'no_such_column == 1'])
+def test_bad_predicates(text):
+    with pytest.raises(ValueError):
+        Predicate.parse(text)
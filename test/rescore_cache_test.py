@@ -0,0 +1,124 @@
+import os
+import os.path
+import sys
+
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TEST_DIR)
+GAMES_CSV_FILENAME = os.path.join(TEST_DIR, 'test.filter-games.csv')
+sys.path.insert(0, REPO_DIR)
+
+from binpack import BinpackWriter
+from rescore_cache import RescoreCache, decode_uci, encode_uci, position_key, rescore_with_cache
+
+''' Rescoring the test games through a cache against rescoring every position
+
+binpack_to_csv.sh is replaced by a script that looks each position up in the test games,
+so every position has the rescored fields of its first row there, whether it was cached or not.
+The start position is rescored differently in each game, and the cache keeps the first too.
+'''
+
+FAKE_RESCORE_SCRIPT = '''
+import sys
+sys.path.insert(0, {repo_dir!r})
+from binpack import iter_entries, move_to_uci
+from rescore_cache import position_key
+
+rescored = {{}}
+with open({games_csv_filename!r}) as f:
+    for csv_row in f:
+        split_row = csv_row.strip().split(',')
+        rescored.setdefault(position_key(split_row[1], split_row[5]), split_row[5:])
+print('info string rescoring', flush=True)
+for entry in iter_entries(sys.argv[-1]):
+    fen = entry.pos.fen()
+    fields = [entry.ply, fen, move_to_uci(entry.move), entry.score, entry.result]
+    print(','.join(map(str, fields + rescored[position_key(fen, 'd6 pv2')])))
+'''
+
+def read_csv_rows():
+    with open(GAMES_CSV_FILENAME) as f:
+        return f.readlines()
+
+@pytest.fixture
+def games(tmp_path):
+    ''' The test games as a .binpack, and the command rescoring it '''
+    binpack_filename = str(tmp_path / 'games.binpack')
+    with BinpackWriter(binpack_filename) as outfile:
+        for csv_row in read_csv_rows():
+            ply, fen, bestmove_uci, bestmove_score, game_result = csv_row.split(',')[:5]
+            outfile.add_position(fen, bestmove_uci, bestmove_score, ply, game_result)
+    script_filename = str(tmp_path / 'fake_rescore.py')
+    with open(script_filename, 'w') as f:
+        f.write(FAKE_RESCORE_SCRIPT.format(repo_dir=REPO_DIR, games_csv_filename=GAMES_CSV_FILENAME))
+    return binpack_filename, [sys.executable, script_filename]
+
+def rescore(binpack_filename, cache, rescore_command):
+    output_filename = binpack_filename + '.csv'
+    with open(output_filename, 'w') as outfile:
+        num_positions, num_misses = rescore_with_cache(binpack_filename, cache, outfile,
+                                                       rescore_command=rescore_command, batch_size=100)
+    with open(output_filename) as f:
+        return f.readlines(), num_misses
+
+def expected_rows(csv_rows):
+    ''' The rows with the rescored fields of the first row of their position, but for move numbers '''
+    rescored = {}
+    for csv_row in csv_rows:
+        split_row = csv_row.split(',')
+        rescored.setdefault(position_key(split_row[1], split_row[5]), split_row[5:])
+    return [without_move_number(csv_row.split(',')[:5] + rescored[position_key(csv_row.split(',')[1], 'd6 pv2')])
+            for csv_row in csv_rows]
+
+def without_move_number(split_row):
+    return [split_row[0], split_row[1].rsplit(' ', 1)[0]] + split_row[2:]
+
+def test_encode_uci():
+    for uci in ['e2e4', 'a7a8q', 'h2g1n', 'e1g1', 'a1h8', '']:
+        assert decode_uci(encode_uci(uci)) == uci
+
+def test_rescore(games, tmp_path):
+    binpack_filename, rescore_command = games
+    csv_rows = read_csv_rows()
+    expected, num_misses = rescore(binpack_filename, RescoreCache(str(tmp_path / 'empty.cache')), rescore_command)
+    assert num_misses == len(csv_rows)
+    assert [without_move_number(row.split(',')) for row in expected] == expected_rows(csv_rows)
+
+    cache_filename = str(tmp_path / 'rescore.cache')
+    first_games_filename = str(tmp_path / 'first-games.csv')
+    with open(first_games_filename, 'w') as f:
+        f.writelines(csv_rows[:600])
+    cache = RescoreCache(cache_filename)
+    cache.add([first_games_filename])
+    output, num_misses = rescore(binpack_filename, cache, rescore_command)
+    assert 0 < num_misses <= len(csv_rows) - len(cache)
+    assert output == expected
+
+    cache.add([GAMES_CSV_FILENAME])
+    # nothing left to rescore, so the command isn't run
+    output, num_misses = rescore(binpack_filename, RescoreCache(cache_filename), [sys.executable, '-c', 'exit(1)'])
+    assert num_misses == 0
+    assert output == expected
+    assert sorted(os.listdir(tmp_path)) == sorted(['rescore.cache', 'first-games.csv', 'games.binpack',
+                                                   'games.binpack.csv', 'fake_rescore.py'])
+
+def test_cached_results_are_kept(tmp_path):
+    csv_rows = read_csv_rows()
+    cache = RescoreCache(str(tmp_path / 'rescore.cache'))
+    cache.add([GAMES_CSV_FILENAME])
+    entries = cache.entries.copy()
+    rescored_again_filename = str(tmp_path / 'rescored-again.csv')
+    # the same positions with another best move score
+    with open(rescored_again_filename, 'w') as f:
+        f.writelines(','.join(csv_row.split(',')[:7] + ['12345'] + csv_row.split(',')[8:]) for csv_row in csv_rows)
+    cache.add([rescored_again_filename])
+    assert (cache.entries == entries).all()
+
+def test_rescore_failures(games, tmp_path):
+    binpack_filename, _ = games
+    cache = RescoreCache(str(tmp_path / 'empty.cache'))
+    for command in (['true'], [sys.executable, '-c', 'exit(3)']):
+        with pytest.raises(RuntimeError):
+            rescore(binpack_filename, cache, command)
+    assert not [f for f in os.listdir(tmp_path) if f.startswith('rescore-cache-')]
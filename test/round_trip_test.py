@@ -0,0 +1,98 @@
+import os
+import os.path
+import sys
+
+import zstandard
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+GAME_PLAIN_FILENAME = os.path.join(TEST_DIR, 'test.round-trip-game.plain')
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+from binpack import BinpackWriter, format_plain_entry, iter_entries
+from csv_reader import ZSTD_SKIPPABLE_MAGIC, iter_csv_rows, zstd_frame_bounds
+
+''' Round-trip tests of the .binpack codec and the .csv reader that need no Stockfish binary
+
+  python3 -m pytest test
+
+test.round-trip-game.plain is encoded with BinpackWriter and decoded with iter_entries,
+and has to give back the same records. It has whole games with castling, en passant and
+promotions, so consecutive positions are chained into movetext. The other .plain files
+here are inputs of run_test_cases.sh with moves that aren't legal, so they're left out.
+
+.csv rows made from those records are written to a .csv.zst of several zstd frames,
+cut in the middle of rows and with a skippable frame between them, and iter_csv_rows
+has to give back the same rows, decompressing the frames in threads or as a stream.
+'''
+
+def read_plain_records(plain_filename):
+    ''' The records of a .plain file as dicts of their fields, in any field order '''
+    records = []
+    record = {}
+    with open(plain_filename) as infile:
+        for line in infile:
+            line = line.strip()
+            if line == 'e':
+                records.append(record)
+                record = {}
+            elif line:
+                name, value = line.split(' ', 1)
+                record[name] = value
+    return records
+
+def binpack_round_trip(records, tmp_dir, chain=True, chunk_size=None):
+    ''' Encode records to a .binpack and decode it, returning the decoded records and the .binpack size '''
+    binpack_filename = os.path.join(tmp_dir, 'round-trip.binpack')
+    options = {'chain': chain} if chunk_size is None else {'chain': chain, 'chunk_size': chunk_size}
+    with BinpackWriter(binpack_filename, **options) as outfile:
+        for record in records:
+            outfile.add_position(record['fen'], record['move'], record['score'], record['ply'], record['result'])
+    decoded_plain_filename = os.path.join(tmp_dir, 'round-trip.plain')
+    with open(decoded_plain_filename, 'w') as outfile:
+        for entry in iter_entries(binpack_filename):
+            outfile.write(format_plain_entry(entry))
+    return read_plain_records(decoded_plain_filename), os.path.getsize(binpack_filename)
+
+def test_binpack_codec(tmp_path):
+    records = read_plain_records(GAME_PLAIN_FILENAME)
+    chained, chained_size = binpack_round_trip(records, str(tmp_path))
+    unchained, unchained_size = binpack_round_trip(records, str(tmp_path), chain=False)
+    one_stem_chunks, _ = binpack_round_trip(records, str(tmp_path), chunk_size=1)
+    assert chained == records
+    assert unchained == records
+    assert one_stem_chunks == records
+    assert chained_size < unchained_size
+
+def write_multi_frame_zst(zst_filename, data, frame_size):
+    ''' Compress data as one zstd frame per frame_size bytes, cut wherever that falls,
+        with a skippable frame after the first one
+    '''
+    compressor = zstandard.ZstdCompressor()
+    with open(zst_filename, 'wb') as outfile:
+        for start in range(0, len(data), frame_size):
+            outfile.write(compressor.compress(data[start:start + frame_size]))
+            if start == 0:
+                skipped = b'not csv rows'
+                outfile.write(ZSTD_SKIPPABLE_MAGIC.to_bytes(4, 'little') + len(skipped).to_bytes(4, 'little') + skipped)
+
+def test_csv_reader(tmp_path):
+    records = read_plain_records(GAME_PLAIN_FILENAME)
+    rows = [f'{record["ply"]},{record["fen"]},{record["move"]},{record["score"]},{record["result"]}\n'
+            for record in records] * 1000
+    data = ''.join(rows).encode()
+    csv_filename = str(tmp_path / 'round-trip.csv')
+    with open(csv_filename, 'wb') as outfile:
+        outfile.write(data)
+    zst_filename = csv_filename + '.zst'
+    frame_size = 100003
+    write_multi_frame_zst(zst_filename, data, frame_size)
+    with open(zst_filename, 'rb') as infile:
+        frames = zstd_frame_bounds(infile.read())
+    assert len(frames) == len(range(0, len(data), frame_size))
+    assert list(iter_csv_rows(csv_filename)) == rows
+    # frames decompressed in threads, and as a stream
+    assert list(iter_csv_rows(zst_filename, threads=4)) == rows
+    assert list(iter_csv_rows(zst_filename, threads=1)) == rows
+    assert list(iter_csv_rows(zst_filename, block_size=4096, threads=4)) == rows
+    assert list(iter_csv_rows(zst_filename, block_size=4096, threads=1)) == rows
+    assert list(iter_csv_rows(zst_filename, block_size=4096, threads=4, start_row=12345)) == rows[12345:]
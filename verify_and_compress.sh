@@ -3,6 +3,11 @@ set -eu -o pipefail
 
 binpack_file=$1
 
+if ! command -v zstd > /dev/null; then
+  echo zstd not found in PATH
+  exit 1
+fi
+
 if [ ! -f $binpack_file ]; then
   echo Binpack file not found: $binpack_file
   exit
@@ -19,9 +24,8 @@ fi
 echo "Found binpack: $binpack_file "
 echo "Found CSV:     $csv_filepath"
 echo Counting binpack positions...
-num_binpack_positions=$(stockfish-output-positions-csv \
-  gather_statistics position_count \
-  input_file $binpack_file | grep "Number of positions" | awk '{print $NF}')
+num_binpack_positions=$($(dirname $0)/count_binpack_positions.sh $binpack_file | \
+  grep "Number of positions" | awk '{print $NF}')
 num_csv_positions=$(wc -l $csv_filepath | awk '{print $1}')
 
 echo Num binpack positions: $num_binpack_positions
@@ -29,7 +33,10 @@ echo Num csv positions: $num_csv_positions
 
 if [ $num_binpack_positions -eq $num_csv_positions ]; then
   echo Same number of positions in both! Compressing CSV file...
-  zstd --ultra -22 --rsyncable --rm $csv_filepath
+  zstd -f --ultra -22 --rsyncable $csv_filepath
+  python3 $(dirname $0)/manifest.py record ${csv_filepath}.zst --input $csv_filepath --tool $0
+  rm $csv_filepath
 else
   echo Not continuing, Different number of positions: $num_binpack_positions != $num_csv_positions
+  exit 1
 fi